@@ -0,0 +1,343 @@
+"""Micro benchmarks of the training and inference settings on synthetic or real batches."""
+import argparse
+import copy
+import os
+import time
+import socket
+import resource
+import multiprocessing
+from statistics import mean
+
+import torch
+from torchvision import transforms
+
+from models import GRIDS, BACKBONES, get_image_model, get_text_encoder
+from steps.utils import autocast_context, to_channels_last, custom_loss, calc_recalls, compute_matchmap_similarity_matrix
+from steps.distributed import init_distributed, gather_embeddings, get_world_size
+
+parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+subparsers = parser.add_subparsers(dest='command')
+
+common = argparse.ArgumentParser(add_help=False)
+common.add_argument('-b', '--batch_size', default=16, type=int,
+                    help='mini-batch size, at least 10 for the recall scores')
+common.add_argument('--steps', default=10, type=int,
+                    help='number of timed steps per configuration')
+common.add_argument('--warmup', default=2, type=int,
+                    help='number of untimed steps run first')
+common.add_argument('--seq_length', default=22, type=int,
+                    help='caption length of synthetic batches (pad_limit + start and end words)')
+common.add_argument('--cnn_model', default='vgg', type=str, choices=list(BACKBONES),
+                    help='CNN Model')
+common.add_argument('--text_encoder', default='lstm', type=str,
+                    help='Text branch used to encode captions')
+common.add_argument('--embedding_dim', default=1024, type=int,
+                    help='Dimension of the word and image region embeddings')
+common.add_argument('--grid', default='14x14', type=str, choices=GRIDS,
+                    help='Spatial grid of the image embeddings')
+common.add_argument('--model_path', default='', type=str,
+                    help='checkpoint to load, models are randomly initialized otherwise')
+common.add_argument('--dataset', default='', type=str,
+                    help="use a validation batch of 'flickr', 'coco' or 'genome' instead of random data")
+common.add_argument('--parse_mode', default='phrase', type=str,
+                    help='parsing mode of the flickr captions')
+common.add_argument('--threads', default=0, type=int,
+                    help='number of intra-op threads, 0 keeps the torch default')
+common.add_argument('--margin', default=0.1, type=float,
+                    help='Margin parameter for triplet loss')
+common.add_argument('--score_type', default='Avg_Both', type=str,
+                    help='Metric used to compute score.')
+common.add_argument('--checkpoint_segments', default=0, type=int,
+                    help='Activation checkpointing of the CNN trunk in this many segments (0 disables it)')
+
+precision_parser = subparsers.add_parser('precision', parents=[common],
+                                         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                         help='compare fp32 / bf16 and channels last training steps')
+
+memory_parser = subparsers.add_parser('memory', parents=[common],
+                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                      help='compare peak memory and step time of activation checkpointing segments')
+memory_parser.add_argument('--segments', nargs='+', default=[0, 2, 4, 8], type=int,
+                           help='checkpointing segments to compare, 0 is no checkpointing')
+
+grid_parser = subparsers.add_parser('grid', parents=[common],
+                                    formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                    help='compare retrieval cost and recall of embedding dimensions and grids')
+grid_parser.add_argument('--model_paths', nargs='*', default=[],
+                         help='trained checkpoints to compare, their settings are read from the checkpoints')
+grid_parser.add_argument('--embedding_dims', nargs='+', default=[1024, 512, 256], type=int,
+                         help='embedding dimensions compared on untrained models when no checkpoints are given')
+grid_parser.add_argument('--grids', nargs='+', default=GRIDS, choices=GRIDS,
+                         help='grids compared on untrained models when no checkpoints are given')
+
+ddp_parser = subparsers.add_parser('ddp', parents=[common],
+                                   formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                   help='compare throughput and scaling of distributed training on one machine')
+ddp_parser.add_argument('--world_sizes', nargs='+', default=[1, 2, 4], type=int,
+                        help='numbers of processes to compare, the threads are split between the processes')
+
+transform = transforms.Compose([
+    transforms.Resize((224, 224)),
+    transforms.ToTensor(),
+    transforms.Normalize((0.485, 0.456, 0.406),
+                         (0.229, 0.224, 0.225))])
+
+
+def build_models(args):
+    """
+    Image and caption models of the benchmark, loaded from args.model_path if given
+    """
+    checkpoint = None
+    if args.model_path:
+        checkpoint = torch.load(args.model_path, map_location='cpu')
+        args.text_encoder = checkpoint.get('text_encoder', args.text_encoder)
+        args.cnn_model = checkpoint.get('cnn_model', 'vgg')
+        args.embedding_dim = checkpoint.get('embedding_dim', 1024)
+        args.grid = checkpoint.get('grid', '14x14')
+
+    # ImageNet weights are only worth downloading when real images are used
+    pretrained = checkpoint is None and bool(args.dataset)
+    image_model = get_image_model(args.cnn_model, args.embedding_dim, pretrained=pretrained,
+                                  checkpoint_segments=args.checkpoint_segments, grid=args.grid)
+    caption_model = get_text_encoder(args.text_encoder, op_size=args.embedding_dim)
+
+    if checkpoint is not None:
+        image_model.load_state_dict(checkpoint['image_model'])
+        caption_model.load_state_dict(checkpoint['caption_model'])
+    return image_model, caption_model
+
+
+def load_batch(args):
+    """
+    A batch of images and caption embeddings, random unless args.dataset is set
+    :return: image tensor (B x 3 x 224 x 224), caption glove tensor (B x T x 300)
+    """
+    if not args.dataset:
+        return torch.randn(args.batch_size, 3, 224, 224), torch.randn(args.batch_size, args.seq_length, 300)
+
+    from dataloader import get_loader_coco, get_loader_flickr, get_loader_genome
+    if args.dataset == 'flickr':
+        loader = get_loader_flickr(transform=transform, mode='val', batch_size=args.batch_size,
+                                   parse_mode=args.parse_mode)
+    elif args.dataset == 'coco':
+        loader = get_loader_coco(transform=transform, mode='val', batch_size=args.batch_size)
+    else:
+        loader = get_loader_genome(transform=transform, mode='train', batch_size=args.batch_size)
+    batch = next(iter(loader))
+    return batch[0], batch[1]
+
+
+def make_train_step(image_model, caption_model, image_ip, caption_glove_ip, args, precision='fp32'):
+    """
+    :return: function running one SGD step of both models on the batch
+    """
+    params = list(image_model.parameters()) + list(caption_model.parameters())
+    optimizer = torch.optim.SGD(params=params, lr=1e-4, momentum=0.9)
+
+    def train_step():
+        image_model.train()
+        caption_model.train()
+        with autocast_context(precision):
+            # Negatives of all processes when the models are distributed, as in train()
+            loss = custom_loss(gather_embeddings(image_model(image_ip)),
+                               gather_embeddings(caption_model(caption_glove_ip)),
+                               args.score_type, args.margin)
+        loss = loss.float()
+        optimizer.zero_grad()
+        (loss * get_world_size()).backward()
+        optimizer.step()
+
+    return train_step
+
+
+def time_steps(step, n_steps, n_warmup):
+    """
+    Run step n_warmup times, then time n_steps calls
+    :return: list of step times in seconds
+    """
+    for _ in range(n_warmup):
+        step()
+    times = list()
+    for _ in range(n_steps):
+        start = time.perf_counter()
+        step()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def precision_benchmark(args):
+    image_model, caption_model = build_models(args)
+    image_ip, caption_glove_ip = load_batch(args)
+
+    results = dict()
+    for precision in ['fp32', 'bf16']:
+        for channels_last in [False, True]:
+            # Every configuration trains its own copy, so all of them start from the same weights
+            image_copy = to_channels_last(copy.deepcopy(image_model), channels_last)
+            caption_copy = copy.deepcopy(caption_model)
+            images = to_channels_last(image_ip, channels_last)
+            train_step = make_train_step(image_copy, caption_copy, images, caption_glove_ip, args, precision)
+            times = time_steps(train_step, args.steps, args.warmup)
+
+            # Recall of the starting weights, so the configurations are compared on the same model
+            image_copy = to_channels_last(copy.deepcopy(image_model), channels_last).eval()
+            caption_copy = copy.deepcopy(caption_model).eval()
+            with torch.no_grad(), autocast_context(precision):
+                recalls = calc_recalls(image_copy(images), caption_copy(caption_glove_ip), args.score_type)
+
+            name = precision + (' channels_last' if channels_last else '')
+            results[name] = (mean(times), recalls)
+            print("%-20s step: %0.3fs  C_r1: %0.3f  C_r10: %0.3f  I_r1: %0.3f  I_r10: %0.3f" % (
+                name, mean(times), recalls['C_r1'], recalls['C_r10'], recalls['I_r1'], recalls['I_r10']))
+
+    base_time, base_recalls = results['fp32']
+    print('---------------------------------------------------------')
+    for name, (step_time, recalls) in results.items():
+        print("%-20s speedup: %0.2fx  R@10 delta caption: %+0.3f image: %+0.3f" % (
+            name, base_time / step_time, recalls['C_r10'] - base_recalls['C_r10'],
+            recalls['I_r10'] - base_recalls['I_r10']))
+
+
+def peak_memory():
+    """
+    Peak resident memory of the current process in MB (ru_maxrss is in KB on Linux)
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def memory_run(args, segments):
+    """
+    Train steps with one number of checkpointing segments. Runs in its own process, so the
+    peak memory of a configuration is not hidden by the peak of the previous one.
+    :return: mean step time, peak memory before training and peak memory while training (MB)
+    """
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    args.checkpoint_segments = segments
+    image_model, caption_model = build_models(args)
+    image_ip, caption_glove_ip = load_batch(args)
+    before = peak_memory()
+    times = time_steps(make_train_step(image_model, caption_model, image_ip, caption_glove_ip, args),
+                       args.steps, args.warmup)
+    return mean(times), before, peak_memory()
+
+
+def memory_benchmark(args):
+    context = multiprocessing.get_context('spawn')
+    results = dict()
+    for segments in args.segments:
+        with context.Pool(1) as pool:
+            results[segments] = pool.apply(memory_run, (args, segments))
+        step_time, before, peak = results[segments]
+        print("segments %2d  step: %0.3fs  peak memory: %0.0f MB  training overhead: %0.0f MB" % (
+            segments, step_time, peak, peak - before))
+
+    base_time, base_before, base_peak = results[args.segments[0]]
+    print('---------------------------------------------------------')
+    print("Batch size %d, relative to %d segments" % (args.batch_size, args.segments[0]))
+    for segments, (step_time, before, peak) in results.items():
+        print("segments %2d  step time: %0.2fx  training memory: %0.2fx" % (
+            segments, step_time / base_time, (peak - before) / max(base_peak - base_before, 1)))
+
+
+def grid_benchmark(args):
+    if args.model_paths:
+        settings = [{'model_path': model_path} for model_path in args.model_paths]
+    else:
+        settings = [{'embedding_dim': embedding_dim, 'grid': grid}
+                     for embedding_dim in args.embedding_dims for grid in args.grids]
+    image_ip, caption_glove_ip = load_batch(args)
+
+    for setting in settings:
+        vars(args).update(setting)
+        image_model, caption_model = build_models(args)
+        image_model.eval()
+        caption_model.eval()
+        with torch.no_grad():
+            image_op = image_model(image_ip)
+            caption_op = caption_model(caption_glove_ip)
+            forward = mean(time_steps(lambda: image_model(image_ip), args.steps, args.warmup))
+            # Retrieval cost: the similarity matrix of all image-caption pairs of the batch
+            retrieval = mean(time_steps(lambda: compute_matchmap_similarity_matrix(image_op, caption_op, args.score_type),
+                                        args.steps, args.warmup))
+            recalls = calc_recalls(image_op, caption_op, args.score_type)
+
+        height, width = image_op.shape[2:]
+        name = args.model_path or 'untrained'
+        print("%-28s %-9s D %4d  grid %-12s T.H.W.D %8d  forward: %0.3fs  retrieval: %0.3fs  C_r10: %0.3f  I_r10: %0.3f" % (
+            name, args.cnn_model, args.embedding_dim, args.grid, caption_op.size(1) * height * width * args.embedding_dim,
+            forward, retrieval, recalls['C_r10'], recalls['I_r10']))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def ddp_run(rank, world_size, port, threads, args, queue):
+    """
+    Distributed train steps of one process over gloo, rank 0 puts the mean step time on the queue.
+    A single process trains without DDP, the baseline of the scaling efficiency.
+    """
+    torch.set_num_threads(threads)
+    distributed = init_distributed(init_method='tcp://127.0.0.1:%d' % port, rank=rank, world_size=world_size)
+    torch.manual_seed(rank)
+    image_model, caption_model = build_models(args)
+    image_ip, caption_glove_ip = load_batch(args)
+    if distributed:
+        image_model = torch.nn.parallel.DistributedDataParallel(image_model)
+        caption_model = torch.nn.parallel.DistributedDataParallel(caption_model)
+    times = time_steps(make_train_step(image_model, caption_model, image_ip, caption_glove_ip, args),
+                       args.steps, args.warmup)
+    if rank == 0:
+        queue.put(mean(times))
+    if distributed:
+        torch.distributed.destroy_process_group()
+
+
+def ddp_benchmark(args):
+    context = multiprocessing.get_context('spawn')
+    total_threads = args.threads if args.threads > 0 else torch.get_num_threads()
+    results = dict()
+    for world_size in args.world_sizes:
+        threads = max(total_threads // world_size, 1)
+        queue = context.Queue()
+        port = free_port()
+        processes = [context.Process(target=ddp_run, args=(rank, world_size, port, threads, args, queue))
+                     for rank in range(world_size)]
+        for process in processes:
+            process.start()
+        step_time = queue.get()
+        for process in processes:
+            process.join()
+
+        # Every step trains on batch_size samples per process
+        results[world_size] = world_size * args.batch_size / step_time
+        print("processes %2d  threads per process: %2d  step: %0.3fs  throughput: %0.1f samples/s" % (
+            world_size, threads, step_time, results[world_size]))
+
+    base_size = args.world_sizes[0]
+    print('---------------------------------------------------------')
+    print("Batch size %d per process, relative to %d processes" % (args.batch_size, base_size))
+    for world_size, throughput in results.items():
+        print("processes %2d  speedup: %0.2fx  scaling efficiency: %0.2f" % (
+            world_size, throughput / results[base_size],
+            throughput * base_size / (world_size * results[base_size])))
+
+
+commands = {'precision': precision_benchmark,
+            'memory': memory_benchmark,
+            'grid': grid_benchmark,
+            'ddp': ddp_benchmark}
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.command is None:
+        parser.print_help()
+    else:
+        if args.threads > 0:
+            torch.set_num_threads(args.threads)
+        print("Process %s, running on %s with %d threads" % (os.getpid(), os.name, torch.get_num_threads()))
+        commands[args.command](args)
@@ -1,6 +1,5 @@
 import os
 import json
-import nltk
 import argparse
 from tqdm import tqdm
 import sys
@@ -9,6 +8,8 @@ path_to_dataloader = '../../'
 sys.path.append(path_to_dataloader)
 
 from dataloader.flickr30k_entities_utils import *
+from dataloader.tokenizer import word_tokenize
+from dataloader.flickr_manifest import manifest_file, load_manifest
 
 parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
@@ -18,18 +19,21 @@ parser.add_argument('--folder', '--split', default='train', type=str,
 parser.add_argument('--make_file', '--mk', default='make', type=str,
                     metavar='m', help='whether to create json file out of data')
 
+parser.add_argument('--manifest', default='default', type=str,
+                    help='split manifest that lists the images of each split')
+
 
 def main(args):
-    sen_path = os.path.join('annotations_flickr', 'Sentences', args.folder)
-    ann_path = os.path.join('annotations_flickr', 'Annotations', args.folder)
+    sen_path = os.path.join('annotations_flickr', 'Sentences')
+    ann_path = os.path.join('annotations_flickr', 'Annotations')
+    parsed_path = os.path.join('annotations_flickr', 'parsed', args.manifest)
     data = {}  # This will be converted to json file later
     caption_id = 0
-    files = os.listdir(sen_path)
-    for i in tqdm(range(len(files))):
-        sen_file = files[i]
-        # print(os.path.join(sen_path, sen_file))
-        image_id = sen_file.replace('.txt', '.jpg')  # Keys in the dictionary.
-        ann_file = sen_file.replace('.txt', '.xml')  # Annotation file
+    image_ids = load_manifest(manifest_file('.', args.manifest), args.folder)
+    for i in tqdm(range(len(image_ids))):
+        sen_file = image_ids[i] + '.txt'
+        image_id = image_ids[i] + '.jpg'  # Keys in the dictionary.
+        ann_file = image_ids[i] + '.xml'  # Annotation file
 
         captions = get_sentence_data(os.path.join(sen_path, sen_file))
         annotations = get_annotations(os.path.join(ann_path, ann_file))
@@ -43,7 +47,7 @@ def main(args):
 
     print("Data dictionary created.")
     if args.make_file == 'make':
-        create_json(sen_path, data)
+        create_json(parsed_path, args.folder + '.json', data)
         print("JSON File created")
     else:
         print(json.dumps(data, indent=4))
@@ -104,13 +108,13 @@ def single_caption_parser(caption, image_file):
 def phrase_data(caption):
     # New dictionary created. Doesn't change original data.
     new_caption = {'sentence': caption['sentence'],
-                   'tok_sent': nltk.tokenize.word_tokenize(str(caption['sentence']).lower())}
+                   'tok_sent': word_tokenize(str(caption['sentence']).lower())}
     phrase_words = []  # List of words in phrase
     phrases = {}
     for phrase in caption['phrases']:
-        phrase_words.extend(nltk.tokenize.word_tokenize(str(phrase['phrase']).lower()))
-        phrases[phrase['phrase_id']] = nltk.tokenize.word_tokenize(str(phrase['phrase']).lower())
-        # phrase_list.append(nltk.tokenize.word_tokenize(str(phrase['phrase']).lower()))
+        tok_phrase = word_tokenize(str(phrase['phrase']).lower())
+        phrase_words.extend(tok_phrase)
+        phrases[phrase['phrase_id']] = list(tok_phrase)
 
     return new_caption, phrase_words, phrases
 
@@ -124,8 +128,9 @@ def dictionary_search(box_dict, query_phrase):
     return query_id
 
 
-def create_json(path, data):
-    full_path = './' + path + '/' + 'data.json'
+def create_json(path, filename, data):
+    os.makedirs(path, exist_ok=True)
+    full_path = os.path.join(path, filename)
     with open(full_path, 'w') as f:
         json.dump(data, f)
 
@@ -1,42 +1,42 @@
 import os
+import sys
+import argparse
 
+path_to_dataloader = '../../'
+sys.path.append(path_to_dataloader)
 
-def move_to_dest(token, f_type, fold):
-    mod_token = token + file_types[f_type][0]
-    f_name = os.path.join(file_types[f_type][1], mod_token)
-    new_fname = os.path.join(file_types[f_type][1], fold, mod_token)
-    os.rename(f_name, new_fname)
+from dataloader.flickr_manifest import manifest_file, write_manifest
 
+parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
-if __name__ == '__main__':
+parser.add_argument('--name', default='default', type=str,
+                    help='name of the split definition, several manifests can coexist')
 
-    fold_files = {"train": "train.txt",
-                  "val": "val.txt",
-                  "test": "test.txt"}
+parser.add_argument('--split_dir', default='.', type=str,
+                    help='folder holding train.txt, val.txt and test.txt')
 
-    img_folder = 'flickr30k-images'
-    sent_folder = os.path.join('annotations_flickr', 'Sentences')
-    ann_folder = os.path.join('annotations_flickr', 'Annotations')
 
-    file_types = {"img": ['.jpg', img_folder],
-                  "sent": ['.txt', sent_folder],
-                  "ann": ['.xml', ann_folder]}
+def read_fold(fold_file):
+    """
+    Image ids listed in a split file, one per line
+    """
+    with open(fold_file, encoding='utf-8', mode='r') as f:
+        return [line.strip() for line in f if line.strip()]
 
-    for fold in fold_files:
 
-        os.makedirs(os.path.join(img_folder, fold), exist_ok=True)
-        os.makedirs(os.path.join(sent_folder, fold), exist_ok=True)
-        os.makedirs(os.path.join(ann_folder, fold), exist_ok=True)
+if __name__ == '__main__':
+    args = parser.parse_args()
 
-        print("Now doing fold: ", fold)
-        with open(fold_files[fold], encoding='utf-8', mode='r') as f:
-            count = 0
-            for file_name in f:
-                if file_name[-1] == '\n':
-                    move_to_dest(file_name[:-1], "img", fold)
-                    move_to_dest(file_name[:-1], "sent", fold)
-                    move_to_dest(file_name[:-1], "ann", fold)
+    fold_files = {"train": "train.txt",
+                  "val": "val.txt",
+                  "test": "test.txt"}
 
-                    count += 1
+    folds = dict()
+    for fold in fold_files:
+        folds[fold] = read_fold(os.path.join(args.split_dir, fold_files[fold]))
+        print("Done with fold : {fold},\n number of files: {count}".format(fold=fold, count=len(folds[fold])))
 
-            print("Done with fold : {fold},\n number of files: {count}".format(fold=fold, count=count))
+    # Images, sentences and annotations are not moved, loaders resolve folds through the manifest
+    filename = manifest_file('.', args.name)
+    write_manifest(filename, folds)
+    print("Split manifest written to ", filename)
@@ -1,8 +1,39 @@
 import numpy as np
 import collections
+import argparse
 import json
 import os
+import sys
 
+path_to_dataloader = '../../'
+sys.path.append(path_to_dataloader)
+
+from dataloader.phrase_columns import PhraseColumns, load_phrase_data
+from dataloader.tokenizer import tokenize_batch
+
+parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+parser.add_argument('--dataset', default='flickr', type=str, choices=['flickr', 'coco', 'genome'],
+                    help='dataset whose vocabulary is generated')
+
+parser.add_argument('--ann_file', default='', type=str,
+                    help='annotation file to build the vocabulary from (default depends on dataset)')
+
+parser.add_argument('--embed_file', default='glove.6B.300d.txt', type=str,
+                    help='GloVe text file')
+
+parser.add_argument('--output', default='', type=str,
+                    help='binary .npz embedding matrix to write (default depends on dataset)')
+
+parser.add_argument('--chunk_size', default=20000, type=int,
+                    help='number of GloVe lines parsed per vectorized chunk')
+
+parser.add_argument('--remove_inputs', action='store_true',
+                    help='delete the annotation and GloVe files once the vocabulary is written')
+
+default_files = {'flickr': ['results_20130124.token', 'vocab_glove_flickr.npz'],
+                 'coco': ['../mscoco/annotations/captions_train2014.json', '../mscoco/vocab_glove.npz'],
+                 'genome': ['../visual_genome/coco_phrase_data', '../visual_genome/vocab_glove.npz']}
 
 
 def random_glove_generator(emb_mean, emb_stddev):
@@ -29,6 +60,40 @@ def gen_annotations(annotation_file):
 
     return anns
 
+
+def gen_annotations_coco(annotation_file):
+    """
+    Collect tokenized COCO captions per image, in the same layout as gen_annotations
+    """
+    print("Loading Annotations")
+    coco_data = json.load(open(annotation_file, encoding='utf-8', mode='r'))
+    all_tokens = tokenize_batch(str(item['caption']).lower() for item in coco_data['annotations'])
+
+    anns = collections.defaultdict(list)
+    for item, tokens in zip(coco_data['annotations'], all_tokens):
+        anns[item['image_id']].append(' '.join(tokens))
+
+    return anns
+
+
+def gen_annotations_genome(annotation_file):
+    """
+    Collect tokenized region phrases per image, in the same layout as gen_annotations
+    """
+    print("Loading Annotations")
+    phrase_data = load_phrase_data(annotation_file)
+
+    anns = collections.defaultdict(list)
+    if isinstance(phrase_data, PhraseColumns):
+        for image_id, tok_phrase in zip(phrase_data.image_id.tolist(), phrase_data.tok_phrase.tolist()):
+            anns[image_id].append(tok_phrase)
+    else:
+        for phrase in phrase_data.values():
+            anns[phrase['image_id']].append(' '.join(phrase['tok_phrase']))
+
+    return anns
+
+
 def gen_vocabulary(annotations):
 
     all_words = []
@@ -45,51 +110,126 @@ def gen_vocabulary(annotations):
     return vocabulary
 
 
-def vocab_glove_list(embed_file):
-    embedding_file = open(embed_file, encoding='utf8', mode='r')
+def merge_moments(count, mean, m2, chunk):
+    """
+    Fold a chunk of embeddings into running moments (Welford/Chan parallel update)
+    :param count: number of embeddings seen so far
+    :param mean: running mean of the embeddings seen so far
+    :param m2: running sum of squared deviations from the mean
+    :param chunk: 2D numpy array of new embeddings
+    :return: updated count, mean and m2
+    """
+    chunk = chunk.astype(np.float64)
+    chunk_count = chunk.shape[0]
+    chunk_mean = chunk.mean(axis=0)
+    chunk_m2 = ((chunk - chunk_mean) ** 2).sum(axis=0)
 
-    glove = {}
-    for line in embedding_file:
-        splitted = line.split()
-        word = splitted[0]
-        emb = np.array([float(val) for val in splitted[1:]])
-        glove[word] = emb
+    if count == 0:
+        return chunk_count, chunk_mean, chunk_m2
 
-    print("Glove Dictionary successfully built!")
-    return glove
+    total = count + chunk_count
+    delta = chunk_mean - mean
+    mean = mean + delta * chunk_count / total
+    m2 = m2 + chunk_m2 + delta ** 2 * count * chunk_count / total
 
+    return total, mean, m2
 
-def create_glove_for_vocab(vocabulary, embed_file):
-    glove_dict = vocab_glove_list(embed_file)
 
-    all_embeddings = np.stack(glove_dict.values())
-    emb_mean = all_embeddings.mean(axis=0)
-    emb_stddev = all_embeddings.std(axis=0)
+def parse_glove_chunk(lines):
+    """
+    Parse a list of GloVe lines with a single vectorized numpy call
+    :param lines: raw lines of the GloVe text file
+    :return: list of words and a 2D float32 array with one embedding per row
+    """
+    words = list()
+    values = list()
+    for line in lines:
+        word, vector = line.rstrip().split(' ', 1)
+        words.append(word)
+        values.append(vector)
 
-    vocab2glove = {}
-    for word in vocabulary:
-        if word not in glove_dict.keys():
-            vocab2glove[word] = random_glove_generator(emb_mean, emb_stddev).tolist()
-        else:
-            vocab2glove[word] = glove_dict[word].tolist()
-    return vocab2glove
+    embeddings = np.fromstring(' '.join(values), dtype=np.float32, sep=' ')
+    return words, embeddings.reshape(len(words), -1)
 
 
-if __name__ == "__main__":
-    ann_file = 'results_20130124.token'
-    embed_file = 'glove.6B.300d.txt'
-    vocab_glove_file = 'vocab_glove_flickr.json'
+def vocab_glove_list(embed_file, vocabulary, chunk_size=20000):
+    """
+    Stream the GloVe file once, keeping only vocabulary words
+    :param embed_file: GloVe text file
+    :param vocabulary: list of words to keep
+    :param chunk_size: number of lines parsed at a time
+    :return: vocabulary embedding matrix, boolean mask of words found in GloVe,
+    and mean and std dev over all GloVe embeddings
+    """
+    vocab_index = {word: index for index, word in enumerate(vocabulary)}
+    matrix = None
+    found = np.zeros(len(vocabulary), dtype=bool)
+    count, emb_mean, emb_m2 = 0, None, None
+
+    def consume(lines):
+        nonlocal matrix, count, emb_mean, emb_m2
+        words, embeddings = parse_glove_chunk(lines)
+        if matrix is None:
+            matrix = np.zeros((len(vocabulary), embeddings.shape[1]), dtype=np.float32)
+        count, emb_mean, emb_m2 = merge_moments(count, emb_mean, emb_m2, embeddings)
+        for row, word in enumerate(words):
+            index = vocab_index.get(word)
+            if index is not None:
+                matrix[index] = embeddings[row]
+                found[index] = True
+
+    with open(embed_file, encoding='utf8', mode='r') as embedding_file:
+        lines = list()
+        for line in embedding_file:
+            lines.append(line)
+            if len(lines) == chunk_size:
+                consume(lines)
+                lines = list()
+        if lines:
+            consume(lines)
+
+    print("Glove embeddings successfully streamed!")
+    return matrix, found, emb_mean, np.sqrt(emb_m2 / count)
+
+
+def create_glove_for_vocab(vocabulary, embed_file, chunk_size=20000):
+    matrix, found, emb_mean, emb_stddev = vocab_glove_list(embed_file, vocabulary, chunk_size)
+
+    for index in np.where(~found)[0]:
+        matrix[index] = random_glove_generator(emb_mean, emb_stddev)
+    print('Words not in GloVe: ', int((~found).sum()))
+
+    return matrix
+
+
+def save_vocab_glove(vocab_glove_file, vocabulary, matrix):
+    """
+    Write the vocabulary and its embedding matrix as a single binary file
+    """
+    np.savez(vocab_glove_file, words=np.array(vocabulary), embeddings=matrix)
 
-    annotations = gen_annotations(ann_file)
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    ann_file = args.ann_file or default_files[args.dataset][0]
+    embed_file = args.embed_file
+    vocab_glove_file = args.output or default_files[args.dataset][1]
+
+    if args.dataset == 'coco':
+        annotations = gen_annotations_coco(ann_file)
+    elif args.dataset == 'genome':
+        annotations = gen_annotations_genome(ann_file)
+    else:
+        annotations = gen_annotations(ann_file)
     vocabulary = gen_vocabulary(annotations)
 
-    vocab_embedding = create_glove_for_vocab(vocabulary, embed_file)
+    vocab_embedding = create_glove_for_vocab(vocabulary, embed_file, args.chunk_size)
 
-    print('Generating JSON file!')
-    with open(vocab_glove_file, "w") as fp:
-        json.dump(vocab_embedding, fp)
-    print('Generated JSON file!')
+    print('Generating embedding file!')
+    save_vocab_glove(vocab_glove_file, vocabulary, vocab_embedding)
+    print('Generated embedding file!')
 
-    os.remove(ann_file)
-    os.remove(embed_file)
-    print('Removed intermediate files!')
+    if args.remove_inputs:
+        os.remove(ann_file)
+        os.remove(embed_file)
+        print('Removed intermediate files!')
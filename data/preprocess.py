@@ -0,0 +1,242 @@
+"""Run the preprocessing scripts as a pipeline of fingerprinted, cached stages."""
+import os
+import sys
+import json
+import hashlib
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+parser.add_argument('--stages', nargs='*', default=[],
+                    help='stages to run, together with the stages they depend on (default: all)')
+
+parser.add_argument('--jobs', default=4, type=int,
+                    help='number of independent stages run in parallel')
+
+parser.add_argument('--force', action='store_true',
+                    help='rerun stages even if their inputs did not change')
+
+parser.add_argument('--dry_run', action='store_true',
+                    help='only print which stages are up to date')
+
+data_root = os.path.dirname(os.path.abspath(__file__))
+repo_root = os.path.dirname(data_root)
+state_file = os.path.join(data_root, '.preprocess_state.json')
+hash_cache_file = os.path.join(data_root, '.preprocess_hashes.json')
+log_folder = os.path.join(data_root, '.preprocess_logs')
+
+flickr = os.path.join(data_root, 'flickr_30kentities')
+genome = os.path.join(data_root, 'visual_genome')
+mscoco = os.path.join(data_root, 'mscoco')
+glove_file = os.path.join(flickr, 'glove.6B.300d.txt')
+source_files = [os.path.join(repo_root, 'dataloader', 'tokenizer.py'),
+                os.path.join(repo_root, 'dataloader', 'phrase_columns.py'),
+                os.path.join(repo_root, 'dataloader', 'flickr_manifest.py')]
+
+
+class Stage(object):
+    """
+    A preprocessing script with the files it reads and writes
+    :param name: unique stage name
+    :param cwd: folder the script is run from
+    :param command: script and arguments, run with the current python interpreter
+    :param inputs: files or folders whose content decides if the stage is up to date
+    :param outputs: files or folders written by the stage
+    :param deps: names of the stages that have to run first
+    """
+
+    def __init__(self, name, cwd, command, inputs, outputs, deps=()):
+        self.name = name
+        self.cwd = cwd
+        self.command = [sys.executable] + command
+        self.inputs = [os.path.join(cwd, command[0])] + inputs
+        self.outputs = outputs
+        self.deps = list(deps)
+
+
+def flickr_stages():
+    sentences = os.path.join(flickr, 'annotations_flickr', 'Sentences')
+    annotations = os.path.join(flickr, 'annotations_flickr', 'Annotations')
+    manifest = os.path.join(flickr, 'manifests', 'default.npz')
+    stages = [Stage('flickr_manifest', flickr, ['flickr_data_shuffler.py', '--name', 'default'],
+                    inputs=[os.path.join(flickr, fold + '.txt') for fold in ['train', 'val', 'test']],
+                    outputs=[manifest])]
+
+    for fold in ['train', 'val', 'test']:
+        stages.append(Stage('flickr_parse_' + fold, flickr,
+                            ['flickr_caption_parser.py', '--split', fold, '--manifest', 'default'],
+                            inputs=[manifest, sentences, annotations,
+                                    os.path.join(repo_root, 'dataloader', 'flickr30k_entities_utils.py')] + source_files,
+                            outputs=[os.path.join(flickr, 'annotations_flickr', 'parsed', 'default', fold + '.json')],
+                            deps=['flickr_manifest']))
+
+    stages.append(Stage('flickr_vocab', flickr, ['flickr_vocab_gen.py', '--dataset', 'flickr'],
+                        inputs=[os.path.join(flickr, 'results_20130124.token'), glove_file],
+                        outputs=[os.path.join(flickr, 'vocab_glove_flickr.npz')]))
+    return stages
+
+
+def genome_stages():
+    phrase_table = os.path.join(genome, 'coco_phrase_data')
+    return [Stage('genome_parse', genome, ['genome_data_parser.py', '--make_file', 'True'],
+                  inputs=[os.path.join(genome, 'image_data.json'),
+                          os.path.join(genome, 'region_descriptions.json')] + source_files,
+                  outputs=[os.path.join(genome, 'coco_image_data.json'),
+                           os.path.join(genome, 'coco_image_data.npz'), phrase_table]),
+            Stage('genome_vocab', flickr, ['flickr_vocab_gen.py', '--dataset', 'genome'],
+                  inputs=[phrase_table, glove_file] + source_files,
+                  outputs=[os.path.join(genome, 'vocab_glove.npz')],
+                  deps=['genome_parse'])]
+
+
+def coco_stages():
+    return [Stage('coco_vocab', flickr, ['flickr_vocab_gen.py', '--dataset', 'coco'],
+                  inputs=[os.path.join(mscoco, 'annotations', 'captions_train2014.json'), glove_file] + source_files,
+                  outputs=[os.path.join(mscoco, 'vocab_glove.npz')])]
+
+
+def load_json(filename):
+    if not os.path.exists(filename):
+        return dict()
+    return json.load(open(filename, encoding='utf-8', mode='r'))
+
+
+def save_json(filename, data):
+    tmp_file = filename + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_file, filename)
+
+
+def file_digest(path, hash_cache):
+    """
+    Content hash of a file. Hashes are cached by size and modification time so
+    large unchanged inputs (GloVe, region descriptions) are only read once.
+    """
+    stat = os.stat(path)
+    cached = hash_cache.get(path)
+    if cached is not None and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+        return cached[2]
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    hash_cache[path] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+    return hash_cache[path][2]
+
+
+def iter_files(path, excluded):
+    if os.path.isfile(path):
+        yield path
+        return
+    for root, folders, files in os.walk(path):
+        folders.sort()
+        for name in sorted(files):
+            file_path = os.path.join(root, name)
+            if file_path not in excluded:
+                yield file_path
+
+
+def fingerprint(stage, hash_cache):
+    """
+    Fingerprint of a stage: its command and the content of all of its inputs.
+    Outputs written inside an input folder are not part of the fingerprint.
+    """
+    excluded = set(stage.outputs)
+    digest = hashlib.sha256(json.dumps(stage.command[1:]).encode('utf-8'))
+    for path in stage.inputs:
+        for file_path in iter_files(path, excluded):
+            digest.update(os.path.relpath(file_path, data_root).encode('utf-8'))
+            digest.update(file_digest(file_path, hash_cache).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def run_stage(stage):
+    os.makedirs(log_folder, exist_ok=True)
+    with open(os.path.join(log_folder, stage.name + '.log'), 'w') as log:
+        result = subprocess.run(stage.command, cwd=stage.cwd, stdout=log, stderr=subprocess.STDOUT)
+    return result.returncode
+
+
+def select_stages(stages, names):
+    """
+    Stages named in names and, transitively, the stages they depend on
+    """
+    by_name = {stage.name: stage for stage in stages}
+    selected = set()
+    pending = list(names) if names else list(by_name)
+    while pending:
+        name = pending.pop()
+        assert name in by_name, "Unknown stage '%s'" % name
+        if name not in selected:
+            selected.add(name)
+            pending.extend(by_name[name].deps)
+    return [stage for stage in stages if stage.name in selected]
+
+
+def main(args):
+    stages = select_stages(flickr_stages() + genome_stages() + coco_stages(), args.stages)
+    state = load_json(state_file)
+    hash_cache = load_json(hash_cache_file)
+
+    done = set()
+    failed = set()
+    blocked = set()
+    running = dict()
+
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        while True:
+            for stage in stages:
+                if stage.name in done | failed | blocked or stage in running.values():
+                    continue
+                if any(dep in failed | blocked for dep in stage.deps):
+                    print("%-16s skipped, a dependency did not run" % stage.name)
+                    blocked.add(stage.name)
+                    continue
+                if not all(dep in done for dep in stage.deps):
+                    continue
+
+                missing = [path for path in stage.inputs if not os.path.exists(path)]
+                if missing:
+                    print("%-16s skipped, missing %s" % (stage.name, os.path.relpath(missing[0], data_root)))
+                    blocked.add(stage.name)
+                    continue
+
+                stage.fingerprint = fingerprint(stage, hash_cache)
+                up_to_date = (state.get(stage.name) == stage.fingerprint and
+                              all(os.path.exists(path) for path in stage.outputs))
+                if up_to_date and not args.force:
+                    print("%-16s up to date" % stage.name)
+                    done.add(stage.name)
+                elif args.dry_run:
+                    print("%-16s would run" % stage.name)
+                    done.add(stage.name)
+                else:
+                    print("%-16s running" % stage.name)
+                    running[executor.submit(run_stage, stage)] = stage
+
+            save_json(hash_cache_file, hash_cache)
+            if not running:
+                break
+
+            finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage = running.pop(future)
+                if future.result() == 0:
+                    print("%-16s finished" % stage.name)
+                    state[stage.name] = stage.fingerprint
+                    save_json(state_file, state)
+                    done.add(stage.name)
+                else:
+                    print("%-16s failed, see %s" % (stage.name, os.path.join(log_folder, stage.name + '.log')))
+                    failed.add(stage.name)
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    sys.exit(main(args))
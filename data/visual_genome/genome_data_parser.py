@@ -1,22 +1,78 @@
+import os
+import sys
 import json
 import argparse
-import nltk
+from collections import deque
+from multiprocessing import Pool
+
+path_to_dataloader = '../../'
+sys.path.append(path_to_dataloader)
+
+from dataloader.phrase_columns import write_phrase_chunk, write_phrase_meta, write_image_index
+from dataloader.tokenizer import word_tokenize
 
 parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
 parser.add_argument('--make_file', '--mk', default=False, type=bool,
                     metavar='m', help='whether to create json file out of data')
 
+parser.add_argument('--workers', default=os.cpu_count(), type=int,
+                    help='number of processes used to tokenize phrases')
+
+parser.add_argument('--chunk_size', default=50000, type=int,
+                    help='number of phrases per tokenization task and per output chunk')
+
+parser.add_argument('--output', default='coco_phrase_data', type=str,
+                    help='folder of the chunked columnar phrase table')
+
+
+def iter_json_array(filename, encoding='utf-8', buffer_size=1 << 20):
+	"""
+	Incrementally parse a file holding a top-level JSON array of objects
+	:param filename: path to the JSON file
+	:param buffer_size: number of characters read at a time
+	:return: generator over the elements of the array
+	"""
+	decoder = json.JSONDecoder()
+	with open(filename, encoding=encoding, mode='r') as f:
+		buffer = f.read(buffer_size).lstrip()
+		assert buffer[:1] == '[', "Expected a top-level JSON array in %s" % filename
+		position = 1
+		eof = False
+		while True:
+			while position < len(buffer) and buffer[position] in ' \t\r\n,':
+				position += 1
+
+			if position < len(buffer) and buffer[position] == ']':
+				return
+
+			try:
+				element, end = decoder.raw_decode(buffer, position)
+			except json.JSONDecodeError:
+				if eof:
+					raise
+				# Element is cut by the end of the buffer, read more of the file
+				chunk = f.read(buffer_size)
+				eof = not chunk
+				buffer = buffer[position:] + chunk
+				position = 0
+				continue
+
+			yield element
+			position = end
+			if position > buffer_size:
+				buffer = buffer[position:]
+				position = 0
+
 
 def gen_image_json(filename, encoding='utf-8', mode='r'):
-	image_data = json.load(open(filename, encoding=encoding, mode=mode))
 	print("Separating images from COCO and generating subset metadata...")
-	coco_images = [item for item in image_data if item['coco_id'] is not None]
 	new_image_data = dict()
-	for image in coco_images:
-		new_image_data[image['image_id']] = {'image_id': image['image_id'],
-											'height': image['height'],
-											'width': image['width']}
+	for image in iter_json_array(filename, encoding=encoding):
+		if image['coco_id'] is not None:
+			new_image_data[image['image_id']] = {'image_id': image['image_id'],
+												'height': image['height'],
+												'width': image['width']}
 
 	return new_image_data
 
@@ -35,53 +91,106 @@ def create_boxes(coords, size):
 	return box_coords
 
 
-def gen_region_json(filename, image_ids, encoding='utf-8', mode='r'):
-	region_data = json.load(open(filename, encoding=encoding, mode=mode))
-	new_phrase_data = dict()
-	phrase_counter = 0
-	print('Generating data for phrases describing regions in the COCO images...')
-	for image in region_data:
+def iter_region_phrases(filename, image_ids, encoding='utf-8'):
+	"""
+	Stream the regions of the images in image_ids
+	:param image_ids: set of image ids to keep
+	:return: generator of untokenized phrase rows
+	"""
+	for image in iter_json_array(filename, encoding=encoding):
 		if image['id'] in image_ids:
 			for phrase in image['regions']:
-				coords = [phrase['x'], phrase['y'], phrase['width'], phrase['height']]
-				new_phrase_data[phrase_counter] = {'phrase': phrase['phrase'],
-				'tok_phrase': nltk.tokenize.word_tokenize(str(phrase['phrase']).lower()),
-				'bbox': coords,
+				yield {'phrase': phrase['phrase'],
+				'bbox': [phrase['x'], phrase['y'], phrase['width'], phrase['height']],
 				'image_id': phrase['image_id']}
+
+
+def tokenize_rows(rows):
+	"""
+	Tokenize the phrases of a chunk of rows. Runs in the worker processes.
+	"""
+	for row in rows:
+		row['tok_phrase'] = word_tokenize(str(row['phrase']).lower())
+	return rows
+
+
+def iter_chunks(rows, chunk_size):
+	chunk = list()
+	for row in rows:
+		chunk.append(row)
+		if len(chunk) == chunk_size:
+			yield chunk
+			chunk = list()
+	if chunk:
+		yield chunk
+
+
+def gen_region_chunks(filename, image_ids, workers, chunk_size, encoding='utf-8'):
+	"""
+	Tokenize the phrases of the COCO images in a process pool
+	:param image_ids: set of image ids to keep
+	:param workers: number of tokenizer processes
+	:param chunk_size: number of phrases per task
+	:return: generator of tokenized chunks, in file order, with sequential ann_ids
+	"""
+	print('Generating data for phrases describing regions in the COCO images...')
+	phrase_counter = 0
+	with Pool(processes=workers) as pool:
+		pending = deque()
+		for chunk in iter_chunks(iter_region_phrases(filename, image_ids, encoding), chunk_size):
+			for row in chunk:
+				row['ann_id'] = phrase_counter
 				phrase_counter += 1
-			else:
-				continue 
+			pending.append(pool.apply_async(tokenize_rows, (chunk,)))
+			# Bound the number of chunks held in memory
+			if len(pending) >= 2 * workers:
+				yield pending.popleft().get()
+
+		while pending:
+			yield pending.popleft().get()
+
+
+def gen_region_json(filename, image_ids, encoding='utf-8', mode='r'):
+	new_phrase_data = dict()
+	for chunk in gen_region_chunks(filename, set(image_ids), 1, 1000, encoding):
+		for row in chunk:
+			new_phrase_data[row.pop('ann_id')] = row
 
 	return new_phrase_data
 
 
+def create_phrase_table(folder, chunks):
+	"""
+	Write tokenized chunks to a chunked columnar phrase table
+	"""
+	os.makedirs(folder, exist_ok=True)
+	chunk_names = list()
+	n_rows = 0
+	for chunk in chunks:
+		chunk_names.append(write_phrase_chunk(folder, len(chunk_names), chunk))
+		n_rows += len(chunk)
+		print("Wrote %d phrases" % n_rows)
+	write_phrase_meta(folder, chunk_names, n_rows)
+
+
 if __name__ == '__main__':
 	args = parser.parse_args()
 	if args.make_file:
 		print("Going to save files!")
 	image_data = gen_image_json('image_data.json')
-	image_ids = list(image_data.keys())
-	phrase_data = gen_region_json('region_descriptions.json', image_ids)
+	image_ids = set(image_data.keys())
+	phrase_chunks = gen_region_chunks('region_descriptions.json', image_ids,
+									  args.workers, args.chunk_size)
 	if args.make_file:
-		print("Creating new JSON files!")
+		print("Creating new files!")
 		with open('coco_image_data.json', 'w') as f:
 			json.dump(image_data, f)
 			print("Created image json file!")
-		with open('coco_phrase_data.json', 'w') as f:
-			json.dump(phrase_data, f)
-			print("Created phrase region json file!")
+		write_image_index('coco_image_data.npz', image_data.values())
+		print("Created image index!")
+		create_phrase_table(args.output, phrase_chunks)
+		print("Created phrase region table!")
 
 	else:
 		print("Printing section of phrase data!")
-		print(list(phrase_data.items())[:5])
-
-
-
-
-
-
-
-
-
-
-
+		print(next(phrase_chunks)[:5])
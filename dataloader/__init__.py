@@ -1 +1,2 @@
-from .get_loader import *
\ No newline at end of file
+from .get_loader import *
+from .samplers import *
\ No newline at end of file
@@ -1,5 +1,4 @@
 """Create the CoCoDataset and a DataLoader for it."""
-import nltk
 import os
 import torch
 import torch.utils.data as data
@@ -11,6 +10,9 @@ import random
 import json
 from collections import defaultdict
 
+from .glove_utils import load_vocab_glove
+from .tokenizer import word_tokenize, tokenize_batch
+
 
 class COCODataset(data.Dataset):
 
@@ -22,7 +24,7 @@ class COCODataset(data.Dataset):
 		self.mode = mode
 
 		self.img_folder = img_folder
-		self.vocab_glove = json.load(open(vocab_glove_file, encoding='utf-8',mode="r"))
+		self.vocab_glove = load_vocab_glove(vocab_glove_file)
 
 		self.transform = transform
 		self.batch_size = batch_size
@@ -37,9 +39,8 @@ class COCODataset(data.Dataset):
 			self.coco = COCO(annotations_file)
 			self.ids = list(self.coco.anns.keys())  # Caption IDs
 
-			all_tokens = [nltk.tokenize.word_tokenize(
-				str(self.coco.anns[self.ids[index]]["caption"]).lower()) 
-				for index in tqdm(np.arange(len(self.ids)))]
+			all_tokens = tokenize_batch(str(self.coco.anns[self.ids[index]]["caption"]).lower()
+										for index in tqdm(np.arange(len(self.ids))))
 			self.caption_lengths = [len(token) for token in all_tokens]
 
 		else:
@@ -60,7 +61,7 @@ class COCODataset(data.Dataset):
 		image = self.transform(image)
 
 		# Convert caption to tensor of word ids.
-		tokens = nltk.tokenize.word_tokenize(str(caption).lower())
+		tokens = word_tokenize(str(caption).lower())
 		caption = list()
 		caption.append(self.start_word)
 		caption.extend(tokens)
@@ -1,5 +1,4 @@
 """Create the FlickrDataset and a DataLoader for it."""
-import nltk
 import os
 import torch
 import torch.utils.data as data
@@ -13,6 +12,7 @@ from statistics import mean
 from collections import defaultdict
 
 from .flickr30k_entities_utils import *
+from .glove_utils import load_vocab_glove
 
 class FlickrDataset(data.Dataset):
 
@@ -31,7 +31,7 @@ class FlickrDataset(data.Dataset):
         self.parse_mode = parse_mode  # Parsing is phrases or single words
         self.pad_caption = pad_caption  # Sets a limit on caption length
         self.pad_limit = pad_limit  # Limit for length of caption
-        self.vocab_glove = json.load(open(vocab_glove_file, 'r'))
+        self.vocab_glove = load_vocab_glove(vocab_glove_file)
         # Assigning proper data based on fold
         self.image_folder = image_root
         self.sentences_folder = sentences_root
@@ -0,0 +1,47 @@
+import os
+import numpy as np
+
+
+def manifest_file(flickr_root, manifest):
+    """
+    Path of a split manifest
+    :param flickr_root: data/flickr_30kentities folder
+    :param manifest: name of the split definition
+    """
+    return os.path.join(flickr_root, 'manifests', manifest + '.npz')
+
+
+def write_manifest(filename, folds):
+    """
+    Store split membership as one integer array of image ids per fold
+    :param filename: manifest file to write
+    :param folds: dictionary mapping a fold name to a list of image ids
+    """
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    np.savez(filename, **{fold: np.array([int(image_id) for image_id in ids], dtype=np.int64)
+                          for fold, ids in folds.items()})
+
+
+def load_manifest(filename, fold):
+    """
+    Image ids of one fold of a manifest
+    :return: list of image ids as strings, in the same form as the dataset file names
+    """
+    assert os.path.exists(filename), "No split manifest at '%s'. Run flickr_data_shuffler.py first." % filename
+    return [str(image_id) for image_id in np.load(filename)[fold].tolist()]
+
+
+def flickr_paths(mode, flickr_loc='', manifest='default'):
+    """
+    Resolve the data of a fold through its split manifest. Images, sentences
+    and annotations stay in the flat folders of the download, only the parsed
+    caption file is specific to a manifest and fold.
+    :return: dictionary with the image, sentences and annotations folders and the parsed caption file
+    """
+    flickr_root = os.path.join(flickr_loc, 'data', 'flickr_30kentities')
+    annotations_root = os.path.join(flickr_root, 'annotations_flickr')
+    return {'manifest': manifest_file(flickr_root, manifest),
+            'images': os.path.join(flickr_root, 'flickr30k-images'),
+            'sentences': os.path.join(annotations_root, 'Sentences'),
+            'annotations': os.path.join(annotations_root, 'Annotations'),
+            'parsed': os.path.join(annotations_root, 'parsed', manifest, mode + '.json')}
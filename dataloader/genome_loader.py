@@ -1,4 +1,3 @@
-import nltk
 import os
 import torch
 import torch.utils.data as data
@@ -8,6 +7,9 @@ from tqdm import tqdm
 import random
 import json
 
+from .glove_utils import load_vocab_glove
+from .phrase_columns import PhraseColumns, load_phrase_data
+
 
 class VisualGenome(data.Dataset):
 
@@ -18,7 +20,7 @@ class VisualGenome(data.Dataset):
 
         self.mode = mode
         self.img_folder = img_folder
-        self.vocab_glove = json.load(open(vocab_glove_file, encoding='utf-8', mode='r'))
+        self.vocab_glove = load_vocab_glove(vocab_glove_file)
         self.transform = transform
         self.batch_size = batch_size
         self.pad_caption = pad_caption
@@ -28,13 +30,16 @@ class VisualGenome(data.Dataset):
         self.unk_word = unk_word
 
 		# All Phrase descriptions for COCO Images
-        self.annotations = json.load(open(annotations_file, encoding='utf-8', mode='r'))
+        self.annotations = load_phrase_data(annotations_file)
 		# All phrase IDs
         self.ids = list(self.annotations.keys())
-        all_tokenized_captions = list()
-        for caption_id in self.annotations:
-            all_tokenized_captions.append(self.annotations[caption_id]['tok_phrase'])
-        self.caption_lengths = [len(caption) for caption in all_tokenized_captions]
+        if isinstance(self.annotations, PhraseColumns):
+            self.caption_lengths = self.annotations.tok_length.tolist()
+        else:
+            all_tokenized_captions = list()
+            for caption_id in self.annotations:
+                all_tokenized_captions.append(self.annotations[caption_id]['tok_phrase'])
+            self.caption_lengths = [len(caption) for caption in all_tokenized_captions]
 
     def __getitem__(self, index):
 
@@ -4,6 +4,7 @@ import torch.utils.data as data
 from .coco_loader import COCODataset
 from .flickr_loader import FlickrDataset
 from .genome_loader import VisualGenome
+from .flickr_manifest import flickr_paths
 
 def get_loader_coco(transform,
                     mode="train",
@@ -13,7 +14,7 @@ def get_loader_coco(transform,
                     unk_word="<unk>",
                     num_workers=4,
                     cocoapi_loc="",
-                    vocab_glove_file="data/mscoco/vocab_glove.json",
+                    vocab_glove_file="data/mscoco/vocab_glove.npz",
                     test_size=1000,
                     pad_caption=True):
     """Return the data loader.
@@ -29,7 +30,7 @@ def get_loader_coco(transform,
         vocab_from_file: If False, create vocab from scratch & override any
                          existing vocab_file. If True, load vocab from
                          existing vocab_file, if it exists.
-        vocab_glove_file: This JSON file contains the Glove embeddings for each
+        vocab_glove_file: This .npz file contains the Glove embeddings for each
                     word in the vocabulary.
         num_workers: Number of subprocesses to use for data loading
         cocoapi_loc: The location of the folder containing the COCO API:
@@ -91,34 +92,27 @@ def get_loader_flickr(transform,
                       unk_word="<unk>",
                       num_workers=1,
                       flickr_loc="",
-                      vocab_glove_file="data/flickr_30kentities/vocab_glove_flickr.json",
+                      vocab_glove_file="data/flickr_30kentities/vocab_glove_flickr.npz",
                       pad_caption=True,
                       pad_limit=20,
-                      parse_mode='phrase'):
-    image_root = os.path.join(flickr_loc, 'data', 'flickr_30kentities', 'flickr30k-images')
-    sentences_root = os.path.join(flickr_loc, 'data', 'flickr_30kentities', 'annotations_flickr', 'Sentences')
-    annotations_root = os.path.join(flickr_loc, 'data', 'flickr_30kentities', 'annotations_flickr', 'Annotations')
-
+                      parse_mode='phrase',
+                      manifest='default'):
+    """Return the data loader of a Flickr30k Entities fold.
+    Parameters:
+        mode: One of "train", "val" or "test".
+        manifest: Name of the split manifest written by flickr_data_shuffler.py.
+                  Split membership comes from the manifest, images and annotations
+                  are read from the flat folders of the download.
+    """
     assert mode in ["train", "val", "test"], "mode must be one of 'train', 'val' or 'test'."
 
-    # Based on mode (train, val, test), obtain img_folder and annotations_file
-    if mode == "train":
-        img_folder = os.path.join(flickr_loc, image_root, 'train')
-        annotations_folder = os.path.join(flickr_loc, annotations_root, 'train')
-        sentences_folder = os.path.join(flickr_loc, sentences_root, 'train')
-        sentences_file = os.path.join(sentences_folder, 'data.json')
-
-    if mode == "val":
-        img_folder = os.path.join(flickr_loc, image_root, 'val')
-        annotations_folder = os.path.join(flickr_loc, annotations_root, 'val')
-        sentences_folder = os.path.join(flickr_loc, sentences_root, 'val')
-        sentences_file = os.path.join(sentences_folder, 'data.json')
-
-    if mode == "test":
-        img_folder = os.path.join(flickr_loc, image_root, 'test')
-        annotations_folder = os.path.join(flickr_loc, annotations_root, 'test')
-        sentences_folder = os.path.join(flickr_loc, sentences_root, 'test')
-        sentences_file = os.path.join(sentences_folder, 'data.json')
+    # Based on mode (train, val, test) and manifest, obtain the parsed captions of the fold
+    paths = flickr_paths(mode, flickr_loc, manifest)
+    assert os.path.exists(paths['manifest']), "No split manifest at '%s'." % paths['manifest']
+    img_folder = paths['images']
+    annotations_folder = paths['annotations']
+    sentences_folder = paths['sentences']
+    sentences_file = paths['parsed']
 
     dataset = FlickrDataset(transform=transform,
                             mode=mode,
@@ -164,13 +158,13 @@ def get_loader_genome(transform,
                       unk_word="<unk>",
                       num_workers=1,
                       genome_loc="",
-                      vocab_glove_file="data/visual_genome/vocab_glove.json",
+                      vocab_glove_file="data/visual_genome/vocab_glove.npz",
                       pad_caption=True,
                       pad_limit=20):
   
     image_root = os.path.join(genome_loc,'data','visual_genome', 'images')
-    annotations_file = os.path.join(genome_loc, 'data','visual_genome', 'coco_phrase_data.json')
-    vocab_glove_file = os.path.join(genome_loc, 'data', 'visual_genome', 'vocab_glove.json')
+    annotations_file = os.path.join(genome_loc, 'data','visual_genome', 'coco_phrase_data')
+    vocab_glove_file = os.path.join(genome_loc, 'data', 'visual_genome', 'vocab_glove.npz')
 
     dataset = VisualGenome(transform=transform, 
                            mode='train', 
@@ -0,0 +1,22 @@
+import os
+import json
+import numpy as np
+
+
+def load_vocab_glove(vocab_glove_file):
+    """
+    Load the GloVe embeddings of a vocabulary
+    :param vocab_glove_file: binary .npz file written by the vocab generator. A json
+    dictionary with the same name is used instead when the .npz file does not exist.
+    :return: dictionary mapping each word of the vocabulary to its embedding (list of floats)
+    """
+    if vocab_glove_file.endswith('.npz') and not os.path.exists(vocab_glove_file):
+        legacy_file = vocab_glove_file[:-len('.npz')] + '.json'
+        if os.path.exists(legacy_file):
+            vocab_glove_file = legacy_file
+
+    if vocab_glove_file.endswith('.json'):
+        return json.load(open(vocab_glove_file, encoding='utf-8', mode='r'))
+
+    vocab_glove = np.load(vocab_glove_file)
+    return dict(zip(vocab_glove['words'].tolist(), vocab_glove['embeddings'].tolist()))
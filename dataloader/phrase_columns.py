@@ -0,0 +1,225 @@
+import os
+import json
+import numpy as np
+
+NUMERIC_COLUMNS = ['ann_id', 'image_id', 'bbox', 'tok_length']
+STRING_COLUMNS = ['phrase', 'tok_phrase']
+
+
+def encode_strings(strings):
+    """
+    Concatenated UTF-8 bytes of a list of strings, without padding every string to the longest one
+    :return: uint8 array of the bytes, int64 array of the len(strings) + 1 offsets of the strings in the bytes
+    """
+    encoded = [string.encode('utf-8') for string in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(item) for item in encoded], dtype=np.int64)
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+
+class StringColumn(object):
+    """
+    Column of strings stored as UTF-8 bytes, with the start and end of every string in the bytes
+    """
+
+    def __init__(self, data, starts, ends):
+        self.data = data
+        self.starts = starts
+        self.ends = ends
+
+    def __getitem__(self, position):
+        return self.data[self.starts[position]:self.ends[position]].tobytes().decode('utf-8')
+
+    def __len__(self):
+        return len(self.starts)
+
+    def take(self, positions):
+        # Reordered column sharing the same bytes
+        return StringColumn(self.data, self.starts[positions], self.ends[positions])
+
+    def tolist(self):
+        return [self[position] for position in range(len(self))]
+
+
+def write_phrase_chunk(folder, chunk_index, rows):
+    """
+    Write a chunk of region phrases as one columnar .npz file
+    :param folder: output folder of the phrase table
+    :param chunk_index: position of the chunk in the table
+    :param rows: list of dictionaries with ann_id, image_id, bbox, phrase and tok_phrase
+    :return: name of the written chunk file
+    """
+    chunk_name = 'chunk_%05d.npz' % chunk_index
+    phrase_bytes, phrase_offsets = encode_strings([row['phrase'] for row in rows])
+    tok_phrase_bytes, tok_phrase_offsets = encode_strings([' '.join(row['tok_phrase']) for row in rows])
+    np.savez(os.path.join(folder, chunk_name),
+             ann_id=np.array([row['ann_id'] for row in rows], dtype=np.int64),
+             image_id=np.array([row['image_id'] for row in rows], dtype=np.int64),
+             bbox=np.array([row['bbox'] for row in rows], dtype=np.int64).reshape(-1, 4),
+             phrase_bytes=phrase_bytes, phrase_offsets=phrase_offsets,
+             tok_phrase_bytes=tok_phrase_bytes, tok_phrase_offsets=tok_phrase_offsets,
+             tok_length=np.array([len(row['tok_phrase']) for row in rows], dtype=np.int32))
+    return chunk_name
+
+
+def write_phrase_meta(folder, chunk_names, n_rows):
+    """
+    Write the index of a phrase table once all of its chunks are written
+    """
+    with open(os.path.join(folder, 'meta.json'), 'w') as f:
+        json.dump({'chunks': chunk_names, 'rows': n_rows}, f)
+
+
+class PhraseColumns(object):
+    """
+    Read-only view of a chunked columnar phrase table. Behaves like the
+    {ann_id: {'phrase', 'tok_phrase', 'bbox', 'image_id'}} dictionary of the
+    older coco_phrase_data.json file, with string ann_id keys.
+    phrase and tok_phrase are StringColumns of UTF-8 bytes.
+    """
+
+    def __init__(self, folder):
+        meta = json.load(open(os.path.join(folder, 'meta.json'), encoding='utf-8', mode='r'))
+        columns = {column: [] for column in NUMERIC_COLUMNS}
+        strings = {column: {'data': [], 'starts': [], 'ends': [], 'size': 0} for column in STRING_COLUMNS}
+        for chunk_name in meta['chunks']:
+            chunk = np.load(os.path.join(folder, chunk_name))
+            for column in NUMERIC_COLUMNS:
+                columns[column].append(chunk[column])
+            for column in STRING_COLUMNS:
+                if column + '_bytes' in chunk.files:
+                    data, offsets = chunk[column + '_bytes'], chunk[column + '_offsets']
+                else:
+                    # Tables written before the byte encoding hold fixed width unicode arrays
+                    data, offsets = encode_strings(chunk[column].tolist())
+                string = strings[column]
+                string['data'].append(data)
+                string['starts'].append(offsets[:-1] + string['size'])
+                string['ends'].append(offsets[1:] + string['size'])
+                string['size'] += len(data)
+
+        for column in NUMERIC_COLUMNS:
+            setattr(self, column, np.concatenate(columns[column]))
+        for column, string in strings.items():
+            setattr(self, column, StringColumn(np.concatenate(string['data']), np.concatenate(string['starts']),
+                                               np.concatenate(string['ends'])))
+
+        if (np.diff(self.ann_id) < 0).any():
+            order = np.argsort(self.ann_id, kind='stable')
+            for column in NUMERIC_COLUMNS:
+                setattr(self, column, getattr(self, column)[order])
+            for column in STRING_COLUMNS:
+                setattr(self, column, getattr(self, column).take(order))
+
+    def row(self, key):
+        ann_id = int(key)
+        position = np.searchsorted(self.ann_id, ann_id)
+        if position == len(self.ann_id) or self.ann_id[position] != ann_id:
+            raise KeyError(key)
+        return position
+
+    def keys(self):
+        return [str(ann_id) for ann_id in self.ann_id.tolist()]
+
+    def __getitem__(self, key):
+        position = self.row(key)
+        tok_phrase = str(self.tok_phrase[position])
+        return {'phrase': str(self.phrase[position]),
+                'tok_phrase': tok_phrase.split(' ') if tok_phrase else [],
+                'bbox': self.bbox[position].tolist(),
+                'image_id': int(self.image_id[position])}
+
+    def __contains__(self, key):
+        try:
+            self.row(key)
+        except (KeyError, ValueError):
+            return False
+        return True
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.ann_id)
+
+
+def load_phrase_data(annotations_file):
+    """
+    Load region phrases either from a columnar phrase table folder or a json file
+    """
+    if os.path.isdir(annotations_file):
+        return PhraseColumns(annotations_file)
+    return json.load(open(annotations_file, encoding='utf-8', mode='r'))
+
+
+def write_image_index(filename, images):
+    """
+    Write image metadata as image_id, height and width columns sorted by image_id, in one .npz file
+    :param images: iterable of dictionaries with image_id, height and width
+    """
+    images = sorted(images, key=lambda image: int(image['image_id']))
+    np.savez(filename,
+             image_id=np.array([image['image_id'] for image in images], dtype=np.int64),
+             height=np.array([image['height'] for image in images], dtype=np.int64),
+             width=np.array([image['width'] for image in images], dtype=np.int64))
+
+
+class ImageIndex(object):
+    """
+    Read-only view of an image index written by write_image_index. Behaves like the
+    {image_id: {'image_id', 'height', 'width'}} dictionary of coco_image_data.json,
+    with string image_id keys.
+    """
+
+    def __init__(self, filename):
+        columns = np.load(filename)
+        self.image_id = columns['image_id']
+        self.height = columns['height']
+        self.width = columns['width']
+
+    def rows(self, image_ids):
+        """
+        :param image_ids: array of image ids
+        :return: positions of the images in the columns
+        """
+        image_ids = np.asarray(image_ids, dtype=np.int64)
+        positions = np.searchsorted(self.image_id, image_ids)
+        found = positions < len(self.image_id)
+        found[found] = self.image_id[positions[found]] == image_ids[found]
+        if not found.all():
+            raise KeyError(str(image_ids[~found][0]))
+        return positions
+
+    def keys(self):
+        return [str(image_id) for image_id in self.image_id.tolist()]
+
+    def __getitem__(self, key):
+        position = self.rows([int(key)])[0]
+        return {'image_id': int(self.image_id[position]),
+                'height': int(self.height[position]),
+                'width': int(self.width[position])}
+
+    def __contains__(self, key):
+        try:
+            self.rows([int(key)])
+        except (KeyError, ValueError):
+            return False
+        return True
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.image_id)
+
+
+def load_image_data(image_data_file):
+    """
+    Load image metadata from its index, the .npz file next to the json file.
+    The index is written from the json file when it does not exist yet.
+    """
+    index_file = os.path.splitext(image_data_file)[0] + '.npz'
+    if not os.path.exists(index_file):
+        image_data = json.load(open(image_data_file, encoding='utf-8', mode='r'))
+        write_image_index(index_file, image_data.values())
+    return ImageIndex(index_file)
@@ -0,0 +1,74 @@
+import numpy as np
+import torch.utils.data as data
+
+
+class EpochBatchSampler(data.Sampler):
+    """
+    Batches covering one epoch of a dataset, in an order that only depends on seed and epoch.
+    Storing the epoch and the number of batches already done is enough to resume from the exact batch.
+    Captions longer than pad_limit are skipped when captions are padded. Without padding, every
+    batch holds captions of a single length, like get_indices.
+    With several ranks, every rank gets every world_size-th batch of the same order, and all ranks
+    run the same number of batches.
+    :param dataset: COCODataset, FlickrDataset or VisualGenome
+    :param batch_size: number of samples per batch (per rank), incomplete batches are dropped
+    :param seed: seed of the shuffling, the same on all ranks
+    """
+    def __init__(self, dataset, batch_size, seed=0, rank=0, world_size=1):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.epoch = 0
+        self.start_batch = 0
+
+    def length_groups(self):
+        lengths = np.array(self.dataset.caption_lengths)
+        if self.dataset.pad_caption:
+            return [np.where(lengths <= self.dataset.pad_limit)[0]]
+        return [np.where(lengths == length)[0] for length in np.unique(lengths)]
+
+    def epoch_batches(self):
+        rng = np.random.RandomState(self.seed + self.epoch)
+        batches = list()
+        for indices in self.length_groups():
+            indices = rng.permutation(indices)
+            n_batches = len(indices) // self.batch_size
+            batches.extend(indices[:n_batches * self.batch_size].reshape(n_batches, self.batch_size).tolist())
+        order = rng.permutation(len(batches))
+        n_rank_batches = len(batches) // self.world_size
+        return [batches[i] for i in order[self.rank:n_rank_batches * self.world_size:self.world_size]]
+
+    def set_epoch(self, epoch, start_batch=0):
+        """
+        :param epoch: epoch whose order is produced by the next iteration
+        :param start_batch: number of batches of the epoch that are skipped, to resume an interrupted epoch
+        """
+        self.epoch = epoch
+        self.start_batch = start_batch
+
+    def __iter__(self):
+        return iter(self.epoch_batches()[self.start_batch:])
+
+    def __len__(self):
+        n_batches = sum(len(indices) // self.batch_size for indices in self.length_groups())
+        return n_batches // self.world_size - self.start_batch
+
+    def state_dict(self):
+        return {'seed': self.seed, 'epoch': self.epoch, 'start_batch': self.start_batch,
+                'world_size': self.world_size}
+
+
+def epoch_loader(data_loader, seed=0, rank=0, world_size=1):
+    """
+    Data loader iterating over whole epochs of the dataset of data_loader, instead of
+    the single random batch drawn by get_indices
+    :param data_loader: loader returned by get_loader_coco, get_loader_flickr or get_loader_genome
+    :param rank: rank of the process, batches are split over world_size processes
+    :return: DataLoader whose batch_sampler is an EpochBatchSampler
+    """
+    batch_sampler = EpochBatchSampler(data_loader.dataset, data_loader.dataset.batch_size, seed, rank, world_size)
+    return data.DataLoader(dataset=data_loader.dataset,
+                           num_workers=data_loader.num_workers,
+                           batch_sampler=batch_sampler)
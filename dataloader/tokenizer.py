@@ -0,0 +1,79 @@
+"""Fast, memoized drop-in for nltk.tokenize.word_tokenize."""
+import re
+import time
+import random
+import argparse
+from functools import lru_cache
+
+# Captions made of plain words, hyphenated words, commas followed by a space and
+# at most one final . ! or ? are tokenized identically by nltk's punkt + treebank
+# pipeline and by a single regex. Everything else is handed to nltk.
+_WORD = r"[A-Za-z0-9]+(?:-[A-Za-z0-9]+)*"
+SIMPLE_TEXT = re.compile(r"^ *%s(?:,? +%s)* *[.!?]? *$" % (_WORD, _WORD))
+SIMPLE_TOKEN = re.compile(r"%s|[,.!?]" % _WORD)
+# Words split by the treebank contraction rules (e.g. cannot -> can not)
+CONTRACTIONS = re.compile(r"(?i)\b(cannot|gimme|gonna|gotta|lemme|wanna)\b")
+
+CACHE_SIZE = 1 << 18
+
+
+def nltk_tokenize(text):
+    import nltk
+    return nltk.tokenize.word_tokenize(text)
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _tokenize(text):
+    if SIMPLE_TEXT.match(text) and not CONTRACTIONS.search(text):
+        return tuple(SIMPLE_TOKEN.findall(text))
+    return tuple(nltk_tokenize(text))
+
+
+def word_tokenize(text):
+    """
+    Tokenize a string exactly like nltk.tokenize.word_tokenize
+    :param text: string to tokenize. Lowercasing is left to the caller.
+    :return: list of tokens
+    """
+    return list(_tokenize(text))
+
+
+def tokenize_batch(texts):
+    """
+    Tokenize a batch of strings
+    :param texts: iterable of strings
+    :return: list of token lists, one per string
+    """
+    return [list(_tokenize(text)) for text in texts]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('caption_file', type=str,
+                        help='text file with one caption per line (results_20130124.token layout also works)')
+    parser.add_argument('--samples', default=10000, type=int,
+                        help='number of captions sampled for the check')
+    args = parser.parse_args()
+
+    with open(args.caption_file, encoding='utf-8', mode='r') as f:
+        captions = [line.rstrip('\n').split('\t')[-1].lower() for line in f if line.strip()]
+    captions = random.sample(captions, min(args.samples, len(captions)))
+
+    start_time = time.time()
+    nltk_tokens = [nltk_tokenize(caption) for caption in captions]
+    nltk_time = time.time() - start_time
+
+    start_time = time.time()
+    fast_tokens = tokenize_batch(captions)
+    fast_time = time.time() - start_time
+
+    mismatches = [(caption, tokens, expected) for caption, tokens, expected
+                  in zip(captions, fast_tokens, nltk_tokens) if tokens != expected]
+    fast_path = sum(1 for caption in captions if SIMPLE_TEXT.match(caption))
+
+    print("Captions checked: ", len(captions))
+    print("Regex fast path: %d (%.1f%%)" % (fast_path, 100.0 * fast_path / max(len(captions), 1)))
+    print("nltk: %.3fs, tokenizer: %.3fs" % (nltk_time, fast_time))
+    print("Mismatches: ", len(mismatches))
+    for caption, tokens, expected in mismatches[:20]:
+        print(caption, tokens, expected)
@@ -1,5 +1,6 @@
 import argparse
 from visualizations import *
+from steps.profiling import MemoryTracker
 import json
 
 parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -8,6 +9,16 @@ parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFo
 parser.add_argument('--model_path', default=0, type=str)
 parser.add_argument('--parse_mode', default='phrase', type=str)
 parser.add_argument('--dataset', default='genome', type=str)
+parser.add_argument('--precision', default='fp32', type=str, choices=['fp32', 'bf16'])
+parser.add_argument('--channels_last', action='store_true')
+parser.add_argument('--batch_size', default=20, type=int,
+                    help='captions evaluated per forward pass')
+parser.add_argument('--num_workers', default=4, type=int,
+                    help='data loader processes')
+parser.add_argument('--memory_report', default='', type=str,
+                    help='track the peak memory of the run and write it to this JSON file')
+parser.add_argument('--memory_detailed', action='store_true',
+                    help='also list the largest tensors at the peak')
 
 
 dict_models = {'none':'',
@@ -17,27 +28,33 @@ dict_models = {'none':'',
         'triplet':'saved_models/flickr_triplet.tar',
         'mix': 'saved_models/mix_140epochs.tar',
         'mix2': 'saved_models/coco_genome.tar'}
-
-# image_data_file = 'data/visual_genome/coco_image_data.json'
-# annotations_file = 'data/visual_genome/coco_phrase_data.json'
-
-# print("Loading Annotations...")
-# image_data = json.load(open(image_data_file, encoding='utf-8', mode='r'))
-# annotations_data = json.load(open(annotations_file, encoding='utf-8', mode='r'))
-# print("Annotations loaded!")
 args = parser.parse_args()
 
 model_path = dict_models[args.model_path]
 
+if args.memory_report:
+    memory_tracker = MemoryTracker(detailed=args.memory_detailed).start()
+
 if args.dataset=='flickr':
-    flickr_processor = FlickrViz(batch_size=20, parse_mode=args.parse_mode, model_path=model_path, eval_mode=True)
+    flickr_processor = FlickrViz(batch_size=args.batch_size, parse_mode=args.parse_mode, model_path=model_path, eval_mode=True,
+                                 precision=args.precision, channels_last=args.channels_last)
     length_dataset = len(flickr_processor.dataset)
 
-    score, score_list = flickr_processor.loc_eval(length_dataset)
+    score, score_list = flickr_processor.loc_eval(length_dataset, args.num_workers)
 
     print(score)
 
 else:
-    genome_processor = GenomeViz(batch_size=1, model_path=model_path, image_data=image_data, annotations_data=annotations_data, eval_mode=True, parse_mode=args.parse_mode)
+    # Image metadata and phrase annotations are read from their indexes in data/visual_genome
+    genome_processor = GenomeViz(batch_size=args.batch_size, model_path=model_path, eval_mode=True, parse_mode=args.parse_mode,
+                                 precision=args.precision, channels_last=args.channels_last)
     length_dataset = len(genome_processor.dataset)
-    score_list, score_mean = genome_processor.loc_eval(length_dataset)
+    score_list, score_mean = genome_processor.loc_eval(length_dataset, args.num_workers)
+
+    print(score_mean)
+
+if args.memory_report:
+    memory_tracker.stop()
+    memory_tracker.dump(args.memory_report)
+    print("Peak memory: %0.0f MB in %s, data loader workers: %0.0f MB" % (
+        memory_tracker.peak, memory_tracker.peak_section, memory_tracker.workers_peak))
@@ -0,0 +1,84 @@
+"""Export both branches and the matchmap head of a checkpoint to TorchScript and ONNX."""
+import argparse
+import os
+
+import torch
+
+from models import ExportedModels, export_onnx, export_torchscript, example_inputs
+from steps.utils import compute_matchmap_similarity_matrix, matchmap_generate
+from visualizations import get_models
+
+parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+parser.add_argument('--model_path', required=True, type=str,
+                    help='checkpoint to export')
+
+parser.add_argument('--output_dir', default='', type=str,
+                    help='folder of the exported artifacts (default: exported/<checkpoint name>)')
+
+parser.add_argument('--formats', nargs='+', default=['torchscript', 'onnx'], choices=['torchscript', 'onnx'],
+                    help='artifact formats to write')
+
+parser.add_argument('--atol', default=1e-4, type=float,
+                    help='largest absolute difference to the eager models accepted by the parity check')
+
+
+def max_difference(a, b):
+    return (a.float() - b.float()).abs().max().item()
+
+
+def check_parity(image_model, caption_model, exported, atol):
+    """
+    Compare the exported artifacts with the eager models on batch and sequence sizes
+    different from the traced ones, including more captions than images as in retrieval
+    :return: True if all outputs are within atol
+    """
+    passed = True
+    for n_images, n_captions, seq_length in [(1, 1, 22), (3, 3, 9), (2, 5, 12)]:
+        image_tensor, _ = example_inputs(n_images, seq_length)
+        _, caption_glove = example_inputs(n_captions, seq_length)
+        with torch.no_grad():
+            image_op = image_model(image_tensor)
+            caption_op = caption_model(caption_glove)
+            sim_mat = compute_matchmap_similarity_matrix(image_op, caption_op)
+
+        exported_image_op = exported.image(image_tensor)
+        exported_caption_op = exported.caption(caption_glove)
+        differences = {'image': max_difference(image_op, exported_image_op),
+                       'caption': max_difference(caption_op, exported_caption_op),
+                       'sim_mat': max_difference(sim_mat, exported.similarity(exported_image_op, exported_caption_op))}
+        if n_images == n_captions:
+            # Matchmaps pair every image with its own caption
+            matchmaps = torch.stack([matchmap_generate(image_op[i], caption_op[i]) for i in range(n_images)])
+            differences['matchmaps'] = max_difference(matchmaps, exported.matchmaps(exported_image_op, exported_caption_op))
+
+        for name, difference in differences.items():
+            ok = difference <= atol
+            passed = passed and ok
+            print("%-12s %-10s images %d, captions %d, length %2d: max abs difference %0.2e %s" % (
+                exported.runtime, name, n_images, n_captions, seq_length, difference, 'ok' if ok else 'FAILED'))
+    return passed
+
+
+def main(args):
+    output_dir = args.output_dir or os.path.join('exported', os.path.basename(args.model_path).split('.')[0])
+    image_model, caption_model = get_models(args.model_path)
+    image_model.eval()
+    caption_model.eval()
+
+    passed = True
+    for export_format in args.formats:
+        print("========================================================")
+        print("Exporting %s artifacts to %s" % (export_format, output_dir))
+        if export_format == 'torchscript':
+            export_torchscript(image_model, caption_model, output_dir)
+        else:
+            export_onnx(image_model, caption_model, output_dir)
+        passed = check_parity(image_model, caption_model, ExportedModels(output_dir, export_format), args.atol) and passed
+    print("========================================================")
+    return 0 if passed else 1
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    exit(main(args))
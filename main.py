@@ -1,8 +1,11 @@
 import argparse
 import os
+import json
+import functools
 import time
+import random
+import numpy as np
 from torchvision import transforms
-import shutil
 import torch
 
 import math
@@ -10,10 +13,17 @@ import math
 from dataloader import get_loader_coco
 from dataloader import get_loader_flickr
 from dataloader import get_loader_genome
+from dataloader import epoch_loader
 
 from steps import *
 from steps.models_train import *
-from models import VGG19, LSTMBranch, ResNet50
+from models import BACKBONES, TEXT_ENCODERS, GRIDS, get_image_model, get_text_encoder, load_models
+
+def step_range(value):
+    # 'a:b' -> (a, b)
+    start, stop = value.split(':')
+    return int(start), int(stop)
+
 
 parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
@@ -48,6 +58,9 @@ parser.add_argument("--optim", type=str, default="sgd",
 parser.add_argument('-b', '--batch-size', default=64, type=int,
                     metavar='N', help='mini-batch size (default: 100)')
 
+parser.add_argument('--accumulation_steps', default=1, type=int,
+                    help='Batches per optimizer step, negatives are mined over all of them at the memory of one batch')
+
 parser.add_argument('--momentum', default=0.9, type=float, metavar='M',
                     help='momentum')
 
@@ -66,18 +79,80 @@ parser.add_argument('--minimum_gain', type=float, default=5e-1, metavar='N',
 parser.add_argument('--no_gain_stop', type=int, default=10, metavar='N',
                     help='number of epochs used to perform early stopping based on validation performance (default: 10)')
 
-parser.add_argument("--cnn_model", type=str, default='vgg',
+parser.add_argument("--cnn_model", type=str, default='vgg', choices=list(BACKBONES),
                     help="CNN Model")
 
+parser.add_argument("--text_encoder", type=str, default='lstm', choices=list(TEXT_ENCODERS),
+                    help="Text branch used to encode captions")
+
+parser.add_argument('--embedding_dim', default=1024, type=int,
+                    help='Dimension of the word and image region embeddings')
+
+parser.add_argument('--grid', default='14x14', type=str, choices=GRIDS,
+                    help='Spatial grid of the image embeddings, 7x7 grids make matchmaps 4 times cheaper')
+
+parser.add_argument('--precision', default='fp32', type=str, choices=['fp32', 'bf16'],
+                    help='Run forward passes and similarity scores under bfloat16 autocast (weights and loss stay fp32)')
+
+parser.add_argument('--channels_last', action='store_true',
+                    help='Use the channels last memory format for the image branch')
+
+parser.add_argument('--checkpoint_segments', default=0, type=int,
+                    help='Activation checkpointing of the CNN trunk in this many segments (0 disables it)')
+
+parser.add_argument('--teacher', default='', type=str,
+                    help='Distillation mode: checkpoint of a frozen teacher supervising the models being trained')
+
+parser.add_argument('--temperature', default=1.0, type=float,
+                    help='Softmax temperature of the distillation losses')
+
+parser.add_argument('--matchmap_weight', default=1.0, type=float,
+                    help='Weight of the matchmap distillation loss')
+
+parser.add_argument('--similarity_weight', default=1.0, type=float,
+                    help='Weight of the similarity matrix distillation loss')
+
 parser.add_argument('--resume', default='', type=str,
                     help='path to latest checkpoint of best model (default: none)')
 
+parser.add_argument('--checkpoint_interval', default=600, type=int,
+                    help='Seconds between two mid-epoch checkpoints, 0 only saves at the end of epochs')
+
+parser.add_argument('--keep_checkpoints', default=0, type=int,
+                    help='Number of end of epoch checkpoints kept as runs/<name>/checkpoint_<epoch>.pth.tar')
+
+parser.add_argument('--seed', default=0, type=int,
+                    help='Seed of the order of the training batches')
+
+parser.add_argument('--profile_steps', default=None, type=step_range,
+                    help="Training steps a:b captured with torch.profiler into runs/<name>/trace_steps_a-b.json")
+
+parser.add_argument('--memory_tracking', default='sampling', type=str, choices=['off', 'sampling', 'detailed'],
+                    help='Peak memory per phase and of the data loader workers, written to runs/<name>/memory.json. '
+                         'detailed also lists the largest tensors at the peak, at a cost')
+
+parser.add_argument('--async_validation', action='store_true',
+                    help='Validate every checkpoint on the whole validation split in a low priority background process, '
+                         'which also selects the best model, instead of stopping training after every epoch')
+
+parser.add_argument('--validation_threads', default=2, type=int,
+                    help='Threads of the background validation process')
+
+parser.add_argument('--log_dir', default='../logs', type=str,
+                    help='Folder of the training metrics')
+
+parser.add_argument('--metrics', nargs='+', default=['tensorboard'], choices=METRICS_BACKENDS,
+                    help='Metrics backends: tensorboard event files, metrics.jsonl, or metrics.prom for the Prometheus textfile collector')
+
 parser.add_argument('--dataset', default='flickr', type=str,
                     help='Which Dataset to use')
 
 parser.add_argument('--parse_mode', default='phrase', type=str,
                     help='If its the flickr dataset, parsing mode needs to be specified.')
 
+parser.add_argument('--manifest', default='default', type=str,
+                    help='Split manifest used to resolve the flickr train and val folds.')
+
 
 def main(args):
     # Parsing command line arguments
@@ -86,18 +161,39 @@ def main(args):
     print("Process %s, running on %s: starting (%s)" % (
         os.getpid(), os.name, time.asctime()))
 
+    # Multi-process training when launched by torchrun, see README
+    distributed = init_distributed()
+    rank, world_size = get_rank(), get_world_size()
+    if distributed:
+        print("Rank %d of %d processes" % (rank, world_size))
+    # Only the main process writes metrics
+    writer.configure(args.log_dir, args.metrics if is_main_process() else [])
+
     print("========================================================")
 
-    if args.cnn_model == 'vgg':
-        image_model = VGG19(pretrained=True)
-    else:
-        image_model = ResNet50(pretrained = True)
+    # ImageNet weights come from the weight store, they are skipped when resuming from a checkpoint
+    pretrained = not os.path.isfile(args.resume)
+    image_model = get_image_model(args.cnn_model, args.embedding_dim, pretrained=pretrained,
+                                  checkpoint_segments=args.checkpoint_segments, grid=args.grid)
+
+    caption_model = get_text_encoder(args.text_encoder, op_size=args.embedding_dim)
 
-    caption_model = LSTMBranch()
+    if args.teacher:
+        assert args.accumulation_steps == 1, "Distillation does not support --accumulation_steps"
+        # The teacher is frozen, only the models built above are trained
+        teacher_image_model, teacher_caption_model = load_models(args.teacher)
+        for p in list(teacher_image_model.parameters()) + list(teacher_caption_model.parameters()):
+            p.requires_grad = False
 
     if torch.cuda.is_available() and args.use_gpu == True:
+        if distributed:
+            torch.cuda.set_device(int(os.environ.get('LOCAL_RANK', 0)))
         image_model = image_model.cuda()
         caption_model = caption_model.cuda()
+        if args.teacher:
+            teacher_image_model = teacher_image_model.cuda()
+            teacher_caption_model = teacher_caption_model.cuda()
+    image_model = to_channels_last(image_model, args.channels_last)
 
     # Get the learnable parameters
     image_trainables = [p for p in image_model.parameters() if p.requires_grad]
@@ -116,39 +212,53 @@ def main(args):
         data_loader_train = get_loader_flickr(transform=transform,
                                             mode='train',
                                             batch_size=args.batch_size,
-                                            parse_mode=args.parse_mode)
+                                            parse_mode=args.parse_mode,
+                                            manifest=args.manifest)
 
-        data_loader_val = get_loader_flickr(transform=transform,
-                                          mode='val',
-                                          batch_size=args.batch_size,
-                                          parse_mode=args.parse_mode)
+        make_val_loader = functools.partial(get_loader_flickr, transform=transform,
+                                            mode='val',
+                                            batch_size=args.batch_size,
+                                            parse_mode=args.parse_mode,
+                                            manifest=args.manifest)
 
     elif args.dataset == 'coco':
         data_loader_train = get_loader_coco(transform=transform,
                                        mode='train',
                                        batch_size=args.batch_size)
 
-        data_loader_val = get_loader_coco(transform=transform,
-                                     mode='val',
-                                     batch_size=args.batch_size)
+        make_val_loader = functools.partial(get_loader_coco, transform=transform,
+                                            mode='val',
+                                            batch_size=args.batch_size)
     else:
         data_loader_train = get_loader_genome(transform=transform,
                                               mode='train',
                                               batch_size=args.batch_size)
 
-        data_loader_val = get_loader_genome(transform=transform,
+        make_val_loader = functools.partial(get_loader_genome, transform=transform,
                                             mode='train',
                                             batch_size=args.batch_size)
 
-    # Load saved model
-    start_epoch, best_loss = load_checkpoint(image_model, caption_model, args.resume)
+    # The background validation process builds its own loader
+    data_loader_val = make_val_loader()
+
+    # Training iterates over whole epochs in an order fixed by the seed, so it can resume from any batch.
+    # Every process trains on its share of the batches, -b is the batch size per process
+    data_loader_train = epoch_loader(data_loader_train, args.seed, rank, world_size)
+    total_train_step = len(data_loader_train.batch_sampler)
+    # print("Total number of training steps are :", total_train_step)
 
     # optimizer = torch.optim.Adam(params=params, lr=0.01)
     optimizer = torch.optim.SGD(params=params, lr=args.lr, momentum=0.9)
 
-    total_train_step = math.ceil(
-        len(data_loader_train.dataset.caption_lengths) / data_loader_train.batch_sampler.batch_size)
-    # print("Total number of training steps are :", total_train_step)
+    # Load saved model
+    start_epoch, best_loss, start_step, start_loss = load_checkpoint(image_model, caption_model,
+                                                                     args.resume, optimizer)
+
+    # Gradients are averaged over the processes, checkpoints and validation use the unwrapped models
+    train_image_model, train_caption_model = image_model, caption_model
+    if distributed:
+        train_image_model = torch.nn.parallel.DistributedDataParallel(image_model)
+        train_caption_model = torch.nn.parallel.DistributedDataParallel(caption_model)
 
     print("========================================================")
     print("Total number of epochs to train: ", args.n_epochs)
@@ -158,38 +268,117 @@ def main(args):
         print("Margin for triplet loss: ", args.margin)
     print("Learning Rate: ", args.lr)
     print("Score Type for similarity: ", args.score_type)
+    print("Text encoder: ", args.text_encoder)
+    print("Embedding dimension: %d, grid: %s" % (args.embedding_dim, args.grid))
+    if args.teacher:
+        print("Distilling from teacher: ", args.teacher)
+    print("Precision: ", args.precision, "(channels last)" if args.channels_last else "")
+    if distributed:
+        print("Processes: %d, global batch size: %d" % (world_size, world_size * args.batch_size))
+    if args.accumulation_steps > 1:
+        print("Accumulation steps: %d, effective batch size: %d" % (
+            args.accumulation_steps, args.accumulation_steps * world_size * args.batch_size))
+    if args.checkpoint_segments > 0:
+        print("Activation checkpointing segments: ", args.checkpoint_segments)
     print("========================================================")
 
     epoch = start_epoch
     best_epoch = start_epoch
 
+    memory_tracker = None
+    if args.memory_tracking != 'off':
+        memory_tracker = MemoryTracker(detailed=args.memory_tracking == 'detailed').start()
+
+    profiler = None
+    if args.profile_steps is not None and is_main_process():
+        profiler = StepProfiler(args.profile_steps[0], args.profile_steps[1],
+                                'runs/%s/trace_steps_%d-%d.json' % ((args.name,) + args.profile_steps),
+                                use_cuda=torch.cuda.is_available() and args.use_gpu == True)
+
+    def training_state(epoch, step, total_loss, best_loss):
+        # Resume point: step batches of epoch are done, their losses summed to total_loss
+        return {
+            'epoch': epoch,
+            'step': step,
+            'total_loss': total_loss,
+            'best_loss': best_loss,
+            'image_model': image_model.state_dict(),
+            'caption_model': caption_model.state_dict(),
+            'optimizer': optimizer.state_dict(),
+            'sampler': data_loader_train.batch_sampler.state_dict(),
+            'rng': {'torch': torch.get_rng_state(), 'numpy': np.random.get_state(), 'python': random.getstate()},
+            'text_encoder': args.text_encoder,
+            'cnn_model': args.cnn_model,
+            'embedding_dim': args.embedding_dim,
+            'grid': args.grid
+        }
+
+    # All processes hold the same weights, only the main process writes them, in a background thread
+    checkpoint_writer = CheckpointWriter('runs/%s/' % args.name, args.keep_checkpoints) if is_main_process() else None
+
+    validation_process = None
+    if args.async_validation and is_main_process():
+        validation_process, stop_validation = start_validation_process(
+            'runs/%s/' % args.name, make_val_loader, total_train_step, args.loss_type, args.score_type,
+            args.sampler, args.margin, args.log_dir, args.metrics,
+            threads=args.validation_threads, use_gpu=args.use_gpu, precision=args.precision)
+
+    def save_state(step, total_loss):
+        if checkpoint_writer is not None:
+            checkpoint_writer.save(training_state(epoch, step, total_loss, best_loss))
+
     # while (epoch - best_epoch) < args.no_gain_stop and (epoch <= args.n_epochs):
     while epoch <= args.n_epochs:
         adjust_learning_rate(args.lr, args.lr_decay, optimizer, epoch)
         print("========================================================")
         print("Epoch: %d Training starting" % epoch)
         print("Learning rate : ", get_lr(optimizer))
-        train_loss = train(data_loader_train, data_loader_val, image_model,
-                              caption_model, args.loss_type, optimizer, epoch,
-                              args.score_type, args.sampler, args.margin,
-                              total_train_step, args.batch_size, args.use_gpu)
-        print('---------------------------------------------------------')
-        print("Epoch: %d Validation starting" % epoch)
-        val_loss = validate(caption_model, image_model, data_loader_val,
-                            epoch, args.loss_type, args.score_type, args.sampler,
-                            args.margin, args.use_gpu)
+        if start_step > 0:
+            print("Resuming after step %d of %d" % (start_step, total_train_step))
+        data_loader_train.batch_sampler.set_epoch(epoch, start_step)
+        if args.teacher:
+            train_loss = distill(data_loader_train, teacher_image_model, teacher_caption_model,
+                                 train_image_model, train_caption_model, optimizer, epoch, total_train_step,
+                                 args.use_gpu, args.temperature, args.matchmap_weight, args.similarity_weight,
+                                 precision=args.precision, channels_last=args.channels_last,
+                                 start_step=start_step + 1, start_loss=start_loss,
+                                 checkpoint_interval=args.checkpoint_interval, save_state=save_state)
+        else:
+            train_loss = train(data_loader_train, data_loader_val, train_image_model,
+                               train_caption_model, args.loss_type, optimizer, epoch,
+                               args.score_type, args.sampler, args.margin,
+                               total_train_step, args.batch_size, args.use_gpu,
+                               start_step=start_step + 1, start_loss=start_loss,
+                               precision=args.precision, channels_last=args.channels_last,
+                               checkpoint_interval=args.checkpoint_interval, save_state=save_state,
+                               accumulation_steps=args.accumulation_steps, profiler=profiler)
+        start_step, start_loss = 0, 0.0
+        if args.async_validation:
+            # The checkpoint is validated, and the best model selected, by the background process
+            val_loss = best_loss
+        else:
+            print('---------------------------------------------------------')
+            print("Epoch: %d Validation starting" % epoch)
+            val_loss = validate(caption_model, image_model, data_loader_val,
+                                epoch, args.loss_type, args.score_type, args.sampler,
+                                args.margin, args.use_gpu, args.precision, args.channels_last)
         print("Epoch: ", epoch)
-        print("Training Loss: ", float(train_loss.data))
-        print("Validation Loss: ", float(val_loss.data))
+        print("Training Loss: ", float(train_loss))
+        if not args.async_validation:
+            print("Validation Loss: ", float(val_loss.data))
+        if memory_tracker is not None:
+            print("Peak memory: %0.0f MB in %s, data loader workers: %0.0f MB" % (
+                memory_tracker.peak, memory_tracker.peak_section, memory_tracker.workers_peak))
+            memory_tracker.write(writer, 'memory', epoch)
+            if is_main_process():
+                memory_tracker.dump('runs/%s/memory.json' % args.name)
 
         print("========================================================")
 
-        save_checkpoint({
-            'epoch': epoch,
-            'best_loss': min(best_loss, val_loss),
-            'image_model': image_model.state_dict(),
-            'caption_model': caption_model.state_dict()
-        }, val_loss < best_loss)
+        # The next run starts with the first batch of the next epoch
+        if checkpoint_writer is not None:
+            checkpoint_writer.save(training_state(epoch + 1, 0, 0.0, min(best_loss, val_loss)),
+                                   val_loss < best_loss, epoch)
         if (val_loss) < best_loss:
             best_epoch = epoch
             best_loss = val_loss
@@ -197,13 +386,37 @@ def main(args):
         epoch += 1
 
     print("Back to main")
+    # Wait for the last checkpoint of the main process
+    if checkpoint_writer is not None:
+        checkpoint_writer.close()
+    if memory_tracker is not None:
+        memory_tracker.stop()
+    barrier()
+
+    if args.async_validation:
+        if validation_process is not None:
+            print("Waiting for the validation of the last checkpoint")
+            stop_validation.set()
+            validation_process.join()
+            if validation_process.exitcode != 0:
+                print("Validation process failed with exit code %d" % validation_process.exitcode)
+            results_file = 'runs/%s/validation.json' % args.name
+            results = json.load(open(results_file)) if os.path.exists(results_file) else list()
+            if not results:
+                print("No checkpoint was validated, %s is missing or empty" % results_file)
+                return
+            best = min(results, key=lambda result: result['loss'])
+            print("========================================================")
+            print("Final Loss : %0.4f at step %d" % (best['loss'], best['step']))
+            print("========================================================")
+        return
     resume_filename = 'runs/%s/' % (args.name) + 'model_best.pth.tar'
     if os.path.exists(resume_filename):
 
-        epoch, best_loss1 = load_checkpoint(image_model, caption_model, args.resume)
+        epoch, best_loss1, _, _ = load_checkpoint(image_model, caption_model, args.resume)
         val_loss1 = validate(caption_model, image_model, data_loader_val,
                                 epoch, args.loss_type, args.score_type, args.sampler,
-                                args.margin, args.use_gpu)
+                                args.margin, args.use_gpu, args.precision, args.channels_last)
         print("========================================================")
         print("========================================================")
         print("Final Loss : ", float(val_loss1.data))
@@ -213,10 +426,10 @@ def main(args):
     else:
         resume_filename = 'runs/%s/' % (args.name) + 'checkpoint.pth.tar'
         print("Using last run epoch.")
-        epoch, best_loss1 = load_checkpoint(image_model, caption_model, args.resume)
+        epoch, best_loss1, _, _ = load_checkpoint(image_model, caption_model, args.resume)
         val_loss1 = validate(caption_model, image_model, data_loader_val,
                              epoch, args.loss_type, args.score_type, args.sampler,
-                             args.margin, args.use_gpu)
+                             args.margin, args.use_gpu, args.precision, args.channels_last)
         print("========================================================")
         print("========================================================")
         print("Final Loss : ", float(val_loss1.data))
@@ -229,23 +442,14 @@ def get_lr(optimizer):
         return param_group['lr']
 
 
-def save_checkpoint(state, is_best, filename='checkpoint.pth.tar'):
-    directory = "runs/%s/" % (args.name)
-
-    if not os.path.exists(directory):
-        os.makedirs(directory)
-
-    filename = directory + filename
-    torch.save(state, filename)
-    print("Saved Checkpoint!")
-
-    if is_best:
-        print("Best Model found ! ")
-        shutil.copyfile(filename, 'runs/%s/' % (args.name) + 'model_best.pth.tar')
-
-
-def load_checkpoint(image_model, caption_model, resume_filename):
+def load_checkpoint(image_model, caption_model, resume_filename, optimizer=None):
+    """
+    Restore models and, if optimizer is given, the optimizer and random number generators
+    :return: epoch to start with, best loss, number of batches of that epoch already done and their summed loss
+    """
     start_epoch = 1
+    start_step = 0
+    start_loss = 0.0
     if args.loss_type == 'triplet':
         best_loss = 2 * args.margin
     else:
@@ -259,6 +463,19 @@ def load_checkpoint(image_model, caption_model, resume_filename):
             best_loss = checkpoint['best_loss']
             image_model.load_state_dict(checkpoint['image_model'])
             caption_model.load_state_dict(checkpoint['caption_model'])
+            # Checkpoints written before mid-epoch resuming only hold the models
+            if optimizer is not None and 'optimizer' in checkpoint:
+                optimizer.load_state_dict(checkpoint['optimizer'])
+                start_step = checkpoint['step']
+                start_loss = checkpoint['total_loss']
+                torch.set_rng_state(checkpoint['rng']['torch'])
+                np.random.set_state(checkpoint['rng']['numpy'])
+                random.setstate(checkpoint['rng']['python'])
+                assert checkpoint['sampler']['seed'] == args.seed, "Resume with --seed %d" % checkpoint['sampler']['seed']
+                # Every rank takes every world_size-th batch, step counts the batches of one rank
+                saved_world_size = checkpoint['sampler'].get('world_size', 1)
+                assert start_step == 0 or saved_world_size == get_world_size(), \
+                    "Resume a mid-epoch checkpoint with %d processes" % saved_world_size
 
             print("========================================================")
 
@@ -270,7 +487,7 @@ def load_checkpoint(image_model, caption_model, resume_filename):
         else:
             print(" => No checkpoint found at '{}'".format(resume_filename))
 
-    return start_epoch, best_loss
+    return start_epoch, best_loss, start_step, start_loss
 
 
 if __name__ == "__main__":
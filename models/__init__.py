@@ -1 +1,5 @@
-from .models import *
\ No newline at end of file
+from .models import *
+from .quantization import *
+from .export import *
+from .loading import *
+from .split_checkpoint import *
\ No newline at end of file
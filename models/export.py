@@ -0,0 +1,150 @@
+import os
+import torch
+import torch.nn as nn
+
+from .models import IMAGE_SIZE
+
+
+# Exported modules, the heads take the outputs of the image and caption branches
+EXPORTED_MODULES = ['image', 'caption', 'matchmap', 'similarity']
+
+
+class MatchmapHead(nn.Module):
+    """
+    Batched matchmap_generate, images and captions share one batch axis.
+    :return matchmaps: B x T x H x W matchmaps of every image with its own caption
+    """
+    def forward(self, image_op, caption_op):
+        return torch.einsum('btd,bdhw->bthw', caption_op, image_op)
+
+
+class SimilarityHead(nn.Module):
+    """
+    Avg_Both similarity matrix, for any number of images and captions.
+    :return sim_mat: B_img x B_cap similarity matrix, the mean of every image-caption matchmap
+    """
+    def forward(self, image_op, caption_op):
+        # The mean of a matchmap is the dot product of the mean word and the mean region embedding
+        return torch.matmul(image_op.mean(dim=(2, 3)), caption_op.mean(1).t())
+
+
+def example_inputs(batch_size=2, seq_length=22, ip_size=300):
+    """
+    Random image and caption glove batches used for tracing
+    """
+    return torch.randn(batch_size, 3, IMAGE_SIZE, IMAGE_SIZE), torch.randn(batch_size, seq_length, ip_size)
+
+
+def trace_models(image_model, caption_model):
+    """
+    Trace both branches and the matchmap and similarity heads
+    :return: dictionary of TorchScript modules
+    """
+    image_model.eval()
+    caption_model.eval()
+    image_tensor, caption_glove = example_inputs()
+    with torch.no_grad():
+        image_op = image_model(image_tensor)
+        caption_op = caption_model(caption_glove)
+        return {'image': torch.jit.trace(image_model, image_tensor),
+                'caption': torch.jit.trace(caption_model, caption_glove),
+                'matchmap': torch.jit.trace(MatchmapHead(), (image_op, caption_op)),
+                # Traced with fewer images than captions, the two batch sizes are independent
+                'similarity': torch.jit.trace(SimilarityHead(), (image_op[:1], caption_op))}
+
+
+def export_torchscript(image_model, caption_model, export_dir):
+    """
+    Write image.pt, caption.pt, matchmap.pt and similarity.pt to export_dir
+    """
+    os.makedirs(export_dir, exist_ok=True)
+    for name, module in trace_models(image_model, caption_model).items():
+        module.save(os.path.join(export_dir, name + '.pt'))
+
+
+def export_onnx(image_model, caption_model, export_dir, opset_version=14):
+    """
+    Write image.onnx, caption.onnx, matchmap.onnx and similarity.onnx to export_dir, with dynamic batch and sequence axes
+    """
+    os.makedirs(export_dir, exist_ok=True)
+    image_model.eval()
+    caption_model.eval()
+    image_tensor, caption_glove = example_inputs()
+    with torch.no_grad():
+        image_op = image_model(image_tensor)
+        caption_op = caption_model(caption_glove)
+
+        torch.onnx.export(image_model, image_tensor, os.path.join(export_dir, 'image.onnx'),
+                          input_names=['images'], output_names=['image_op'],
+                          dynamic_axes={'images': {0: 'batch'}, 'image_op': {0: 'batch'}},
+                          opset_version=opset_version)
+        torch.onnx.export(caption_model, caption_glove, os.path.join(export_dir, 'caption.onnx'),
+                          input_names=['captions'], output_names=['caption_op'],
+                          dynamic_axes={'captions': {0: 'batch', 1: 'sequence'},
+                                        'caption_op': {0: 'batch', 1: 'sequence'}},
+                          opset_version=opset_version)
+        torch.onnx.export(MatchmapHead(), (image_op, caption_op), os.path.join(export_dir, 'matchmap.onnx'),
+                          input_names=['image_op', 'caption_op'], output_names=['matchmaps'],
+                          dynamic_axes={'image_op': {0: 'batch'},
+                                        'caption_op': {0: 'batch', 1: 'sequence'},
+                                        'matchmaps': {0: 'batch', 1: 'sequence'}},
+                          opset_version=opset_version)
+        torch.onnx.export(SimilarityHead(), (image_op[:1], caption_op), os.path.join(export_dir, 'similarity.onnx'),
+                          input_names=['image_op', 'caption_op'], output_names=['sim_mat'],
+                          dynamic_axes={'image_op': {0: 'batch_img'},
+                                        'caption_op': {0: 'batch_cap', 1: 'sequence'},
+                                        'sim_mat': {0: 'batch_img', 1: 'batch_cap'}},
+                          opset_version=opset_version)
+
+
+class ExportedModels(object):
+    """
+    Run exported branches without the model classes or torchvision
+    :param export_dir: folder written by export.py
+    :param runtime: 'torchscript' or 'onnx' (needs onnxruntime)
+    """
+    def __init__(self, export_dir, runtime='torchscript'):
+        assert runtime in ['torchscript', 'onnx'], "runtime must be one of 'torchscript' or 'onnx'"
+        self.runtime = runtime
+        self.modules = dict()
+        for name in EXPORTED_MODULES:
+            if runtime == 'torchscript':
+                self.modules[name] = torch.jit.load(os.path.join(export_dir, name + '.pt'), map_location='cpu')
+            else:
+                import onnxruntime
+                self.modules[name] = onnxruntime.InferenceSession(os.path.join(export_dir, name + '.onnx'),
+                                                                  providers=['CPUExecutionProvider'])
+
+    def run(self, name, *inputs):
+        if self.runtime == 'torchscript':
+            with torch.no_grad():
+                return self.modules[name](*inputs)
+
+        session = self.modules[name]
+        feeds = {node.name: tensor.cpu().numpy() for node, tensor in zip(session.get_inputs(), inputs)}
+        outputs = [torch.from_numpy(output) for output in session.run(None, feeds)]
+        return outputs[0] if len(outputs) == 1 else tuple(outputs)
+
+    def image(self, image_tensor):
+        return self.run('image', image_tensor)
+
+    def caption(self, caption_glove):
+        return self.run('caption', caption_glove)
+
+    def matchmaps(self, image_op, caption_op):
+        """
+        :return: matchmaps of every image with its own caption, both batches have the same size
+        """
+        return self.run('matchmap', image_op, caption_op)
+
+    def similarity(self, image_op, caption_op):
+        """
+        :return: similarity matrix of every image with every caption
+        """
+        return self.run('similarity', image_op, caption_op)
+
+    def head(self, image_op, caption_op):
+        """
+        :return: matchmaps of every image with its own caption, similarity matrix
+        """
+        return self.matchmaps(image_op, caption_op), self.similarity(image_op, caption_op)
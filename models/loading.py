@@ -0,0 +1,40 @@
+import os
+import torch
+
+from .models import get_image_model, get_text_encoder
+from .quantization import quantized_models
+from .split_checkpoint import load_split_models
+
+
+def models_from_checkpoint(checkpoint):
+    """
+    Rebuild the image and caption models described by the metadata of a checkpoint and load its weights.
+    Checkpoints written before a setting was stored use its default.
+    :param checkpoint: dictionary loaded from a checkpoint file
+    :return: image model, caption model
+    """
+    text_encoder = checkpoint.get('text_encoder', 'lstm')
+    cnn_model = checkpoint.get('cnn_model', 'vgg')
+    embedding_dim = checkpoint.get('embedding_dim', 1024)
+    grid = checkpoint.get('grid', '14x14')
+    if checkpoint.get('quantized'):
+        # int8 checkpoint written by quantize.py, the models run on CPU only
+        image_model, caption_model = quantized_models(text_encoder, embedding_dim,
+                                                      engine=checkpoint['quantized'], grid=grid)
+    else:
+        # The checkpoint overwrites all weights, ImageNet weights are not loaded
+        image_model = get_image_model(cnn_model, embedding_dim, pretrained=False, grid=grid)
+        caption_model = get_text_encoder(text_encoder, op_size=embedding_dim)
+    image_model.load_state_dict(checkpoint['image_model'])
+    caption_model.load_state_dict(checkpoint['caption_model'])
+    return image_model, caption_model
+
+
+def load_models(model_path):
+    """
+    :param model_path: checkpoint file, or folder of a split checkpoint (see models/split_checkpoint.py)
+    :return: image model, caption model of a checkpoint
+    """
+    if os.path.isdir(model_path):
+        return load_split_models(model_path)
+    return models_from_checkpoint(torch.load(model_path, map_location='cpu'))
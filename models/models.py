@@ -1,78 +1,274 @@
+import contextlib
 import torch
 import torch.nn as nn
 from torch.autograd import Variable
 import torch.nn.functional as F
-import torchvision.models as imagemodels
-import torch.utils.model_zoo as model_zoo
+from torch.utils.checkpoint import checkpoint
 
+from .weight_store import load_weights
+
+
+# All text encoders map a B x T x ip_size batch of word embeddings to a
+# B x T x op_size batch of per-word embeddings.
 
 class LSTMBranch(nn.Module):
     def __init__(self, ip_size=300, op_size=1024):
         super(LSTMBranch, self).__init__()
 
-        # self.batch_size = batch_size
         self.ip_size = ip_size
         self.op_size = op_size
 
-        self.lstm = nn.LSTM(ip_size, op_size)
+        # batch_first keeps the B x T x D layout of the data loaders, no permutes or copies needed.
+        # Parameters are the same as the time-major LSTM, so older checkpoints still load.
+        self.lstm = nn.LSTM(ip_size, op_size, batch_first=True)
 
     def forward(self, ip_matrix, use_gpu=True):
-        ip_matrix = ip_matrix.permute(1, 0, 2)
-        ip_matrix.requires_grad = False
-        # h_0 = Variable(torch.zeros(1, self.batch_size, self.op_size))
-        # c_0 = Variable(torch.zeros(1, self.batch_size, self.op_size))
+        op, _ = self.lstm(ip_matrix)
+        return op
 
-        # # Move to GPU if CUDA is available
-        # if torch.cuda.is_available() and use_gpu:
-        #     h_0 = h_0.cuda()
-        #     c_0 = c_0.cuda()
 
-        op, _ = self.lstm(ip_matrix)
-        x1 = op.permute(1, 0, 2)
-        x = x1.contiguous()
+class GRUBranch(nn.Module):
+    def __init__(self, ip_size=300, op_size=1024):
+        super(GRUBranch, self).__init__()
 
-        norm = x.view(x.size(0), -1).norm(p=2, dim=1, keepdim=True)
-        x_normalized = x.view(x.size(0), -1).div(norm.expand_as(x.view(x.size(0), -1))).view(x.size())
+        self.ip_size = ip_size
+        self.op_size = op_size
 
-        return x1
+        self.gru = nn.GRU(ip_size, op_size, batch_first=True)
 
+    def forward(self, ip_matrix, use_gpu=True):
+        op, _ = self.gru(ip_matrix)
+        return op
 
-class VGG19(nn.Module):
-    def __init__(self, embedding_dim=1024, pretrained=True):
-        super(VGG19, self).__init__()
-        seed_model = imagemodels.__dict__['vgg19'](pretrained=pretrained).features
-        seed_model = nn.Sequential(*list(seed_model.children())[:-1])  # remove final maxpool
-        self.pre_mod = seed_model
-        self.c1 = nn.Conv2d(512, embedding_dim, kernel_size=(3, 3), stride=(1, 1), padding=(1, 1))
-        self.bn = nn.BatchNorm2d(embedding_dim)
-        self.rel = nn.ReLU(inplace=True)
 
-    def forward(self, x):
-        x = self.pre_mod(x)
-        x = self.c1(x)
-        x = self.bn(x)
-        x = self.rel(x)
+class ConvBranch(nn.Module):
+    """
+    Stack of 1D convolutions over time. All time steps are computed in parallel.
+    """
+    def __init__(self, ip_size=300, op_size=1024, kernel_size=3, n_layers=2):
+        super(ConvBranch, self).__init__()
 
-        # l2 normalization
-        norm = x.view(x.size(0), -1).norm(p=2, dim=1, keepdim=True)
-        x_normalized = x.view(x.size(0), -1).div(norm.expand_as(x.view(x.size(0), -1))).view(x.size())
+        self.ip_size = ip_size
+        self.op_size = op_size
+
+        layers = list()
+        in_channels = ip_size
+        for layer in range(n_layers):
+            layers.append(nn.Conv1d(in_channels, op_size, kernel_size, padding=kernel_size // 2))
+            if layer < n_layers - 1:
+                layers.append(nn.ReLU(inplace=True))
+            in_channels = op_size
+        self.conv = nn.Sequential(*layers)
+
+    def forward(self, ip_matrix, use_gpu=True):
+        op = self.conv(ip_matrix.transpose(1, 2))
+        return op.transpose(1, 2)
+
+
+class BagBranch(nn.Module):
+    """
+    Projection of each word plus a projection of the mean of the caption (bag of embeddings).
+    """
+    def __init__(self, ip_size=300, op_size=1024):
+        super(BagBranch, self).__init__()
+
+        self.ip_size = ip_size
+        self.op_size = op_size
+
+        self.word = nn.Linear(ip_size, op_size)
+        self.context = nn.Linear(ip_size, op_size, bias=False)
+
+    def forward(self, ip_matrix, use_gpu=True):
+        return self.word(ip_matrix) + self.context(ip_matrix.mean(1, keepdim=True))
+
+
+TEXT_ENCODERS = {'lstm': LSTMBranch,
+                 'gru': GRUBranch,
+                 'conv': ConvBranch,
+                 'bag': BagBranch}
 
-        return x
 
+def get_text_encoder(name='lstm', ip_size=300, op_size=1024):
+    """
+    Build a text encoder from its registry name
+    :param name: one of TEXT_ENCODERS
+    :return: text encoder producing B x T x op_size outputs
+    """
+    assert name in TEXT_ENCODERS, "Unknown text encoder '%s', use one of %s" % (name, list(TEXT_ENCODERS))
+    return TEXT_ENCODERS[name](ip_size=ip_size, op_size=op_size)
 
-class ResNet50(nn.Module):
-    def __init__(self, embedding_dim=1024, pretrained=True):
-        super(ResNet50, self).__init__()
-        seed_model = imagemodels.resnet50(pretrained=pretrained)
-        seed_model = nn.Sequential(*list(seed_model.children())[:-3])  # remove final maxpool
-        self.pre_mod = seed_model
-        self.c1 = nn.Conv2d(1024, embedding_dim, kernel_size=(3, 3), stride=(1, 1), padding=(1, 1))
+
+def feature_weights(arch, prefix):
+    """
+    ImageNet weights of the layers of a backbone under prefix, from the local weight store
+    """
+    return {key[len(prefix):]: value for key, value in load_weights(arch).items() if key.startswith(prefix)}
+
+
+def split_segments(layers, segments):
+    """
+    Split a list of layers into at most segments consecutive chunks of about the same length.
+    A chunk never starts with an in-place ReLU, which would overwrite the stored input of the chunk.
+    """
+    size = -(-len(layers) // segments)
+    chunks = list()
+    start = 0
+    while start < len(layers):
+        end = min(start + size, len(layers))
+        while end < len(layers) and isinstance(layers[end], nn.ReLU) and layers[end].inplace:
+            end += 1
+        chunks.append(nn.Sequential(*layers[start:end]))
+        start = end
+    return chunks
+
+
+@contextlib.contextmanager
+def frozen_batch_norm_stats(module):
+    """
+    Forward passes inside the context leave the running statistics of the batch norm layers of module
+    unchanged, for passes recomputing a batch whose statistics are already counted. The layers still
+    normalize with the statistics of the batch.
+    """
+    layers = [layer for layer in module.modules()
+              if isinstance(layer, nn.modules.batchnorm._BatchNorm) and layer.training and layer.track_running_stats]
+    saved = [[buffer.clone() for buffer in (layer.running_mean, layer.running_var, layer.num_batches_tracked)]
+             for layer in layers]
+    try:
+        yield
+    finally:
+        with torch.no_grad():
+            for layer, buffers in zip(layers, saved):
+                for buffer, value in zip((layer.running_mean, layer.running_var, layer.num_batches_tracked), buffers):
+                    buffer.copy_(value)
+
+
+def checkpointed_forward(sequential, x, segments=0):
+    """
+    Run a Sequential with segment-wise activation checkpointing. Only the input of each
+    segment is kept during the forward pass, activations inside a segment are recomputed
+    in the backward pass. Checkpointing is only used when training with gradients.
+    Batch norm running statistics are only updated by the forward pass, not by the recomputation.
+    :param segments: number of segments, 0 disables checkpointing
+    """
+    if segments < 1 or not (sequential.training and torch.is_grad_enabled()):
+        return sequential(x)
+
+    chunks = split_segments(list(sequential.children()), segments)
+    for chunk in chunks[:-1]:
+        x = checkpoint(chunk, x, use_reentrant=False,
+                       context_fn=lambda chunk=chunk: (contextlib.nullcontext(), frozen_batch_norm_stats(chunk)))
+    # Activations of the last segment are needed by the backward pass right away
+    return chunks[-1](x)
+
+
+# Input resolution of the image branch
+IMAGE_SIZE = 224
+
+# Spatial grid of the image embeddings. All backbones output 14 x 14 feature maps for 224 x 224 images
+# (see BACKBONES). A matchmap costs T x H x W x D per pair,
+# so 7 x 7 grids are 4 times cheaper. '7x7' average pools the trunk output, '7x7_learned' uses a
+# learned depthwise 2 x 2 projection. The grid is reduced before c1, which gets cheaper as well.
+GRIDS = ['14x14', '7x7', '7x7_learned']
+
+
+def grid_pool(grid, channels):
+    assert grid in GRIDS, "Unknown grid '%s', use one of %s" % (grid, GRIDS)
+    if grid == '7x7':
+        return nn.AvgPool2d(kernel_size=2)
+    elif grid == '7x7_learned':
+        return nn.Conv2d(channels, channels, kernel_size=2, stride=2, groups=channels)
+    return nn.Identity()
+
+
+class Backbone(object):
+    """
+    A torchvision classification network truncated at stride 16
+    :param arch: torchvision constructor, also the name of its weights in the weight store
+    :param channels: output channels of the truncated trunk, the input channels of c1
+    :param truncate: number of leading children of the network (or of its module) that are kept
+    :param module: attribute of the network holding the layers, e.g. 'features', '' for the network itself
+    :param build: function building the network instead of the torchvision constructor
+    """
+    def __init__(self, arch, channels, truncate, module='', build=None):
+        self.arch = arch
+        self.channels = channels
+        self.truncate = truncate
+        self.module = module
+        self.build = build
+
+    def trunk(self, pretrained=True):
+        """
+        :return: nn.Sequential of the kept layers, with ImageNet weights if pretrained
+        """
+        if self.build is not None:
+            network = self.build()
+        else:
+            # torchvision is only imported when a backbone is built
+            import torchvision.models as imagemodels
+            network = imagemodels.__dict__[self.arch]()
+        layers = getattr(network, self.module) if self.module else network
+        if pretrained:
+            layers.load_state_dict(feature_weights(self.arch, self.module + '.' if self.module else ''))
+        return nn.Sequential(*list(layers.children())[:self.truncate])
+
+
+def vgg19_network():
+    # Only the convolution stack is built, the 120M parameters of the classifier are never allocated
+    from torchvision.models.vgg import make_layers, cfgs
+    network = nn.Module()
+    network.features = make_layers(cfgs['E'])
+    return network
+
+
+# Names are stored as 'cnn_model' in checkpoints. All trunks output a 14 x 14 grid for 224 x 224 images.
+# resnet18 and mobilenet (MobileNetV3 large) are light student backbones for distillation.
+BACKBONES = {'vgg': Backbone('vgg19', 512, 36, 'features', build=vgg19_network),  # without the final maxpool
+             'resnet': Backbone('resnet50', 1024, 7),  # up to layer3
+             'resnet18': Backbone('resnet18', 256, 7),  # up to layer3
+             'mobilenet': Backbone('mobilenet_v3_large', 112, 13, 'features')}  # last blocks of stride 16
+
+
+# pretrained=True reads the ImageNet weights from the weight store (models/weight_store.py).
+# Use pretrained=False when a checkpoint is loaded afterwards, nothing is read or downloaded then.
+# checkpoint_segments > 0 trades recomputation for activation memory in the trunk, see checkpointed_forward.
+
+class ImageBranch(nn.Module):
+    def __init__(self, backbone='vgg', embedding_dim=1024, pretrained=True, checkpoint_segments=0, grid='14x14'):
+        super(ImageBranch, self).__init__()
+        assert backbone in BACKBONES, "Unknown image model '%s', use one of %s" % (backbone, list(BACKBONES))
+        self.backbone = backbone
+        self.checkpoint_segments = checkpoint_segments
+        self.grid = grid
+        channels = BACKBONES[backbone].channels
+        self.pre_mod = BACKBONES[backbone].trunk(pretrained)
+        self.pool = grid_pool(grid, channels)
+        self.c1 = nn.Conv2d(channels, embedding_dim, kernel_size=(3, 3), stride=(1, 1), padding=(1, 1))
         self.bn = nn.BatchNorm2d(embedding_dim)
         self.rel = nn.ReLU(inplace=True)
 
     def forward(self, x):
-        x = self.pre_mod(x)
+        x = checkpointed_forward(self.pre_mod, x, self.checkpoint_segments)
+        x = self.pool(x)
         x = self.c1(x)
         x = self.bn(x)
         x = self.rel(x)
-        return x
\ No newline at end of file
+        return x
+
+
+class VGG19(ImageBranch):
+    def __init__(self, embedding_dim=1024, pretrained=True, checkpoint_segments=0, grid='14x14'):
+        super(VGG19, self).__init__('vgg', embedding_dim, pretrained, checkpoint_segments, grid)
+
+
+class ResNet50(ImageBranch):
+    def __init__(self, embedding_dim=1024, pretrained=True, checkpoint_segments=0, grid='14x14'):
+        super(ResNet50, self).__init__('resnet', embedding_dim, pretrained, checkpoint_segments, grid)
+
+
+def get_image_model(name='vgg', embedding_dim=1024, pretrained=True, checkpoint_segments=0, grid='14x14'):
+    """
+    Build an image branch from its registry name
+    :param name: one of BACKBONES
+    :return: image model producing B x embedding_dim x H x W outputs
+    """
+    return ImageBranch(name, embedding_dim, pretrained, checkpoint_segments, grid)
@@ -0,0 +1,94 @@
+import warnings
+import torch
+import torch.nn as nn
+from torch.ao import quantization
+
+from .models import VGG19, get_text_encoder
+
+
+class QuantizableVGG19(VGG19):
+    """
+    VGG19 with quantization stubs around the convolution stack. After prepare and
+    convert the VGG layers run in int8, the embedding head (c1, bn, rel) stays in float32.
+    """
+    def __init__(self, embedding_dim=1024, pretrained=False, grid='14x14'):
+        super(QuantizableVGG19, self).__init__(embedding_dim=embedding_dim, pretrained=pretrained, grid=grid)
+        self.quant = quantization.QuantStub()
+        self.dequant = quantization.DeQuantStub()
+
+    def forward(self, x):
+        x = self.quant(x)
+        x = self.pre_mod(x)
+        x = self.dequant(x)
+        x = self.pool(x)
+        x = self.c1(x)
+        x = self.bn(x)
+        x = self.rel(x)
+        return x
+
+    def fuse_model(self):
+        # Every convolution of the VGG stack is followed by a ReLU
+        layers = list(self.pre_mod.named_children())
+        pairs = [[name, next_name] for (name, layer), (next_name, next_layer) in zip(layers, layers[1:])
+                 if isinstance(layer, nn.Conv2d) and isinstance(next_layer, nn.ReLU)]
+        quantization.fuse_modules(self.pre_mod, pairs, inplace=True)
+
+
+def prepare_image_model(image_model, engine=None):
+    """
+    Copy a float32 VGG19 into a QuantizableVGG19 with fused layers and observers
+    :param image_model: trained VGG19
+    :param engine: quantized backend, the current torch.backends.quantized.engine by default
+    :return: model to be calibrated, then converted
+    """
+    assert image_model.backbone == 'vgg', "Static quantization is only implemented for VGG19"
+    if engine is not None:
+        torch.backends.quantized.engine = engine
+    model = QuantizableVGG19(embedding_dim=image_model.c1.out_channels, grid=image_model.grid)
+    model.load_state_dict(image_model.state_dict())
+    model.eval()
+    model.fuse_model()
+
+    qconfig = quantization.get_default_qconfig(torch.backends.quantized.engine)
+    for module in [model.quant, model.pre_mod, model.dequant]:
+        module.qconfig = qconfig
+    quantization.prepare(model, inplace=True)
+    return model
+
+
+def quantize_image_model(image_model, calibration_images, engine=None):
+    """
+    Static int8 quantization of the VGG19 convolution stack
+    :param calibration_images: iterable of image batches used to fit the activation ranges
+    :return: quantized image model, runs on CPU only
+    """
+    model = prepare_image_model(image_model, engine)
+    with torch.no_grad():
+        for image_tensor in calibration_images:
+            model(image_tensor)
+    return quantization.convert(model, inplace=True)
+
+
+def quantize_caption_model(caption_model):
+    """
+    Dynamic int8 quantization of the recurrent and linear layers of a text encoder.
+    Weights are stored in int8, activations are quantized on the fly.
+    """
+    return quantization.quantize_dynamic(caption_model, {nn.LSTM, nn.GRU, nn.Linear}, dtype=torch.qint8)
+
+
+def quantized_models(text_encoder='lstm', embedding_dim=1024, engine=None, grid='14x14'):
+    """
+    Empty int8 models with the layout of a quantized checkpoint, to load its state dicts into
+    :param text_encoder: name of the text encoder of the checkpoint
+    :param engine: quantized backend the checkpoint was converted with
+    :param grid: spatial grid of the image embeddings, one of GRIDS
+    :return: image model, caption model
+    """
+    with warnings.catch_warnings():
+        # Observers are never run here, their ranges come from the checkpoint
+        warnings.simplefilter('ignore')
+        image_model = quantization.convert(prepare_image_model(VGG19(embedding_dim, pretrained=False, grid=grid),
+                                                               engine))
+    caption_model = quantize_caption_model(get_text_encoder(text_encoder, op_size=embedding_dim))
+    return image_model, caption_model
@@ -0,0 +1,152 @@
+"""Inference checkpoints with one memory-mapped weight file per branch."""
+import os
+import json
+import time
+import struct
+import argparse
+import torch
+
+from .models import get_image_model, get_text_encoder
+
+# Files use the safetensors layout: an 8 byte little endian header size, a JSON header with the
+# dtype, shape and byte range of every tensor plus string metadata, then the raw tensor data.
+DTYPES = {'F64': torch.float64, 'F32': torch.float32, 'F16': torch.float16, 'BF16': torch.bfloat16,
+          'I64': torch.int64, 'I32': torch.int32, 'I16': torch.int16, 'I8': torch.int8,
+          'U8': torch.uint8, 'BOOL': torch.bool}
+DTYPE_NAMES = {dtype: name for name, dtype in DTYPES.items()}
+
+BRANCHES = ['image_model', 'caption_model']
+
+
+def save_tensors(tensors, filename, metadata=None):
+    """
+    Write a dict of tensors in the safetensors layout. Tensors are ordered by decreasing element size,
+    so every tensor of the file can be memory-mapped at an aligned offset.
+    :param metadata: dict of strings stored in the header
+    """
+    names = sorted(tensors, key=lambda name: (-tensors[name].element_size(), name))
+    header = dict()
+    blobs = list()
+    offset = 0
+    for name in names:
+        tensor = tensors[name].detach().cpu().contiguous()
+        blob = tensor.reshape(-1).view(torch.uint8).numpy().tobytes()
+        header[name] = {'dtype': DTYPE_NAMES[tensor.dtype], 'shape': list(tensor.shape),
+                        'data_offsets': [offset, offset + len(blob)]}
+        blobs.append(blob)
+        offset += len(blob)
+    if metadata:
+        header['__metadata__'] = {key: str(value) for key, value in metadata.items()}
+
+    header = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    # Padding keeps the data aligned to 8 bytes
+    header += b' ' * (-len(header) % 8)
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'wb') as f:
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for blob in blobs:
+            f.write(blob)
+    os.replace(tmp_filename, filename)
+
+
+def load_tensors(filename):
+    """
+    Memory-map a file written by save_tensors. Tensors share the pages of the file (copy on write),
+    so processes loading the same file share one copy in the page cache.
+    :return: dict of tensors, metadata dict
+    """
+    with open(filename, 'rb') as f:
+        header_size = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(header_size).decode('utf-8'))
+    metadata = header.pop('__metadata__', dict())
+
+    storage = torch.UntypedStorage.from_file(filename, shared=False, nbytes=os.path.getsize(filename))
+    data = torch.empty(0, dtype=torch.uint8).set_(storage)
+    data_start = 8 + header_size
+
+    tensors = dict()
+    for name, info in header.items():
+        start, end = info['data_offsets']
+        dtype = DTYPES[info['dtype']]
+        tensor = data[data_start + start:data_start + end]
+        if (data_start + start) % torch.empty(0, dtype=dtype).element_size():
+            # Files from other writers may not be aligned, these tensors are copied
+            tensor = tensor.clone()
+        tensors[name] = tensor.view(dtype).reshape(info['shape'])
+    return tensors, metadata
+
+
+def save_split_checkpoint(checkpoint, directory, score_type='Avg_Both'):
+    """
+    Write the two branches of a training checkpoint as directory/image_model.safetensors and
+    directory/caption_model.safetensors. Each file holds the settings needed to rebuild its branch.
+    :param checkpoint: dictionary loaded from a checkpoint file
+    :param score_type: score type the models were trained with
+    """
+    assert not checkpoint.get('quantized'), "int8 checkpoints hold packed weights, they cannot be split"
+    os.makedirs(directory, exist_ok=True)
+    metadata = {'text_encoder': checkpoint.get('text_encoder', 'lstm'),
+                'cnn_model': checkpoint.get('cnn_model', 'vgg'),
+                'embedding_dim': checkpoint.get('embedding_dim', 1024),
+                'grid': checkpoint.get('grid', '14x14'),
+                'score_type': score_type}
+    for branch in BRANCHES:
+        save_tensors(checkpoint[branch], os.path.join(directory, branch + '.safetensors'),
+                     dict(metadata, branch=branch))
+
+
+def load_branch(directory, branch):
+    """
+    Build one branch of a split checkpoint on its memory-mapped weights. The model is built without
+    allocating weights, its parameters are the mapped tensors.
+    :param branch: 'image_model' or 'caption_model'
+    :return: model in eval mode, metadata dict (text_encoder, cnn_model, embedding_dim, grid, score_type)
+    """
+    assert branch in BRANCHES, "Unknown branch '%s', use one of %s" % (branch, BRANCHES)
+    tensors, metadata = load_tensors(os.path.join(directory, branch + '.safetensors'))
+    metadata['embedding_dim'] = int(metadata['embedding_dim'])
+    with torch.device('meta'):
+        if branch == 'image_model':
+            model = get_image_model(metadata['cnn_model'], metadata['embedding_dim'], pretrained=False,
+                                    grid=metadata['grid'])
+        else:
+            model = get_text_encoder(metadata['text_encoder'], op_size=metadata['embedding_dim'])
+    model.load_state_dict(tensors, assign=True)
+    return model.eval(), metadata
+
+
+def load_split_models(directory):
+    """
+    :return: image model, caption model of a split checkpoint
+    """
+    image_model, _ = load_branch(directory, 'image_model')
+    caption_model, _ = load_branch(directory, 'caption_model')
+    return image_model, caption_model
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('model_path', type=str,
+                        help='training checkpoint to split')
+    parser.add_argument('directory', type=str,
+                        help='folder of the split checkpoint')
+    parser.add_argument('--score_type', default='Avg_Both', type=str,
+                        help='score type stored with the models')
+    args = parser.parse_args()
+
+    from .loading import load_models
+    save_split_checkpoint(torch.load(args.model_path, map_location='cpu'), args.directory, args.score_type)
+
+    start = time.perf_counter()
+    load_models(args.model_path)
+    full_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    load_split_models(args.directory)
+    split_time = time.perf_counter() - start
+    start = time.perf_counter()
+    load_branch(args.directory, 'caption_model')
+    caption_time = time.perf_counter() - start
+    print("Saved to %s. Loading time, full checkpoint: %0.3fs, split models: %0.3fs, caption model only: %0.3fs" % (
+        args.directory, full_time, split_time, caption_time))
@@ -0,0 +1,119 @@
+"""Local, content-hashed store of the ImageNet backbone weights."""
+import os
+import sys
+import json
+import hashlib
+import argparse
+import shutil
+import tempfile
+import torch
+
+# Like the torchvision model zoo, files are named <arch>-<first 8 hex digits of their sha256>.pth
+WEIGHT_STORE = os.environ.get('LOCNET_WEIGHT_STORE', os.path.join('saved_models', 'weights'))
+# Stored files are checked against their sha256 when loaded, unless LOCNET_VERIFY_WEIGHTS=0
+VERIFY_WEIGHTS = os.environ.get('LOCNET_VERIFY_WEIGHTS', '1') != '0'
+
+
+def file_sha256(filename):
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_index(store=WEIGHT_STORE):
+    index_file = os.path.join(store, 'index.json')
+    if not os.path.exists(index_file):
+        return dict()
+    return json.load(open(index_file, encoding='utf-8', mode='r'))
+
+
+def add_weights(arch, filename, store=WEIGHT_STORE):
+    """
+    Copy a state dict file into the store under its content hash
+    :param arch: torchvision architecture name, e.g. 'vgg19' or 'resnet50'
+    :param filename: file written with torch.save(model.state_dict())
+    :return: path of the stored file
+    """
+    os.makedirs(store, exist_ok=True)
+    sha256 = file_sha256(filename)
+    stored_name = '%s-%s.pth' % (arch, sha256[:8])
+    stored_file = os.path.join(store, stored_name)
+    if not os.path.exists(stored_file):
+        shutil.copyfile(filename, stored_file + '.tmp')
+        os.replace(stored_file + '.tmp', stored_file)
+
+    index = load_index(store)
+    index[arch] = {'file': stored_name, 'sha256': sha256}
+    with open(os.path.join(store, 'index.json.tmp'), 'w') as f:
+        json.dump(index, f, indent=2)
+    os.replace(os.path.join(store, 'index.json.tmp'), os.path.join(store, 'index.json'))
+    return stored_file
+
+
+def fetch_weights(arch, store=WEIGHT_STORE):
+    """
+    Download the ImageNet weights of arch from the torchvision model zoo into the store.
+    Run this once on a machine with network access, then copy the store folder.
+    """
+    import torchvision.models as imagemodels
+    model = imagemodels.__dict__[arch](weights=imagemodels.get_model_weights(arch).DEFAULT)
+    with tempfile.TemporaryDirectory() as folder:
+        filename = os.path.join(folder, arch + '.pth')
+        torch.save(model.state_dict(), filename)
+        return add_weights(arch, filename, store)
+
+
+def load_weights(arch, store=WEIGHT_STORE, verify=VERIFY_WEIGHTS, download=False):
+    """
+    ImageNet state dict of a backbone. Weights missing from the store are an error, nothing is downloaded
+    unless download is set.
+    :param arch: torchvision architecture name
+    :param verify: check the full sha256 of the stored file, not only that it is indexed
+    :param download: fetch the weights from the model zoo if they are not in the store
+    :return: state dict
+    """
+    index = load_index(store)
+    stored_file = os.path.join(store, index[arch]['file']) if arch in index else None
+    if stored_file is None or not os.path.exists(stored_file):
+        if not download:
+            raise FileNotFoundError("No '%s' weights in the store at '%s'. Run 'python -m models.weight_store fetch %s' "
+                                    "on a machine with network access and copy the store." % (arch, store, arch))
+        print("'%s' weights are not in the store, downloading them to '%s'" % (arch, store))
+        fetch_weights(arch, store)
+        index = load_index(store)
+        stored_file = os.path.join(store, index[arch]['file'])
+
+    if verify:
+        assert file_sha256(stored_file) == index[arch]['sha256'], \
+            "'%s' does not match its hash, fetch or add the '%s' weights again" % (stored_file, arch)
+    return torch.load(stored_file, map_location='cpu')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('command', choices=['fetch', 'add', 'verify'],
+                        help='fetch: download from the model zoo, add: store a local state dict file, '
+                             'verify: check the hashes of the stored files')
+    parser.add_argument('arch', nargs='*', default=['vgg19', 'resnet50'],
+                        help='architectures to fetch or verify')
+    parser.add_argument('--file', default='', type=str,
+                        help='state dict file stored by the add command')
+    parser.add_argument('--store', default=WEIGHT_STORE, type=str,
+                        help='weight store folder, also set through LOCNET_WEIGHT_STORE')
+    args = parser.parse_args()
+
+    if args.command == 'fetch':
+        for arch in args.arch:
+            print(arch, '->', fetch_weights(arch, args.store))
+    elif args.command == 'add':
+        assert len(args.arch) == 1 and args.file, "add takes one architecture and --file"
+        print(args.arch[0], '->', add_weights(args.arch[0], args.file, args.store))
+    else:
+        index = load_index(args.store)
+        failed = [arch for arch in args.arch
+                  if arch not in index or file_sha256(os.path.join(args.store, index[arch]['file'])) != index[arch]['sha256']]
+        for arch in args.arch:
+            print(arch, 'FAILED' if arch in failed else 'ok')
+        sys.exit(1 if failed else 0)
@@ -0,0 +1,153 @@
+"""Post-training int8 quantization of a trained checkpoint, with accuracy and speed against float32."""
+import argparse
+import os
+import time
+from statistics import mean
+
+import torch
+import torch.utils.data as data
+from torchvision import transforms
+
+from dataloader import get_loader_coco, get_loader_flickr, get_loader_genome
+from models import quantize_image_model, quantize_caption_model
+from steps.utils import calc_recalls
+from visualizations import FlickrViz, get_models
+
+parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+parser.add_argument('--model_path', required=True, type=str,
+                    help='float32 checkpoint to quantize')
+
+parser.add_argument('--output', default='', type=str,
+                    help='quantized checkpoint (default: model_path with an _int8 suffix)')
+
+parser.add_argument('--dataset', default='flickr', type=str,
+                    help='Which Dataset to calibrate and evaluate on')
+
+parser.add_argument('--parse_mode', default='phrase', type=str,
+                    help='If its the flickr dataset, parsing mode needs to be specified.')
+
+parser.add_argument('--manifest', default='default', type=str,
+                    help='Split manifest used to resolve the flickr folds.')
+
+parser.add_argument('--engine', default=torch.backends.quantized.engine, type=str,
+                    help='quantized backend, x86 or fbgemm on Intel and AMD, qnnpack on ARM')
+
+parser.add_argument('--calibration_images', default=256, type=int,
+                    help='number of training images used to fit the activation ranges')
+
+parser.add_argument('-b', '--batch_size', default=32, type=int,
+                    help='mini-batch size of calibration and recall batches (at least 10)')
+
+parser.add_argument('--eval_batches', default=10, type=int,
+                    help='number of validation batches the recalls are averaged over')
+
+parser.add_argument('--pointing_game', default=1000, type=int,
+                    help='number of flickr test images of the pointing game, 0 skips it')
+
+transform = transforms.Compose([
+    transforms.Resize((224, 224)),
+    transforms.ToTensor(),
+    transforms.Normalize((0.485, 0.456, 0.406),
+                         (0.229, 0.224, 0.225))])
+
+
+def get_loader(args, mode):
+    if args.dataset == 'flickr':
+        return get_loader_flickr(transform=transform, mode=mode, batch_size=args.batch_size,
+                                 parse_mode=args.parse_mode, manifest=args.manifest)
+    elif args.dataset == 'coco':
+        return get_loader_coco(transform=transform, mode=mode, batch_size=args.batch_size)
+    # Visual genome only has a training fold
+    return get_loader_genome(transform=transform, mode='train', batch_size=args.batch_size)
+
+
+def sample_batches(data_loader, n_batches):
+    """
+    Draw random batches the same way train() does, by resampling the indices of the batch sampler
+    :return: generator of (image tensor, caption glove tensor)
+    """
+    for _ in range(n_batches):
+        indices = data_loader.dataset.get_indices()
+        data_loader.batch_sampler.sampler = data.sampler.SubsetRandomSampler(indices=indices)
+        batch = next(iter(data_loader))
+        yield batch[0], batch[1]
+
+
+def forward_time(image_model, caption_model, batches):
+    """
+    :return: mean time in seconds of a forward pass of both branches over a batch
+    """
+    times = list()
+    with torch.no_grad():
+        for image_tensor, caption_glove in batches:
+            start = time.perf_counter()
+            image_model(image_tensor)
+            caption_model(caption_glove)
+            times.append(time.perf_counter() - start)
+    return mean(times)
+
+
+def recalls(image_model, caption_model, batches):
+    """
+    :return: dictionary of recall scores averaged over the batches
+    """
+    scores = list()
+    with torch.no_grad():
+        for image_tensor, caption_glove in batches:
+            scores.append(calc_recalls(image_model(image_tensor), caption_model(caption_glove), 'Avg_Both'))
+    return {key: mean(score[key] for score in scores) for key in scores[0]}
+
+
+def pointing_game(model_path, args):
+    processor = FlickrViz(batch_size=20, parse_mode=args.parse_mode, model_path=model_path,
+                          eval_mode=True, manifest=args.manifest)
+    n_images = min(args.pointing_game, len(processor.dataset))
+    score, _ = processor.loc_eval(n_images)
+    return score
+
+
+def main(args):
+    output = args.output or os.path.splitext(args.model_path)[0] + '_int8.pth.tar'
+    checkpoint = torch.load(args.model_path, map_location='cpu')
+    assert not checkpoint.get('quantized'), "'%s' is already quantized" % args.model_path
+    image_model, caption_model = get_models(args.model_path)
+    image_model.eval()
+    caption_model.eval()
+
+    print("========================================================")
+    print("Quantizing '%s' with the %s backend" % (args.model_path, args.engine))
+    n_batches = max(1, args.calibration_images // args.batch_size)
+    calibration = (image_tensor for image_tensor, _ in sample_batches(get_loader(args, 'train'), n_batches))
+    image_model_int8 = quantize_image_model(image_model, calibration, args.engine)
+    caption_model_int8 = quantize_caption_model(caption_model)
+
+    checkpoint['image_model'] = image_model_int8.state_dict()
+    checkpoint['caption_model'] = caption_model_int8.state_dict()
+    checkpoint['quantized'] = args.engine
+    torch.save(checkpoint, output)
+    print("Saved quantized checkpoint to ", output)
+    print("========================================================")
+
+    # Both models are evaluated on the same batches
+    batches = list(sample_batches(get_loader(args, 'val'), args.eval_batches))
+    time_fp32 = forward_time(image_model, caption_model, batches)
+    time_int8 = forward_time(image_model_int8, caption_model_int8, batches)
+    print("Forward pass fp32: %0.3fs  int8: %0.3fs  speedup: %0.2fx" % (time_fp32, time_int8, time_fp32 / time_int8))
+
+    recalls_fp32 = recalls(image_model, caption_model, batches)
+    recalls_int8 = recalls(image_model_int8, caption_model_int8, batches)
+    for key in sorted(recalls_fp32):
+        print("%-6s fp32: %0.3f  int8: %0.3f  delta: %+0.3f" % (
+            key, recalls_fp32[key], recalls_int8[key], recalls_int8[key] - recalls_fp32[key]))
+
+    if args.dataset == 'flickr' and args.pointing_game > 0:
+        score_fp32 = pointing_game(args.model_path, args)
+        score_int8 = pointing_game(output, args)
+        print("Pointing game fp32: %0.4f  int8: %0.4f  delta: %+0.4f" % (score_fp32, score_int8, score_int8 - score_fp32))
+    print("========================================================")
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    main(args)
@@ -1,2 +1,8 @@
 from .utils import *
-from .models_train import *
\ No newline at end of file
+from .models_train import *
+from .distill import *
+from .distributed import *
+from .checkpointing import *
+from .profiling import *
+from .metrics import *
+from .async_validation import *
\ No newline at end of file
@@ -0,0 +1,123 @@
+import os
+import json
+import time
+import collections
+import multiprocessing
+import torch
+
+from models import models_from_checkpoint
+from dataloader import epoch_loader
+from .utils import *
+from .checkpointing import atomic_link
+from .metrics import MetricsWriter
+
+# Order of the validation batches, the same for every checkpoint
+VALIDATION_SEED = 0
+
+
+def validate_split(image_model, caption_model, data_loader, loss_type, score_type, sampler, margin,
+                   device, precision='fp32'):
+    """
+    Loss and recalls averaged over every batch of a whole split, instead of the 10 random batches of validate().
+    Recalls rank the batch_size images and captions of each batch, like validate().
+    :param data_loader: loader of epoch_loader, its batches are the same for every call
+    :return: dict of loss, C_r1, C_r5, C_r10, I_r1, I_r5, I_r10
+    """
+    image_model.to(device).eval()
+    caption_model.to(device).eval()
+    totals = collections.defaultdict(float)
+    n_batches = 0
+    with torch.no_grad(), autocast_context(precision, device.type):
+        for batch in data_loader:
+            image_output = image_model(batch[0].to(device))
+            caption_output = caption_model(batch[1].to(device))
+            if loss_type == 'triplet':
+                loss = custom_loss(image_output, caption_output, score_type, margin, sampler)
+            elif loss_type == 'npairs':
+                loss = npairs_loss(image_output, caption_output, score_type)
+            totals['loss'] += float(loss)
+            for key, value in calc_recalls(image_output, caption_output, score_type).items():
+                totals[key] += value
+            n_batches += 1
+    return {key: value / max(n_batches, 1) for key, value in totals.items()}
+
+
+def validation_worker(directory, make_loader, total_train_step, loss_type, score_type, sampler, margin,
+                      log_dir, metrics, threads=2, use_gpu=False, precision='fp32', poll_interval=10.0,
+                      stop=None):
+    """
+    Validate every new checkpoint.pth.tar of directory, until stop is set and the last checkpoint is validated.
+    Results are logged under the training step of the checkpoint and appended to directory/validation.json.
+    The best checkpoint is linked to model_best.pth.tar.
+    :param make_loader: function returning the validation data loader
+    :param total_train_step: number of steps per epoch, to compute the training step of a checkpoint
+    """
+    parent = os.getppid()
+    if hasattr(os, 'nice'):
+        # Training keeps priority over validation
+        os.nice(10)
+    torch.set_num_threads(threads)
+    device = torch.device('cuda' if torch.cuda.is_available() and use_gpu else 'cpu')
+    data_loader = epoch_loader(make_loader(), VALIDATION_SEED)
+    writer = MetricsWriter(os.path.join(log_dir, 'validation'), metrics)
+
+    checkpoint_file = os.path.join(directory, 'checkpoint.pth.tar')
+    validating_file = os.path.join(directory, 'validating.pth.tar')
+    results_file = os.path.join(directory, 'validation.json')
+    results = json.load(open(results_file)) if os.path.exists(results_file) else list()
+    best_loss = min([result['loss'] for result in results], default=float('inf'))
+    last_version = None
+
+    # Stops as well when training died without setting stop
+    while os.getppid() == parent:
+        stopping = stop is not None and stop.is_set()
+        version = None
+        if os.path.exists(checkpoint_file):
+            stat = os.stat(checkpoint_file)
+            # Checkpoints are replaced by a rename, a new checkpoint is a new file
+            version = (stat.st_ino, stat.st_mtime_ns)
+        if version is None or version == last_version:
+            if stopping:
+                break
+            time.sleep(poll_interval)
+            continue
+        last_version = version
+
+        # The link keeps the validated version, while training goes on replacing checkpoint.pth.tar
+        atomic_link(checkpoint_file, validating_file)
+        checkpoint = torch.load(validating_file, map_location='cpu')
+        image_model, caption_model = models_from_checkpoint(checkpoint)
+        step = checkpoint['epoch'] * total_train_step + checkpoint.get('step', 0)
+        del checkpoint
+
+        start = time.time()
+        result = validate_split(image_model, caption_model, data_loader, loss_type, score_type, sampler, margin,
+                                device, precision)
+        for key, value in result.items():
+            writer.add_scalar('async_val/' + key, value, step)
+        result.update(step=step, seconds=time.time() - start)
+        results.append(result)
+        with open(results_file + '.tmp', 'w') as f:
+            json.dump(results, f, indent=1)
+        os.replace(results_file + '.tmp', results_file)
+
+        is_best = result['loss'] < best_loss
+        print("Validated step %d in %0.0fs: loss %0.4f, caption R@10 %0.3f, image R@10 %0.3f%s" % (
+            step, result['seconds'], result['loss'], result['C_r10'], result['I_r10'], ', best' if is_best else ''))
+        if is_best:
+            best_loss = result['loss']
+            atomic_link(validating_file, os.path.join(directory, 'model_best.pth.tar'))
+    writer.close()
+
+
+def start_validation_process(*args, **kwargs):
+    """
+    Run validation_worker in a separate process
+    :return: process, event stopping the worker once it has validated the last checkpoint
+    """
+    context = multiprocessing.get_context('spawn')
+    stop = context.Event()
+    # Not a daemon, the worker starts data loader workers of its own
+    process = context.Process(target=validation_worker, args=args, kwargs=dict(kwargs, stop=stop))
+    process.start()
+    return process, stop
@@ -0,0 +1,122 @@
+import os
+import glob
+import queue
+import shutil
+import threading
+import torch
+
+
+def snapshot(state):
+    """
+    Copy of a checkpoint with every tensor copied to the CPU, so training can go on
+    while the copy is written
+    """
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return type(state)((key, snapshot(value)) for key, value in state.items())
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(value) for value in state)
+    return state
+
+
+def atomic_save(state, filename):
+    # A crash while writing leaves the previous file in place, never a truncated one
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'wb') as f:
+        torch.save(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_filename, filename)
+
+
+def atomic_link(filename, link_name):
+    """
+    Make link_name point to the content of filename. Replacing filename later leaves link_name unchanged.
+    Falls back to a copy on file systems without hard links.
+    """
+    tmp_name = link_name + '.tmp'
+    if os.path.exists(tmp_name):
+        os.remove(tmp_name)
+    try:
+        os.link(filename, tmp_name)
+    except OSError:
+        shutil.copyfile(filename, tmp_name)
+    os.replace(tmp_name, link_name)
+
+
+class CheckpointWriter(object):
+    """
+    Writes checkpoints in a background thread. save() only blocks for the copy of the
+    tensors to the CPU, and when the previous checkpoint is still waiting to be written.
+    Files of the directory:
+    checkpoint.pth.tar, the last checkpoint.
+    model_best.pth.tar, a hard link to the best checkpoint.
+    checkpoint_<epoch>.pth.tar, hard links to the checkpoints of the last keep epochs.
+    :param directory: folder of the checkpoints, created if needed
+    :param keep: number of epoch checkpoints kept, 0 keeps none
+    """
+    def __init__(self, directory, keep=0):
+        self.directory = directory
+        self.keep = keep
+        self.error = None
+        os.makedirs(directory, exist_ok=True)
+        # At most one checkpoint waits while another one is written
+        self.queue = queue.Queue(maxsize=1)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def path(self, filename):
+        return os.path.join(self.directory, filename)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            try:
+                self.write(*item)
+            except Exception as error:
+                self.error = error
+            self.queue.task_done()
+
+    def write(self, state, is_best, epoch):
+        filename = self.path('checkpoint.pth.tar')
+        atomic_save(state, filename)
+        print("Saved Checkpoint!")
+
+        if is_best:
+            print("Best Model found ! ")
+            atomic_link(filename, self.path('model_best.pth.tar'))
+
+        if epoch is not None and self.keep > 0:
+            atomic_link(filename, self.path('checkpoint_%d.pth.tar' % epoch))
+            epoch_files = sorted(glob.glob(self.path('checkpoint_*.pth.tar')),
+                                 key=lambda name: int(name[:-len('.pth.tar')].rsplit('_', 1)[1]))
+            for old_file in epoch_files[:-self.keep]:
+                os.remove(old_file)
+
+    def check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("Writing a checkpoint to '%s' failed" % self.directory) from error
+
+    def save(self, state, is_best=False, epoch=None):
+        """
+        :param state: checkpoint dict, snapshotted before returning
+        :param is_best: also make it model_best.pth.tar
+        :param epoch: end of epoch checkpoint, kept as checkpoint_<epoch>.pth.tar if keep > 0
+        """
+        self.check()
+        self.queue.put((snapshot(state), is_best, epoch))
+
+    def wait(self):
+        # Block until every saved checkpoint is on disk
+        self.queue.join()
+        self.check()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.check()
@@ -0,0 +1,99 @@
+import time
+import torch
+import torch.nn.functional as F
+
+from models import MatchmapHead, SimilarityHead
+from .utils import *
+from .models_train import writer
+
+
+def standardize(x, dim):
+    # Teacher and student embeddings have different scales, distributions are compared on standardized logits
+    return (x - x.mean(dim, keepdim=True)) / (x.std(dim, keepdim=True) + 1e-6)
+
+
+def matchmap_distill_loss(teacher_maps, student_maps, temperature=1.0):
+    """
+    KL divergence between the spatial distributions of the matchmap of every word
+    :param teacher_maps: B x T x H x W matchmaps of every image with its own caption
+    :param student_maps: B x T x H' x W' student matchmaps, teacher maps are pooled to a smaller student grid
+    :return: loss averaged over images and words
+    """
+    if teacher_maps.shape[2:] != student_maps.shape[2:]:
+        teacher_maps = F.adaptive_avg_pool2d(teacher_maps, student_maps.shape[2:])
+    teacher = F.softmax(standardize(teacher_maps.flatten(2), 2) / temperature, dim=2)
+    student = F.log_softmax(standardize(student_maps.flatten(2), 2) / temperature, dim=2)
+    return F.kl_div(student, teacher, reduction='batchmean') / teacher_maps.size(1) * temperature ** 2
+
+
+def similarity_distill_loss(teacher_sim, student_sim, temperature=1.0):
+    """
+    KL divergence between the caption retrieval (rows) and image retrieval (columns)
+    distributions of the teacher and student similarity matrices
+    """
+    loss = 0
+    for dim in [1, 0]:
+        teacher = F.softmax(standardize(teacher_sim, dim) / temperature, dim=dim)
+        student = F.log_softmax(standardize(student_sim, dim) / temperature, dim=dim)
+        loss = loss + F.kl_div(student, teacher, reduction='sum') / teacher_sim.size(1 - dim)
+    return loss / 2 * temperature ** 2
+
+
+def distill(data_loader_train, teacher_image_model, teacher_caption_model,
+            image_model, caption_model, optimizer, epoch, total_train_step,
+            use_gpu=False, temperature=1.0, matchmap_weight=1.0, similarity_weight=1.0,
+            precision='fp32', channels_last=False, start_step=1, start_loss=0.0,
+            checkpoint_interval=0, save_state=None):
+    """
+    Trains the student models for 1 Epoch against a frozen teacher. Batches, resuming and
+    mid-epoch checkpoints work as in train().
+    """
+    losses = AverageMeter()
+    total_loss = start_loss
+    matchmap_head, similarity_head = MatchmapHead(), SimilarityHead()
+    last_checkpoint = time.time()
+
+    teacher_image_model.eval()
+    teacher_caption_model.eval()
+
+    i_step = start_step - 1
+    for i_step, batch in enumerate(data_loader_train, start=start_step):
+        image_model.train()
+        caption_model.train()
+
+        image_ip, caption_glove_ip = batch[0], batch[1]
+
+        if torch.cuda.is_available() and use_gpu == True:
+            image_ip = image_ip.cuda()
+            caption_glove_ip = caption_glove_ip.cuda()
+        image_ip = to_channels_last(image_ip, channels_last)
+
+        with torch.no_grad(), autocast_context(precision, image_ip.device.type):
+            teacher_image_op, teacher_caption_op = teacher_image_model(image_ip), teacher_caption_model(caption_glove_ip)
+            teacher_maps = matchmap_head(teacher_image_op, teacher_caption_op)
+            teacher_sim = similarity_head(teacher_image_op, teacher_caption_op)
+
+        with autocast_context(precision, image_ip.device.type):
+            image_op, caption_op = image_model(image_ip), caption_model(caption_glove_ip)
+            student_maps = matchmap_head(image_op, caption_op)
+            student_sim = similarity_head(image_op, caption_op)
+
+        loss = (matchmap_weight * matchmap_distill_loss(teacher_maps.float(), student_maps.float(), temperature) +
+                similarity_weight * similarity_distill_loss(teacher_sim.float(), student_sim.float(), temperature))
+
+        optimizer.zero_grad()
+        total_loss += loss.item()
+        loss.backward()
+        optimizer.step()
+
+        losses.update(loss.item(), image_ip.size(0))
+        niter = epoch * total_train_step + i_step
+        writer.add_scalar('data/distill_loss', losses.val, niter)
+
+        print("Step: %d/%d, current loss: %0.4f, avg_loss: %0.4f" % (i_step, total_train_step, loss, total_loss / i_step))
+
+        if save_state is not None and checkpoint_interval > 0 and time.time() - last_checkpoint > checkpoint_interval:
+            save_state(i_step, total_loss)
+            last_checkpoint = time.time()
+
+    return torch.tensor(total_loss / max(i_step, 1))
@@ -0,0 +1,67 @@
+import os
+import contextlib
+import torch
+import torch.distributed as dist
+
+
+def init_distributed(backend='gloo', init_method='env://', rank=None, world_size=None):
+    """
+    Join the process group when launched by torchrun (WORLD_SIZE is set) or when rank and
+    world_size are given. Single-process runs are left untouched.
+    :return: True if the process is part of a process group
+    """
+    if world_size is None:
+        world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size < 2:
+        return False
+    if rank is None:
+        rank = int(os.environ['RANK'])
+    dist.init_process_group(backend, init_method=init_method, rank=rank, world_size=world_size)
+    return True
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def no_sync(model, skip=True):
+    """
+    Skip the gradient averaging of a DistributedDataParallel model, for all but the last of
+    several backward passes accumulating into the same gradients
+    """
+    if skip and hasattr(model, 'no_sync'):
+        return model.no_sync()
+    return contextlib.nullcontext()
+
+
+def gather_embeddings(tensor):
+    """
+    Concatenate the embeddings of all ranks along the batch dimension, so losses mine negatives
+    over the global batch. Only the local slice carries gradients: DDP sums those contributions
+    over the ranks, scale the loss with get_world_size() to undo its averaging.
+    :param tensor: B x ... local embeddings, the same shape on every rank
+    :return: (world_size * B) x ... embeddings, ordered by rank
+    """
+    if not is_distributed():
+        return tensor
+    gathered = [torch.zeros_like(tensor) for _ in range(get_world_size())]
+    dist.all_gather(gathered, tensor.detach().contiguous())
+    gathered[get_rank()] = tensor
+    return torch.cat(gathered)
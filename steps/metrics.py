@@ -0,0 +1,152 @@
+import os
+import re
+import json
+import time
+import atexit
+import threading
+import torch
+
+METRICS_BACKENDS = ['tensorboard', 'jsonl', 'prometheus']
+
+
+class TensorboardBackend(object):
+    def __init__(self, log_dir):
+        # tensorboardX is only imported, and its event file only created, on the first flush
+        from tensorboardX import SummaryWriter
+        self.summary_writer = SummaryWriter(log_dir)
+
+    def write(self, scalars):
+        for tag, value, step, wall_time in scalars:
+            self.summary_writer.add_scalar(tag, value, step, wall_time)
+        self.summary_writer.flush()
+
+    def close(self):
+        self.summary_writer.close()
+
+
+class JsonlBackend(object):
+    # One {"tag", "value", "step", "time"} object per line of <log_dir>/metrics.jsonl
+    def __init__(self, log_dir):
+        os.makedirs(log_dir, exist_ok=True)
+        self.file = open(os.path.join(log_dir, 'metrics.jsonl'), 'a')
+
+    def write(self, scalars):
+        for tag, value, step, wall_time in scalars:
+            self.file.write(json.dumps({'tag': tag, 'value': value, 'step': step, 'time': wall_time}) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class PrometheusBackend(object):
+    """
+    Last value and step of every tag as gauges in <log_dir>/metrics.prom, for the textfile
+    collector of the node exporter. The file is replaced atomically on every flush.
+    """
+    def __init__(self, log_dir):
+        os.makedirs(log_dir, exist_ok=True)
+        self.filename = os.path.join(log_dir, 'metrics.prom')
+        self.last = dict()
+
+    def write(self, scalars):
+        for tag, value, step, _ in scalars:
+            self.last['locnet_' + re.sub('[^a-zA-Z0-9_]', '_', tag)] = (value, step)
+        lines = list()
+        for name, (value, step) in sorted(self.last.items()):
+            lines.append('# TYPE %s gauge\n%s %r\n' % (name, name, value))
+            lines.append('# TYPE %s_step gauge\n%s_step %d\n' % (name, name, step))
+        with open(self.filename + '.tmp', 'w') as f:
+            f.writelines(lines)
+        os.replace(self.filename + '.tmp', self.filename)
+
+    def close(self):
+        pass
+
+
+BACKEND_CLASSES = {'tensorboard': TensorboardBackend,
+                   'jsonl': JsonlBackend,
+                   'prometheus': PrometheusBackend}
+
+
+class MetricsWriter(object):
+    """
+    Scalar sink with the add_scalar interface of SummaryWriter. Scalars are appended to an in-memory
+    buffer and written by a background thread every flush_interval seconds. Nothing is created,
+    neither files nor the thread, before the first scalar, so importing steps has no side effects.
+    :param log_dir: folder of the metric files
+    :param backends: list of METRICS_BACKENDS
+    """
+    def __init__(self, log_dir='../logs', backends=('tensorboard',), flush_interval=5.0):
+        self.log_dir = log_dir
+        self.backends = list(backends)
+        self.flush_interval = flush_interval
+        self.buffer = list()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.sinks = None
+        self.error = None
+
+    def configure(self, log_dir=None, backends=None, flush_interval=None):
+        # Settings only apply before the first scalar is written
+        assert self.thread is None, "Metrics are already being written to '%s'" % self.log_dir
+        for backend in backends or []:
+            assert backend in BACKEND_CLASSES, "Unknown metrics backend '%s', use one of %s" % (backend, METRICS_BACKENDS)
+        if log_dir is not None:
+            self.log_dir = log_dir
+        if backends is not None:
+            self.backends = list(backends)
+        if flush_interval is not None:
+            self.flush_interval = flush_interval
+
+    def add_scalar(self, tag, value, step):
+        self.check_error()
+        if not self.backends:
+            return
+        if isinstance(value, torch.Tensor):
+            # Converted to a float by the flush thread, the training loop does not wait for the device
+            value = value.detach()
+        with self.lock:
+            self.buffer.append((tag, value, step, time.time()))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+                atexit.register(self.close)
+
+    def run(self):
+        try:
+            while not self.stopped.wait(self.flush_interval):
+                self.flush_buffer()
+            self.flush_buffer()
+        except Exception as error:
+            # Reported by the next add_scalar or close
+            self.error = error
+
+    def check_error(self):
+        # Once the flush thread failed, scalars are no longer buffered
+        if self.error is not None and self.backends:
+            self.backends = list()
+            with self.lock:
+                self.buffer = list()
+            print("Writing metrics to '%s' failed, metrics are no longer logged: %r" % (self.log_dir, self.error))
+
+    def flush_buffer(self):
+        with self.lock:
+            scalars, self.buffer = self.buffer, list()
+        if scalars:
+            if self.sinks is None:
+                self.sinks = [BACKEND_CLASSES[backend](self.log_dir) for backend in self.backends]
+            scalars = [(tag, float(value), int(step), wall_time) for tag, value, step, wall_time in scalars]
+            for sink in self.sinks:
+                sink.write(scalars)
+
+    def close(self):
+        # Write the buffered scalars and stop the flush thread
+        if self.thread is None or self.stopped.is_set():
+            return
+        self.stopped.set()
+        self.thread.join()
+        self.check_error()
+        for sink in self.sinks or []:
+            sink.close()
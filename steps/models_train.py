@@ -2,86 +2,174 @@ import time
 import torch.utils.data as data
 import torch
 from statistics import mean
-from tensorboardX import SummaryWriter
 
+from models import frozen_batch_norm_stats
 from .utils import *
-
-
-writer = SummaryWriter('../logs')
+from .distributed import gather_embeddings, get_world_size, no_sync
+from .profiling import PhaseTimer
+from .metrics import MetricsWriter
+
+
+# Created lazily on the first scalar, entry points change its folder and backends with writer.configure()
+writer = MetricsWriter('../logs')
+
+# Steps between two writes of the phase time percentiles to TensorBoard
+TIMING_INTERVAL = 10
+
+
+def grad_cache_backward(micro_batches, image_model, caption_model, batch_loss, use_gpu=False, precision='fp32'):
+    """
+    GradCache: gradients of a loss over several micro-batches, at the activation memory of one of them.
+    The embeddings of all micro-batches are computed without gradients, and the loss of the whole batch
+    is backpropagated to these cached embeddings only. Every micro-batch is then encoded again with
+    gradients, and its slice of the cached embedding gradients is backpropagated through the models.
+    Batch norm running statistics are only updated by the second encoding, once per micro-batch.
+    :param micro_batches: list of (images, captions) on the device of the models, captions of the same length
+    :param batch_loss: function of the image and caption embeddings of the whole batch
+    :return: loss of the whole batch, without graph
+    """
+    device_type = micro_batches[0][0].device.type
+    assert len(set(captions.size(1) for _, captions in micro_batches)) == 1, \
+        "Accumulated micro-batches need captions of the same length, use padded captions"
+
+    with torch.no_grad(), autocast_context(precision, device_type), \
+            frozen_batch_norm_stats(image_model), frozen_batch_norm_stats(caption_model):
+        image_cache = torch.cat([image_model(images) for images, _ in micro_batches])
+        caption_cache = torch.cat([caption_model(captions, use_gpu) for _, captions in micro_batches])
+    image_cache.requires_grad_()
+    caption_cache.requires_grad_()
+
+    with autocast_context(precision, device_type):
+        loss = batch_loss(image_cache, caption_cache)
+    loss = loss.float()
+    (loss * get_world_size()).backward()
+
+    sizes = [images.size(0) for images, _ in micro_batches]
+    image_grads = image_cache.grad.split(sizes)
+    caption_grads = caption_cache.grad.split(sizes)
+    for i, (images, captions) in enumerate(micro_batches):
+        # Distributed models average their gradients once, after the last micro-batch
+        last = i == len(micro_batches) - 1
+        with no_sync(image_model, not last), no_sync(caption_model, not last):
+            with autocast_context(precision, device_type):
+                image_output = image_model(images)
+                caption_output = caption_model(captions, use_gpu)
+            torch.autograd.backward([image_output, caption_output], [image_grads[i], caption_grads[i]])
+    return loss.detach()
 
 
 def train(data_loader_train, data_loader_val, image_model, caption_model,
           loss_type, optimizer, epoch, score_type, sampler, margin,
-          total_train_step, batch_size, use_gpu=False, start_step=1, start_loss=0.0):
-    # Trains model for 1 Epoch
+          total_train_step, batch_size, use_gpu=False, start_step=1, start_loss=0.0,
+          precision='fp32', channels_last=False, checkpoint_interval=0, save_state=None,
+          accumulation_steps=1, profiler=None):
+    """
+    Trains model for 1 Epoch. data_loader_train iterates over the batches of the epoch that are
+    left (see dataloader.epoch_loader), start_step is the number of the first of them.
+    :param checkpoint_interval: seconds between two calls of save_state, 0 disables mid-epoch checkpoints
+    :param save_state: function taking the number of finished steps and the summed loss, saves a resumable checkpoint
+    :param accumulation_steps: number of batches per optimizer step. Negatives are mined over all of them,
+    see grad_cache_backward. Steps are still counted in batches.
+    :param profiler: StepProfiler capturing a trace of some steps
+    """
     losses = AverageMeter()
     total_loss = start_loss
 
     start_time = time.time()
+    last_checkpoint = start_time
+    timer = PhaseTimer(synchronize=torch.cuda.is_available() and use_gpu == True)
+
+    def batch_loss(image_output, caption_glove_output):
+        # With several processes, negatives are mined over the batches of all ranks
+        image_output = gather_embeddings(image_output)
+        caption_glove_output = gather_embeddings(caption_glove_output)
+
+        if loss_type == 'triplet':
+            return custom_loss(image_output, caption_glove_output,
+                               score_type, margin, sampler)
+        elif loss_type == 'npairs':
+            return npairs_loss(image_output, caption_glove_output,
+                               score_type)
 
     loss_scores = list()
-    total_steps = 100
-    # for i_step in range(start_step, total_train_step + 1):
-    for i_step in range(start_step, total_steps+1):
+    micro_batches = list()
+    i_step = start_step - 1
+    # Data time is the wait for the next batch plus its copy to the device
+    data_start = time.perf_counter()
+    for i_step, batch in enumerate(data_loader_train, start=start_step):
+        if profiler is not None:
+            profiler.begin(i_step)
         image_model.train()
         caption_model.train()
-        #
-        indices = data_loader_train.dataset.get_indices()
-        # Create a batch sampler to retrieve a batch with the sampled indices
-        new_sampler = data.sampler.SubsetRandomSampler(indices=indices)
-        data_loader_train.batch_sampler.sampler = new_sampler
 
-        # Obtain the batch
-        for batch in data_loader_train:
-            image_ip, caption_glove_ip = batch[0], batch[1]
-            break
+        image_ip, caption_glove_ip = batch[0], batch[1]
 
         # Move to GPU if CUDA is available
         if torch.cuda.is_available() and use_gpu == True:
             image_ip = image_ip.cuda()
             caption_glove_ip = caption_glove_ip.cuda()
+        image_ip = to_channels_last(image_ip, channels_last)
+        timer.add('data', time.perf_counter() - data_start)
 
-        image_output = image_model(image_ip)
-        caption_glove_output = caption_model(caption_glove_ip, use_gpu)
-
-        sim_scores = list()
-
-        for sample in range(batch_size):
-            # mmap = matchmap_generate(image_output[sample], caption_glove_output[sample])
-            # score = compute_similarity_score(mmap, "Max_Img")
-            score = score_function(image_output[sample], caption_glove_output[sample], score_type)
-            sim_scores.append(score)
-
-        if loss_type == 'triplet':
-            loss = custom_loss(image_output, caption_glove_output,
-                           score_type, margin, sampler)
-            loss_scores.append(loss)
-        elif loss_type == 'npairs':
-            loss = npairs_loss(image_output, caption_glove_output,
-                               score_type)
-            loss_scores.append(loss)
+        # One optimizer step every accumulation_steps batches, and after the last batch of the epoch
+        micro_batches.append((image_ip, caption_glove_ip))
+        if len(micro_batches) < accumulation_steps and i_step < total_train_step:
+            data_start = time.perf_counter()
+            continue
 
         optimizer.zero_grad()
-        total_loss += loss
-        loss.backward()
-        optimizer.step()
-
-        losses.update(loss.data[0], image_ip.size(0))
-        niter = epoch * total_steps + i_step
+        if len(micro_batches) == 1:
+            # Forward passes and similarity scores run under autocast, the loss is kept in float32
+            with autocast_context(precision, image_ip.device.type):
+                with timer.phase('image'):
+                    image_output = image_model(image_ip)
+                with timer.phase('text'):
+                    caption_glove_output = caption_model(caption_glove_ip, use_gpu)
+                with timer.phase('loss'):
+                    loss = batch_loss(image_output, caption_glove_output)
+            loss = loss.float()
+            with timer.phase('backward'):
+                (loss * get_world_size()).backward()
+            loss = loss.detach()
+        else:
+            with timer.phase('grad_cache'):
+                loss = grad_cache_backward(micro_batches, image_model, caption_model, batch_loss, use_gpu, precision)
+        with timer.phase('optimizer'):
+            optimizer.step()
+        loss_scores.append(loss)
+        # The summed loss stays per batch, so resumed epochs and avg_loss do not depend on accumulation_steps
+        total_loss += loss * len(micro_batches)
+
+        losses.update(loss.data[0], image_ip.size(0) * len(micro_batches))
+        micro_batches = list()
+        niter = epoch * total_train_step + i_step
         writer.add_scalar('data/training_loss', losses.val, niter)
+        if i_step % TIMING_INTERVAL == 0:
+            timer.write(writer, 'timing/train', niter)
+
+        print("Step: %d/%d, current loss: %0.4f, avg_loss: %0.4f" % (i_step, total_train_step, loss, total_loss / i_step))
 
-        print("Step: %d, current loss: %0.4f, avg_loss: %0.4f" % (i_step, loss, total_loss / i_step))
+        if save_state is not None and checkpoint_interval > 0 and time.time() - last_checkpoint > checkpoint_interval:
+            save_state(i_step, float(total_loss))
+            last_checkpoint = time.time()
+        if profiler is not None:
+            profiler.end(i_step)
+        data_start = time.perf_counter()
 
+    if profiler is not None:
+        profiler.end(i_step, last=True)
     time_taken = time.time() - start_time
-    # print("Time taken for this epoch:", time_taken)
+    print("Epoch time: %0.1fs, median phase times: %s" % (time_taken, timer.summary()))
 
-    return total_loss / i_step
+    return total_loss / max(i_step, 1)
 
 
 def validate(caption_model, image_model, data_loader_val, epoch,
-             loss_type, score_type, sampler, margin, use_gpu):
+             loss_type, score_type, sampler, margin, use_gpu,
+             precision='fp32', channels_last=False):
     val_losses = AverageMeter()
     total_loss_val = 0.0
+    timer = PhaseTimer(synchronize=torch.cuda.is_available())
 
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     image_model = image_model.to(device)
@@ -106,30 +194,34 @@ def validate(caption_model, image_model, data_loader_val, epoch,
         new_sampler = data.sampler.SubsetRandomSampler(indices=indices)
         data_loader_val.batch_sampler.sampler = new_sampler
 
-        for batch in data_loader_val:
-            image_ip_val, caption_glove_ip_val = batch[0], batch[1]
-            break
+        with timer.phase('data'):
+            for batch in data_loader_val:
+                image_ip_val, caption_glove_ip_val = batch[0], batch[1]
+                break
 
-        image_ip_val = image_ip_val.to(device)
-        caption_glove_ip_val = caption_glove_ip_val.to(device)
+            image_ip_val = to_channels_last(image_ip_val.to(device), channels_last)
+            caption_glove_ip_val = caption_glove_ip_val.to(device)
 
         loss_scores = list()
 
-        with torch.no_grad():
-            image_output_val = image_model(image_ip_val)
-            caption_output_val = caption_model(caption_glove_ip_val)
+        with torch.no_grad(), autocast_context(precision, device.type):
+            with timer.phase('image'):
+                image_output_val = image_model(image_ip_val)
+            with timer.phase('text'):
+                caption_output_val = caption_model(caption_glove_ip_val)
 
-            if loss_type == 'triplet':
-                loss = custom_loss(image_output_val, caption_output_val,
-                                   score_type, margin, sampler)
-                loss_scores.append(loss)
+            with timer.phase('loss'):
+                if loss_type == 'triplet':
+                    loss = custom_loss(image_output_val, caption_output_val,
+                                       score_type, margin, sampler)
 
-            elif loss_type == 'npairs':
-                loss = npairs_loss(image_output_val, caption_output_val,
-                                   score_type)
-                loss_scores.append(loss)
+                elif loss_type == 'npairs':
+                    loss = npairs_loss(image_output_val, caption_output_val,
+                                       score_type)
 
-            total_loss_val += loss
+        loss = loss.float()
+        loss_scores.append(loss)
+        total_loss_val += loss
 
         I_embeddings = []
         C_embeddings = []
@@ -140,7 +232,8 @@ def validate(caption_model, image_model, data_loader_val, epoch,
         caption_output = torch.cat(C_embeddings)
 
         # Calculating recall scores
-        recalls = calc_recalls(image_output, caption_output, score_type)
+        with autocast_context(precision, device.type), timer.phase('recall'):
+            recalls = calc_recalls(image_output, caption_output, score_type)
         C_r10.append(recalls['C_r10'])
         I_r10.append(recalls['I_r10'])
         C_r5.append(recalls['C_r5'])
@@ -166,6 +259,8 @@ def validate(caption_model, image_model, data_loader_val, epoch,
           .format(C_r5=mean(C_r5), I_r5=mean(I_r5)), flush=True)
     print(' Caption Mean R@1 {C_r1:.3f} Image Mean R@1 {I_r1:.3f}'
           .format(C_r1=mean(C_r1), I_r1=mean(I_r1)), flush=True)
+    print(' Median phase times: %s' % timer.summary())
     print('---------------------------------------------------------')
+    timer.write(writer, 'timing/val', epoch)
 
     return total_loss_val / i_step_val
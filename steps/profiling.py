@@ -0,0 +1,257 @@
+import os
+import gc
+import sys
+import json
+import time
+import resource
+import threading
+import contextlib
+import collections
+import numpy as np
+import torch
+
+
+class PhaseTimer(object):
+    """
+    Wall clock time of the phases of a step (data, image, text, loss, backward, ...), kept over
+    the last window steps. Each phase is also a named range in torch.profiler traces.
+    :param synchronize: wait for CUDA kernels at phase boundaries, otherwise GPU phases only
+    measure the time to launch their kernels
+    """
+    def __init__(self, window=100, synchronize=False):
+        self.times = collections.OrderedDict()
+        self.window = window
+        self.synchronize = synchronize
+
+    def add(self, name, seconds):
+        if name not in self.times:
+            self.times[name] = collections.deque(maxlen=self.window)
+        self.times[name].append(seconds)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if self.synchronize:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        with torch.profiler.record_function(name), memory_section(name):
+            yield
+        if self.synchronize:
+            torch.cuda.synchronize()
+        self.add(name, time.perf_counter() - start)
+
+    def percentiles(self, q=(50, 90, 99)):
+        """
+        :return: dict of phase name -> percentiles of its times in the window, in seconds
+        """
+        return {name: np.percentile(times, q) for name, times in self.times.items()}
+
+    def write(self, writer, prefix, niter):
+        # TensorBoard scalars <prefix>/<phase>_p50, _p90 and _p99, in milliseconds
+        for name, values in self.percentiles().items():
+            for q, value in zip((50, 90, 99), values):
+                writer.add_scalar('%s/%s_p%d' % (prefix, name, q), value * 1000, niter)
+
+    def summary(self):
+        return ', '.join('%s %0.1fms' % (name, values[0] * 1000) for name, values in self.percentiles((50,)).items())
+
+
+class StepProfiler(object):
+    """
+    torch.profiler capture of the training steps start to stop, written as a Chrome trace with the
+    input shapes and memory allocations of every operator. Open it in chrome://tracing or ui.perfetto.dev.
+    Only the first epoch reaching step start is captured.
+    """
+    def __init__(self, start, stop, trace_file, use_cuda=False):
+        self.start = start
+        self.stop = stop
+        self.trace_file = trace_file
+        self.activities = [torch.profiler.ProfilerActivity.CPU]
+        if use_cuda:
+            self.activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.profiler = None
+        self.done = False
+
+    def begin(self, i_step):
+        # Called at the start of every step
+        if not self.done and self.profiler is None and self.start <= i_step <= self.stop:
+            self.profiler = torch.profiler.profile(activities=self.activities, record_shapes=True,
+                                                   profile_memory=True)
+            self.profiler.__enter__()
+
+    def end(self, i_step, last=False):
+        # Called after every optimizer step, last at the end of the epoch
+        if self.profiler is not None and (i_step >= self.stop or last):
+            self.profiler.__exit__(None, None, None)
+            os.makedirs(os.path.dirname(self.trace_file) or '.', exist_ok=True)
+            self.profiler.export_chrome_trace(self.trace_file)
+            print("Saved profile of steps %d to %d to %s" % (self.start, i_step, self.trace_file))
+            self.profiler = None
+            self.done = True
+
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def process_rss(pid='self'):
+    """
+    Resident memory of a process in MB, read from /proc on Linux. Elsewhere only the current
+    process is measured, by its peak resident memory.
+    """
+    try:
+        with open('/proc/%s/statm' % pid) as f:
+            return int(f.read().split()[1]) * PAGE_SIZE / 2 ** 20
+    except (OSError, IndexError, ValueError):
+        if pid != 'self':
+            return 0.0
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS, in KB elsewhere
+        return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+def child_pids():
+    # Children of all threads of the current process, e.g. the DataLoader workers
+    pids = list()
+    try:
+        for task in os.listdir('/proc/self/task'):
+            with open('/proc/self/task/%s/children' % task) as f:
+                pids.extend(f.read().split())
+    except OSError:
+        pass
+    return pids
+
+
+def largest_tensors(n=10):
+    """
+    Largest tensors referenced from Python, one per storage. Activations saved for backward are
+    only held by the autograd graph and are not listed.
+    :return: list of (MB, shape, dtype, device)
+    """
+    storages = dict()
+    for obj in gc.get_objects():
+        try:
+            if isinstance(obj, torch.Tensor) and obj.device.type != 'meta':
+                storage = obj.untyped_storage()
+                storages[storage.data_ptr()] = (storage.nbytes() / 2 ** 20, list(obj.shape), str(obj.dtype), str(obj.device))
+        except (ReferenceError, RuntimeError):
+            continue
+    return sorted(storages.values(), reverse=True)[:n]
+
+
+_active_tracker = None
+
+
+def memory_section(name):
+    """
+    Memory record of a named section (e.g. a training phase, the similarity matrix) for the running
+    MemoryTracker, does nothing when no tracker runs
+    """
+    if _active_tracker is None:
+        return contextlib.nullcontext()
+    return _active_tracker.section(name)
+
+
+class MemoryTracker(object):
+    """
+    Resident memory of the main process and of its child processes (DataLoader workers).
+    A background thread samples both every interval seconds, and the main process is also measured
+    when a section (see memory_section) starts and ends. Samples are attributed to the innermost
+    running section, which gives the peak memory of every phase and a time series of each section.
+    :param detailed: also list the largest tensors whenever the main process reaches a new peak at a
+    section boundary. This scans all Python objects, which is too slow to leave on.
+    """
+    def __init__(self, interval=1.0, detailed=False, max_samples=10000):
+        self.interval = interval
+        self.detailed = detailed
+        self.peaks = collections.OrderedDict()
+        self.workers_peak = 0.0
+        self.peak = 0.0
+        self.peak_section = None
+        self.peak_tensors = list()
+        self.series = collections.deque(maxlen=max_samples)
+        self.stack = list()
+        # Records come from both the sampling thread and the main thread
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        global _active_tracker
+        _active_tracker = self
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        global _active_tracker
+        if _active_tracker is self:
+            _active_tracker = None
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def current(self):
+        # Called by the sampling thread while the main thread pushes and pops sections
+        try:
+            return self.stack[-1]
+        except IndexError:
+            return 'other'
+
+    def record(self, name, rss, workers=None, scan=False):
+        with self.lock:
+            self.peaks[name] = max(self.peaks.get(name, 0.0), rss)
+            self.series.append((round(time.time() - self.start_time, 3), name, round(rss, 1),
+                                None if workers is None else round(workers, 1)))
+            new_peak = rss > self.peak
+            if new_peak:
+                self.peak = rss
+                self.peak_section = name
+        if new_peak and scan and self.detailed:
+            self.peak_tensors = largest_tensors()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            workers = sum(process_rss(pid) for pid in child_pids())
+            self.workers_peak = max(self.workers_peak, workers)
+            self.record(self.current(), process_rss(), workers)
+
+    @contextlib.contextmanager
+    def section(self, name):
+        self.stack.append(name)
+        self.record(name, process_rss(), scan=True)
+        try:
+            yield
+        finally:
+            self.record(name, process_rss(), scan=True)
+            self.stack.pop()
+
+    def summary(self):
+        with self.lock:
+            peaks = dict(self.peaks)
+        return {'peak_mb': self.peak,
+                'peak_section': self.peak_section,
+                'section_peaks_mb': peaks,
+                'workers_peak_mb': self.workers_peak,
+                'largest_tensors_at_peak': [{'mb': mb, 'shape': shape, 'dtype': dtype, 'device': device}
+                                            for mb, shape, dtype, device in self.peak_tensors]}
+
+    def write(self, writer, prefix, niter):
+        # TensorBoard scalars <prefix>/<section>_peak_mb, <prefix>/peak_mb and <prefix>/workers_peak_mb
+        with self.lock:
+            peaks = list(self.peaks.items())
+        for name, peak in peaks:
+            writer.add_scalar('%s/%s_peak_mb' % (prefix, name), peak, niter)
+        writer.add_scalar('%s/peak_mb' % prefix, self.peak, niter)
+        writer.add_scalar('%s/workers_peak_mb' % prefix, self.workers_peak, niter)
+
+    def dump(self, filename):
+        """
+        Write the summary and the time series (seconds, section, main process MB, workers MB) as JSON
+        """
+        os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+        with self.lock:
+            series = list(self.series)
+        report = dict(self.summary(), series=series)
+        with open(filename + '.tmp', 'w') as f:
+            json.dump(report, f, indent=1)
+        os.replace(filename + '.tmp', filename)
@@ -1,5 +1,8 @@
 import torch
 import numpy as np
+import contextlib
+
+from .profiling import memory_section
 
 class AverageMeter(object):
     def __init__(self):
@@ -26,6 +29,31 @@ def adjust_learning_rate(base_lr, lr_decay, optimizer, epoch):
         param_group['lr'] = lr
 
 
+def autocast_context(precision='fp32', device_type='cpu'):
+    """
+    Mixed precision region for forward passes and similarity computation
+    :param precision: 'fp32' or 'bf16'. With bf16, convolutions, recurrent layers and matrix
+    products run in bfloat16 while weights stay in float32.
+    :param device_type: device the models run on
+    :return: context manager
+    """
+    assert precision in ['fp32', 'bf16'], "precision must be one of 'fp32' or 'bf16'"
+    if precision == 'bf16':
+        return torch.autocast(device_type=device_type, dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+
+def to_channels_last(image_tensor, channels_last=True):
+    """
+    Convert a batch of images (or an image model) to the channels last memory format
+    """
+    if not channels_last:
+        return image_tensor
+    if isinstance(image_tensor, torch.nn.Module):
+        return image_tensor.to(memory_format=torch.channels_last)
+    return image_tensor.contiguous(memory_format=torch.channels_last)
+
+
 def matchmap_generate(image, text):
     """
     Generates Matchmap for a single image and text pair
@@ -97,9 +125,11 @@ def compute_matchmap_similarity_matrix(image_outputs, caption_outputs, score_typ
         
     sim_mat = torch.zeros(batch_size_img, batch_size_cap, device=image_outputs.device)
 
-    for image_idx in range(batch_size_img):
-        for word_idx in range(batch_size_cap):
-            sim_mat[image_idx, word_idx] = score_function(image_outputs[image_idx], caption_outputs[word_idx], score_type)
+    # Recorded as its own section by a running MemoryTracker, the graph of the B x B matchmaps grows with the square of the batch
+    with memory_section('similarity_matrix'):
+        for image_idx in range(batch_size_img):
+            for word_idx in range(batch_size_cap):
+                sim_mat[image_idx, word_idx] = score_function(image_outputs[image_idx], caption_outputs[word_idx], score_type)
 
     return sim_mat
 
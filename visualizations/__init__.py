@@ -2,3 +2,4 @@ from .flickr_processor import *
 from .visualize_utils import *
 from .coco_processor import *
 from .genome_processor import *
+from .batched_eval import *
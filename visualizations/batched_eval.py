@@ -0,0 +1,206 @@
+"""Batched pointing game evaluation, with the same scores as the evaluation of one sample at a time."""
+import time
+import functools
+import contextlib
+import collections
+import cv2
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torch.utils.data as data
+from statistics import mean
+
+from steps.utils import autocast_context, to_channels_last
+from models import IMAGE_SIZE
+from dataloader.phrase_columns import PhraseColumns, ImageIndex
+
+# Largest number of channels cv2.resize takes at once
+CV_MAX_CHANNELS = 512
+
+
+def instance_batch_norm(layer, x):
+    # What a batch norm layer in training mode computes for a batch of one sample
+    return F.instance_norm(x, weight=layer.weight, bias=layer.bias, use_input_stats=True, eps=layer.eps)
+
+
+@contextlib.contextmanager
+def per_sample_batch_norm(model):
+    """
+    Models loaded for evaluation are left in training mode, where batch norm layers normalize with
+    the statistics of the batch. Inside this context they normalize every sample with its own
+    statistics, so a batch gives the outputs of one sample at a time. Running statistics are not updated.
+    """
+    layers = [layer for layer in model.modules()
+              if isinstance(layer, nn.modules.batchnorm._BatchNorm) and layer.training]
+    for layer in layers:
+        layer.forward = functools.partial(instance_batch_norm, layer)
+    try:
+        yield
+    finally:
+        for layer in layers:
+            del layer.forward
+
+
+def padded_lengths(dataset):
+    """
+    Length of the caption glove tensor of every sample of a dataset, without start and end words
+    """
+    if dataset.pad_caption:
+        return [max(length, dataset.pad_limit) for length in dataset.caption_lengths]
+    return list(dataset.caption_lengths)
+
+
+def length_batches(lengths, batch_size):
+    """
+    Batches of the indices of samples with the same caption length, each batch in increasing index order
+    :param lengths: caption length of every sample to evaluate
+    """
+    groups = collections.OrderedDict()
+    for index, length in enumerate(lengths):
+        groups.setdefault(length, list()).append(index)
+    return [indices[start:start + batch_size] for indices in groups.values()
+            for start in range(0, len(indices), batch_size)]
+
+
+def eval_collate(batch):
+    # Images and caption gloves are stacked, the other fields of the samples are kept as lists
+    fields = list(zip(*batch))
+    return [torch.stack(fields[0]), torch.stack(fields[1])] + [list(field) for field in fields[2:]]
+
+
+def eval_loader(dataset, batches, num_workers=4):
+    """
+    :param batches: lists of indices, see length_batches
+    :return: DataLoader giving the batches in order
+    """
+    return data.DataLoader(dataset, batch_sampler=batches, num_workers=num_workers, collate_fn=eval_collate)
+
+
+def batched_matchmaps(image_model, caption_model, image_tensor, caption_glove, precision='fp32',
+                      channels_last=False, mean_caption=False):
+    """
+    Matchmaps of every image with its own caption, computed as matchmap_generate does for each sample
+    :param mean_caption: match the image with the mean of the caption embeddings (phrase colocalization)
+    :return: B x T x H x W float32 matchmaps, B x 1 x H x W with mean_caption
+    """
+    with torch.inference_mode(), per_sample_batch_norm(image_model), autocast_context(precision):
+        image_op = image_model(to_channels_last(image_tensor, channels_last))
+        caption_op = caption_model(caption_glove)
+        if mean_caption:
+            caption_op = caption_op.mean(1, keepdim=True)
+        batch_size, depth, height, width = image_op.shape
+        matchmaps = torch.bmm(caption_op, image_op.reshape(batch_size, depth, height * width))
+    return matchmaps.float().reshape(batch_size, -1, height, width)
+
+
+def flickr_phrase_maps(maps, caption_data, parse_mode):
+    """
+    Maps of the phrases of a Flickr caption, as flickr_element_processor clips and averages them
+    :param maps: T x H x W matchmaps of the caption, with start, end and padding words
+    :param caption_data: annotation of the caption
+    :return: P x H x W array, one map per phrase
+    """
+    caption = caption_data['parsed_caption'] if parse_mode == 'phrase' else caption_data['tok_sent']
+    maps = maps[1:len(caption) + 1]
+    if parse_mode != 'phrase':
+        maps = np.stack([np.array([maps[index] for index in position]).mean(axis=0)
+                         for position in caption_data['caption_index']])
+    return maps
+
+
+def resize_maps(maps):
+    """
+    cv2.resize of every map to IMAGE_SIZE x IMAGE_SIZE, the maps are resized as the channels of a few images
+    :param maps: N x H x W float32 array
+    :return: N x IMAGE_SIZE x IMAGE_SIZE array
+    """
+    resized = list()
+    for start in range(0, len(maps), CV_MAX_CHANNELS):
+        stack = np.ascontiguousarray(maps[start:start + CV_MAX_CHANNELS].transpose(1, 2, 0))
+        stack = cv2.resize(stack, dsize=(IMAGE_SIZE, IMAGE_SIZE))
+        resized.append(stack.reshape(IMAGE_SIZE, IMAGE_SIZE, -1).transpose(2, 0, 1))
+    return np.concatenate(resized)
+
+
+def map_maxima(maps):
+    """
+    :param maps: N x H x W array
+    :return: N x 2 array of the (row, column) of the first maximum of every map, as np.argmax
+    """
+    flat_index = maps.reshape(len(maps), -1).argmax(axis=1)
+    return np.stack(np.unravel_index(flat_index, maps.shape[1:]), axis=1)
+
+
+def boxes_hit(coords, boxes):
+    """
+    :param coords: N x 2 (row, column) maxima
+    :param boxes: N x 4 [x1, y1, x2, y2] boxes
+    :return: N booleans, whether every maximum is in its box
+    """
+    # Like hit_condition, the row of the maximum is compared with the x range of the box
+    return ((boxes[:, 0] <= coords[:, 0]) & (coords[:, 0] <= boxes[:, 2]) &
+            (boxes[:, 1] <= coords[:, 1]) & (coords[:, 1] <= boxes[:, 3]))
+
+
+def pointing_game_hits(coords, boxes):
+    """
+    Hits of the maxima of the phrase maps in the boxes of their phrase, as single_image_score counts them
+    :param coords: P x 2 (row, column) maxima of the phrase maps
+    :param boxes: list of P lists of [x1, y1, x2, y2] boxes, phrases without boxes are not a list
+    :return: number of hits, number of boxes
+    """
+    frames = [frame_index for frame_index, frame in enumerate(boxes) if type(frame) is list for _ in frame]
+    if not frames:
+        return 0, 0
+    boxes = np.array([box for frame in boxes if type(frame) is list for box in frame], dtype=np.float64)
+    return int(boxes_hit(coords[frames], boxes).sum()), len(frames)
+
+
+def genome_boxes(annotations, image_data, ids):
+    """
+    Boxes of Visual Genome phrases, resized to IMAGE_SIZE x IMAGE_SIZE images as bbox_processor does
+    :param annotations: phrase annotations, PhraseColumns or the dictionary of a json file
+    :param image_data: image metadata, ImageIndex or the dictionary of a json file
+    :param ids: ann_ids of the phrases
+    :return: N x 4 float64 array of [x1, y1, x2, y2] boxes, in the order of ids
+    """
+    if isinstance(annotations, PhraseColumns):
+        rows = np.searchsorted(annotations.ann_id, np.array(ids).astype(np.int64))
+        bbox, image_ids = annotations.bbox[rows], annotations.image_id[rows]
+    else:
+        bbox = np.array([annotations[ann_id]['bbox'] for ann_id in ids], dtype=np.int64).reshape(-1, 4)
+        image_ids = np.array([annotations[ann_id]['image_id'] for ann_id in ids], dtype=np.int64)
+    if isinstance(image_data, ImageIndex):
+        rows = image_data.rows(image_ids)
+        height, width = image_data.height[rows], image_data.width[rows]
+    else:
+        height = np.array([image_data[str(image_id)]['height'] for image_id in image_ids.tolist()], dtype=np.int64)
+        width = np.array([image_data[str(image_id)]['width'] for image_id in image_ids.tolist()], dtype=np.int64)
+    width_factor = IMAGE_SIZE / width
+    height_factor = IMAGE_SIZE / height
+    return np.stack([bbox[:, 0] * width_factor,
+                     bbox[:, 1] * height_factor,
+                     (bbox[:, 2] + bbox[:, 0]) * width_factor,
+                     (bbox[:, 1] + bbox[:, 3]) * height_factor], axis=1)
+
+
+class EvalProgress(object):
+    """
+    Running mean of the scores printed every interval samples, and throughput at the end
+    """
+    def __init__(self, interval=100):
+        self.interval = interval
+        self.scores = list()
+        self.start = time.time()
+
+    def update(self, scores):
+        printed = len(self.scores) // self.interval
+        self.scores.extend(scores)
+        if len(self.scores) // self.interval > printed:
+            print(len(self.scores), "--->", mean(self.scores))
+
+    def summary(self):
+        seconds = time.time() - self.start
+        print("Evaluated %d samples in %0.0fs, %0.1f samples/s" % (
+            len(self.scores), seconds, len(self.scores) / max(seconds, 1e-9)))
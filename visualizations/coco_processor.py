@@ -8,15 +8,16 @@ from tqdm import tqdm
 
 from steps.utils import *
 
-transform = transforms.Compose([transforms.Resize((224, 224)),
+transform = transforms.Compose([transforms.Resize((IMAGE_SIZE, IMAGE_SIZE)),
                                 transforms.ToTensor(),
                                 transforms.Normalize((0.485, 0.456, 0.406),(0.229, 0.224, 0.225))])
 class COCOViz():
 
     def __init__(self, batch_size, model_path='saved_models/checkpoint.pth.tar',
-                 mode='val', transform=transform):
+                 mode='val', transform=transform, precision='fp32', channels_last=False):
         """
         Load models, batch-size data, compute colocalization maps. 
+        precision and channels_last select bf16 autocast and the channels last image layout.
         """
 
         self.batch_size = batch_size
@@ -24,14 +25,19 @@ class COCOViz():
         self.mode = mode
         self.transform = transform
 
+        self.precision = precision
+        self.channels_last = channels_last
+
         self.image_model, self.caption_model = get_models(self.model_path)
+        self.image_model = to_channels_last(self.image_model, self.channels_last)
 
         self.image_tensor, self.caption_glove, self.caption = coco_load_data(self.batch_size,
                                                                              self.transform,
                                                                              self.mode)
 
         self.coloc_maps, self.vgg_op = gen_coloc_maps(self.image_model, self.caption_model,
-                                           self.image_tensor, self.caption_glove)
+                                           self.image_tensor, self.caption_glove,
+                                           self.precision, self.channels_last)
 
     def __getitem__(self, index):
         """
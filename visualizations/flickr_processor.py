@@ -1,4 +1,5 @@
 from .visualize_utils import *
+from .batched_eval import *
 
 from torchvision import transforms
 import json
@@ -9,7 +10,7 @@ from tqdm import tqdm
 
 # from steps.utils import *
 
-transform = transforms.Compose([transforms.Resize((224, 224)),
+transform = transforms.Compose([transforms.Resize((IMAGE_SIZE, IMAGE_SIZE)),
                                 transforms.ToTensor(),
                                 transforms.Normalize((0.485, 0.456, 0.406),(0.229, 0.224, 0.225))])
 
@@ -17,32 +18,41 @@ transform = transforms.Compose([transforms.Resize((224, 224)),
 class FlickrViz():
 
     def __init__(self, batch_size, parse_mode, model_path, 
-                 mode='test', transform=transform, eval_mode=False):
+                 mode='test', transform=transform, eval_mode=False, manifest='default',
+                 precision='fp32', channels_last=False):
         """
         If eval_mode is true, evaluate localization score for entities present in the dataset.
         Otherwise, load models, batch-size data, compute colocalization maps. 
+        precision and channels_last select bf16 autocast and the channels last image layout.
         """
         self.eval_mode = eval_mode
         self.batch_size = batch_size
         self.parse_mode = parse_mode
-        self.json_path = 'data/flickr_30kentities/annotations_flickr/Sentences/test/data.json'
+        self.manifest = manifest
+        self.json_path = flickr_paths(mode, manifest=self.manifest)['parsed']
         self.data = json.load(open(self.json_path, encoding='utf-8', mode='r'))
         self.model_path = model_path
         self.mode = mode
         self.transform = transform
+        self.precision = precision
+        self.channels_last = channels_last
         self.image_model, self.caption_model = get_models(self.model_path)
+        self.image_model = to_channels_last(self.image_model, self.channels_last)
         
         if self.eval_mode:
             loader = flickr_load_data(1, self.parse_mode, self.transform,
-                                      self.mode, self.eval_mode)
+                                      self.mode, self.eval_mode, self.manifest)
             self.dataset = loader.dataset
 
         else:
             self.image_tensor, self.caption_glove, self.ids = flickr_load_data(self.batch_size,
                                                                            self.parse_mode,
-                                                                           self.transform)
+                                                                           self.transform,
+                                                                           self.mode,
+                                                                           manifest=self.manifest)
             self.coloc_maps, self.vgg_op = gen_coloc_maps(self.image_model, self.caption_model,
-                                    self.image_tensor, self.caption_glove)
+                                    self.image_tensor, self.caption_glove,
+                                    self.precision, self.channels_last)
 
         
     def __getitem__(self, index):
@@ -102,30 +112,44 @@ class FlickrViz():
         else:
             mask_viz(mask_list, caption, bw_img, boxes, save_flag, save_name_results)
 
-    def loc_eval(self, last):
+    def loc_eval(self, last, num_workers=4):
         """
-        When in eval mode, this will load entire dataset and iteratively find
-        localization score for each image first and then average it to find 
-        localization score for the entire dataset. Only works when eval_mode is True.
+        When in eval mode, this will load entire dataset and find localization
+        score for each image first and then average it to find localization
+        score for the entire dataset. Only works when eval_mode is True.
+        Images are evaluated in batches of batch_size captions of the same length,
+        loaded by num_workers processes. Scores are the same as one image at a time.
         :param last: number of images to evaluate. For full dataset, use len(data_loader.dataset)
-        :return score_list: last - length list of all scores
+        :return score_list: list of the scores of the evaluated images, in dataset order.
+        Captions without boxes are skipped.
         :return mean(score_list): mean localization score for dataset. 
         """
-        score_list = list()
-        for index in tqdm(np.arange(last)):
-            image_tensor, caption_glove, caption, cap_id = self.dataset[index]
-            image_tensor = image_tensor.unsqueeze(0)
-            caption_glove = caption_glove.unsqueeze(0)
-            co_loc_map, vgg_op = gen_coloc_maps(self.image_model, self.caption_model,
-                                        image_tensor, caption_glove)
-            element = fetch_data(0, co_loc_map, vgg_op, image_tensor, cap_id)
-            element = flickr_element_processor(element, self.parse_mode, self.data)
-            score = element_score(element)
-            score_list.append(score)
-            if not(index % 100):
-                print(index,"--->",score, mean(score_list))
-
-
+        batches = length_batches(padded_lengths(self.dataset)[:last], self.batch_size)
+        loader = eval_loader(self.dataset, batches, num_workers)
+        scores = dict()
+        progress = EvalProgress()
+        for indices, (image_tensor, caption_glove, _, cap_ids) in zip(batches, tqdm(loader)):
+            matchmaps = batched_matchmaps(self.image_model, self.caption_model,
+                                          image_tensor, caption_glove,
+                                          self.precision, self.channels_last).numpy()
+            phrase_maps = [flickr_phrase_maps(maps, self.data[cap_id], self.parse_mode)
+                           for maps, cap_id in zip(matchmaps, cap_ids)]
+            # Maps of the whole batch are resized together
+            coords = np.split(map_maxima(resize_maps(np.concatenate(phrase_maps))),
+                              np.cumsum([len(maps) for maps in phrase_maps])[:-1])
+
+            batch_scores = list()
+            for index, cap_id, coords_max in zip(indices, cap_ids, coords):
+                caption_data = self.data[cap_id]
+                boxes = flickr_box_converter(caption_data['boxes'], caption_data['image_size'])
+                hits, total = pointing_game_hits(coords_max, boxes)
+                if total:
+                    scores[index] = hits / total
+                    batch_scores.append(scores[index])
+            progress.update(batch_scores)
+        progress.summary()
+
+        score_list = [scores[index] for index in sorted(scores)]
         return mean(score_list), score_list
 
 
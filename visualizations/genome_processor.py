@@ -1,4 +1,6 @@
 from .genome_utils import *
+from .batched_eval import *
+from dataloader.phrase_columns import load_image_data
 
 from torchvision import transforms
 import json
@@ -8,16 +10,19 @@ from statistics import mean
 from tqdm import tqdm
 
 
-transform = transforms.Compose([transforms.Resize((224, 224)),
+transform = transforms.Compose([transforms.Resize((IMAGE_SIZE, IMAGE_SIZE)),
                                 transforms.ToTensor(),
                                 transforms.Normalize((0.485, 0.456, 0.406),(0.229, 0.224, 0.225))])
 
 class GenomeViz():
 
-    def __init__(self, batch_size, model_path, image_data, annotations_data, transform=transform, eval_mode=False, parse_mode="matchmap"):
+    def __init__(self, batch_size, model_path, image_data=None, annotations_data=None, transform=transform, eval_mode=False, parse_mode="matchmap",
+                 precision='fp32', channels_last=False):
         """
         If eval_mode is true, compute localization score.
         Otherwise, load models, batch_size data, compute colocalization maps
+        precision and channels_last select bf16 autocast and the channels last image layout.
+        image_data and annotations_data default to the image index and the phrase table of the dataset.
         """
         self.eval_mode = eval_mode
         self.parse_mode = parse_mode
@@ -26,24 +31,30 @@ class GenomeViz():
         self.batch_size = batch_size
         self.model_path = model_path
         self.image_data_file = 'data/visual_genome/coco_image_data.json'
-        self.annotations_file = 'data/visual_genome/coco_phrase_data.json'
-
-        self.image_data = image_data
-        self.annotations_data = annotations_data
+        self.annotations_file = 'data/visual_genome/coco_phrase_data'
 
+        self.precision = precision
+        self.channels_last = channels_last
         self.image_model, self.caption_model = get_models_genome(self.model_path)
+        self.image_model = to_channels_last(self.image_model, self.channels_last)
 
         self.data_loader, self.image_tensor, self.caption_glove, self.ann_ids = genome_load_data(self.batch_size,
                                                                                                  self.transform)
+        self.dataset = self.data_loader.dataset
+        self.image_data = image_data if image_data is not None else load_image_data(self.image_data_file)
+        self.annotations_data = annotations_data if annotations_data is not None else self.dataset.annotations
+
         if self.eval_mode:
-            self.dataset = self.data_loader.dataset
+            return
 
         if self.parse_mode == 'matchmap':
             self.coloc_maps = gen_coloc_maps_matchmap(self.image_model, self.caption_model,
-                                             self.image_tensor, self.caption_glove)
+                                             self.image_tensor, self.caption_glove,
+                                             self.precision, self.channels_last)
         else:
             self.coloc_maps = gen_coloc_maps_phrase(self.image_model, self.caption_model,
-                                                    self.image_tensor, self.caption_glove)
+                                                    self.image_tensor, self.caption_glove,
+                                                    self.precision, self.channels_last)
 
 
     def __getitem__(self, index):
@@ -70,33 +81,35 @@ class GenomeViz():
             mask_viz_genome(element, save_flag, name)
         print("Score: ",self.score)
 
-    def loc_eval(self, last):
+    def loc_eval(self, last, num_workers=4):
         """
-        When in eval mode, this will load entire dataset and iteratively find
-        localization score for each image first and then average it to find 
-        localization score for the entire dataset. Only works when eval_mode is True.
-        :param last: number of images to evaluate. For full dataset, use len(data_loader.dataset)
+        When in eval mode, this will load entire dataset and find localization
+        score for each phrase first and then average it to find localization
+        score for the entire dataset. Only works when eval_mode is True.
+        Phrases are evaluated in batches of batch_size phrases of the same length,
+        loaded by num_workers processes. Scores are the same as one phrase at a time.
+        :param last: number of phrases to evaluate. For full dataset, use len(data_loader.dataset)
         :return score_list: last - length list of all scores
         :return mean(score_list): mean localization score for dataset. 
         """
-        score_list = list()
-        for index in tqdm(np.arange(last)):
-            image_tensor, caption_glove, cap_id = self.dataset[index]
-            image_tensor = image_tensor.unsqueeze(0)
-            caption_glove = caption_glove.unsqueeze(0)
-            if self.parse_mode == "matchmap":
-                coloc_map = gen_coloc_maps_matchmap(self.image_model, self.caption_model,
-                                                    image_tensor, caption_glove)
-            else:
-                coloc_map = gen_coloc_maps_phrase(self.image_model, self.caption_model,
-                                                    image_tensor, caption_glove)
-            raw_element = fetch_data_genome(0, coloc_map, image_tensor, cap_id)
-            element = genome_element_processor(raw_element, self.image_data, self.annotations_data)
-            score = int(hit_score_genome(element))
-            score_list.append(score)
-            if not(index % 100):
-                print(index,"--->",score, mean(score_list))
-
+        boxes = genome_boxes(self.annotations_data, self.image_data, self.dataset.ids[:last])
+        batches = length_batches(padded_lengths(self.dataset)[:last], self.batch_size)
+        loader = eval_loader(self.dataset, batches, num_workers)
+        scores = np.zeros(len(boxes), dtype=np.int64)
+        progress = EvalProgress()
+        for indices, (image_tensor, caption_glove, _) in zip(batches, tqdm(loader)):
+            matchmaps = batched_matchmaps(self.image_model, self.caption_model,
+                                          image_tensor, caption_glove,
+                                          self.precision, self.channels_last,
+                                          mean_caption=self.parse_mode != 'matchmap')
+            # One map per phrase, the mean of the maps of its words in matchmap mode
+            coloc_maps = matchmaps.mean(1) if self.parse_mode == 'matchmap' else matchmaps[:, 0]
+            hits = boxes_hit(map_maxima(resize_maps(coloc_maps.numpy())), boxes[indices])
+            scores[indices] = hits
+            progress.update(hits.astype(int).tolist())
+        progress.summary()
+
+        score_list = scores.tolist()
         return score_list, mean(score_list)
 
 
@@ -6,8 +6,8 @@ import matplotlib.pyplot as plt
 import matplotlib.patches as patches
 from tqdm import tqdm
 
-from steps.utils import matchmap_generate
-from models import VGG19, LSTMBranch
+from steps.utils import matchmap_generate, autocast_context, to_channels_last
+from models import VGG19, IMAGE_SIZE, get_text_encoder, load_models
 
 import sys
 
@@ -33,65 +33,71 @@ def get_models_genome(model_path):
     Load pre-trained model
     :return: pretrained image and caption model
     '''
-    image_model = VGG19(pretrained=True)
-    caption_model = LSTMBranch()
-
     if not os.path.exists(model_path):
         print("Not using trained models")
-        return image_model, caption_model
+        return VGG19(pretrained=True), get_text_encoder('lstm')
 
-    checkpoint = torch.load(model_path, map_location='cpu')
-    image_model.load_state_dict(checkpoint['image_model'])
-    caption_model.load_state_dict(checkpoint['caption_model'])
+    # Architecture and settings are read from the checkpoint
+    image_model, caption_model = load_models(model_path)
     print('Loaded pretrained models')
     return image_model, caption_model
 
 
 def gen_coloc_maps_matchmap(image_model, caption_model,
-                   image_tensor, caption_glove):
+                   image_tensor, caption_glove, precision='fp32', channels_last=False):
     """
     This gen_coloc processes a phrase and then averages matchmaps for each word
     Generate a list of numpy match-maps from a batch of data
     :param models and tensors:Caption glove and image tensors required 
     generate a list of co_localization maps.
+    :param precision: 'fp32' or 'bf16' autocast for the forward passes and match-maps
+    :param channels_last: feed images in the channels last memory format
     :return: A list of co-localization maps. Each map is a numpy ndarray
     """
-    image_op = image_model(image_tensor)
-    caption_op = caption_model(caption_glove)
+    image_tensor = to_channels_last(image_tensor, channels_last)
     batch_size = image_tensor.size(0)
     coloc_maps = list()
 
-    for i in np.arange(batch_size):
-        coloc = matchmap_generate(image_op[i], caption_op[i])
-        coloc = coloc.mean(0)
-        mm = coloc.detach().numpy()
-        coloc_maps.append(mm)
+    with autocast_context(precision):
+        image_op = image_model(image_tensor)
+        caption_op = caption_model(caption_glove)
+
+        for i in np.arange(batch_size):
+            coloc = matchmap_generate(image_op[i], caption_op[i])
+            coloc = coloc.float().mean(0)
+            mm = coloc.detach().numpy()
+            coloc_maps.append(mm)
 
     return coloc_maps
 
 
 def gen_coloc_maps_phrase(image_model, caption_model,
-                   image_tensor, caption_glove):
+                   image_tensor, caption_glove, precision='fp32', channels_last=False):
     """
     This gen_coloc processes a single glove embedding for a phrase.
     Generate a list of a single match-maps from a batch of data
     :param models and tensors:Caption glove and image tensors required 
     generate a list of co_localization maps.
+    :param precision: 'fp32' or 'bf16' autocast for the forward passes and match-maps
+    :param channels_last: feed images in the channels last memory format
     :return: A list of co-localization maps. Each map is a numpy ndarray
     """
-    image_op = image_model(image_tensor)
-    caption_op = caption_model(caption_glove)
-    # caption_op = caption_op.mean(1).unsqueeze(1)
+    image_tensor = to_channels_last(image_tensor, channels_last)
     batch_size = image_tensor.size(0)
     coloc_maps = list()
 
-    for i in np.arange(batch_size):
-        caption_matrix = caption_op[i]
-        caption_emb = caption_matrix.mean(0).unsqueeze(0)
-        coloc = matchmap_generate(image_op[i], caption_emb)
-        coloc = coloc.squeeze(0)
-        mm = coloc.detach().numpy()
-        coloc_maps.append(mm)
+    with autocast_context(precision):
+        image_op = image_model(image_tensor)
+        caption_op = caption_model(caption_glove)
+        # caption_op = caption_op.mean(1).unsqueeze(1)
+
+        for i in np.arange(batch_size):
+            caption_matrix = caption_op[i]
+            caption_emb = caption_matrix.mean(0).unsqueeze(0)
+            coloc = matchmap_generate(image_op[i], caption_emb)
+            coloc = coloc.squeeze(0)
+            mm = coloc.detach().float().numpy()
+            coloc_maps.append(mm)
 
     return coloc_maps
 
@@ -133,8 +139,8 @@ def bbox_processor(bbox, image_size):
     im_wt = image_size[1]
 
     new_box = list()
-    hf = 224/im_ht
-    wf = 224/im_wt
+    hf = IMAGE_SIZE/im_ht
+    wf = IMAGE_SIZE/im_wt
 
     new_box.append(x1 * wf)
     new_box.append(y1 * hf)
@@ -152,12 +158,12 @@ def genome_coloc_processor(coloc_map):
 
     mask_list = list()
     for frame in coloc_map:
-        mask = cv2.resize(frame, dsize=(224, 224))
+        mask = cv2.resize(frame, dsize=(IMAGE_SIZE, IMAGE_SIZE))
         mask_list.append(mask)
     mask_list = np.stack(mask_list, axis=0)
     return mask_list
     """
-    mask = cv2.resize(coloc_map, dsize=(224,224))
+    mask = cv2.resize(coloc_map, dsize=(IMAGE_SIZE, IMAGE_SIZE))
     return mask
 
 
@@ -237,7 +243,7 @@ def mask_viz_genome(element, save_flag=False, save_name=''):
     caption_phrase = element['caption']
     col_image = element['image']['color']
     bw_image = element['image']['bw']
-    mask = cv2.resize(element['coloc_map'], dsize=(224,224))
+    mask = cv2.resize(element['coloc_map'], dsize=(IMAGE_SIZE, IMAGE_SIZE))
     box = element['bboxes']
 
     ax1 = fig.add_subplot(121)
@@ -266,7 +272,7 @@ def seg_viz_genome(element, thresh=0.5, save_flag=False, save_name=''):
     caption_phrase = element['caption']
     col_image = element['image']['color']
     # bw_image = element['image']['bw']
-    mask = cv2.resize(element['coloc_map'], dsize=(224,224))
+    mask = cv2.resize(element['coloc_map'], dsize=(IMAGE_SIZE, IMAGE_SIZE))
     mask2 = np.where((mask<thresh*np.mean(mask)), 0, 1).astype('uint8')
     img = col_image * mask2[:,:,np.newaxis]
     box = element['bboxes']
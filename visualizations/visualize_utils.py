@@ -6,8 +6,8 @@ import matplotlib.pyplot as plt
 import matplotlib.patches as patches
 from tqdm import tqdm
 
-from steps.utils import matchmap_generate
-from models import VGG19, LSTMBranch
+from steps.utils import matchmap_generate, autocast_context, to_channels_last
+from models import VGG19, IMAGE_SIZE, get_text_encoder, load_models
 
 import sys
 
@@ -59,15 +59,17 @@ def coco_load_data(batch_size, transform, mode='val'):
     return image_tensor, caption_glove, caption_list
 
 
-def flickr_load_data(batch_size, parse_mode, transform, mode='test', eval_mode=False):
+def flickr_load_data(batch_size, parse_mode, transform, mode='test', eval_mode=False, manifest='default'):
     """
     Loads data from test fold of flickr dataset using flickr_loader
     :param parse_mode: decides whether the captions should be parsed 
+    :param manifest: split manifest the fold is resolved through
     :return: image tensor, caption glove tensor and tuple of caption ids
     """
     flickr_loader = get_loader_flickr(transform=transform,
                                       batch_size=batch_size,
-                                      mode=mode, parse_mode=parse_mode)
+                                      mode=mode, parse_mode=parse_mode,
+                                      manifest=manifest)
 
     for batch in flickr_loader:
         image, caption_glove, caption, ids = batch[0], batch[1], batch[2], batch[3]
@@ -83,38 +85,39 @@ def get_models(model_path):
     Load pre-trained model
     :return: pretrained image and caption model
     '''
-    image_model = VGG19(pretrained=True)
-    caption_model = LSTMBranch()
-
     if not os.path.exists(model_path):
         print("Not using trained models")
-        return image_model, caption_model
+        return VGG19(pretrained=True), get_text_encoder('lstm')
 
-    checkpoint = torch.load(model_path, map_location='cpu')
-    image_model.load_state_dict(checkpoint['image_model'])
-    caption_model.load_state_dict(checkpoint['caption_model'])
+    # Architecture and settings are read from the checkpoint
+    image_model, caption_model = load_models(model_path)
     print('Loaded pretrained models')
     return image_model, caption_model
 
 
 def gen_coloc_maps(image_model, caption_model,
-                   image_tensor, caption_glove):
+                   image_tensor, caption_glove, precision='fp32', channels_last=False):
     """
     Generate a list of numpy match-maps from a batch of data
     :param models and tensors:Caption glove and image tensors required 
     generate a list of co_localization maps.
+    :param precision: 'fp32' or 'bf16' autocast for the forward passes and match-maps
+    :param channels_last: feed images in the channels last memory format
     :return: A list of co-localization maps. Each map is a numpy ndarray
     """
-    image_op = image_model(image_tensor)
-    caption_op = caption_model(caption_glove)
+    image_tensor = to_channels_last(image_tensor, channels_last)
     batch_size = image_tensor.size(0)
     coloc_maps = list()
-    vgg_op = image_op.mean(1)       # Mean across depth dimension
 
-    for i in np.arange(batch_size):
-        coloc = matchmap_generate(image_op[i], caption_op[i])
-        mm = coloc.detach().numpy()
-        coloc_maps.append(mm)
+    with autocast_context(precision):
+        image_op = image_model(image_tensor)
+        caption_op = caption_model(caption_glove)
+        vgg_op = image_op.float().mean(1)       # Mean across depth dimension
+
+        for i in np.arange(batch_size):
+            coloc = matchmap_generate(image_op[i], caption_op[i])
+            mm = coloc.detach().float().numpy()
+            coloc_maps.append(mm)
 
     return coloc_maps, vgg_op
 
@@ -164,7 +167,7 @@ def vgg_op_processor(vgg_op):
     Convert each vgg_op to a mask
     """
     mask = vgg_op.detach().numpy()
-    mask = cv2.resize(mask, dsize=(224,224))
+    mask = cv2.resize(mask, dsize=(IMAGE_SIZE, IMAGE_SIZE))
 
     return mask
 
@@ -177,7 +180,7 @@ def coloc_map_processor(coloc_map):
     """
     mask_list = list()
     for frame in coloc_map:
-        mask = cv2.resize(frame, dsize=(224, 224))
+        mask = cv2.resize(frame, dsize=(IMAGE_SIZE, IMAGE_SIZE))
         mask_list.append(mask)
     mask_list = np.stack(mask_list, axis=0)
     return mask_list
@@ -307,7 +310,7 @@ def mask_viz(mask_list, caption, bw_img, boxes, save_flag=False, save_name=''):
     rows = 1
     for id in range(len(mask_list)-1):
         cap_phrase = caption[id]
-        mask = cv2.resize(mask_list[id], dsize=(224,224))
+        mask = cv2.resize(mask_list[id], dsize=(IMAGE_SIZE, IMAGE_SIZE))
         ax = fig.add_subplot(rows, columns, id + 1)
         ax.imshow(bw_img)
         ax.imshow(mask, cmap='jet', alpha=0.5)
@@ -332,7 +335,7 @@ def mask_viz_coco(mask_list, caption, bw_img, save_flag=False, save_name=''):
     rows = 1
     for id in range(len(mask_list)-1):
         cap_phrase = caption[id]
-        mask = cv2.resize(mask_list[id], dsize=(224,224))
+        mask = cv2.resize(mask_list[id], dsize=(IMAGE_SIZE, IMAGE_SIZE))
         if not cap_phrase in ['<start>','<end>',',','.','<unk>']:
             fig.add_subplot(rows, columns, id + 1)
             plt.imshow(bw_img)
@@ -355,7 +358,7 @@ def seg_viz(mask_list, caption, color_img, boxes, thresh, save_flag=False, save_
 
     for id in range(len(mask_list)-1):
         cap_phrase = caption[id]
-        mask = cv2.resize(mask_list[id], dsize=(224, 224))
+        mask = cv2.resize(mask_list[id], dsize=(IMAGE_SIZE, IMAGE_SIZE))
         mask2 = np.where((mask < thresh * np.mean(mask)), 0, 1).astype('uint8')
         ax = fig.add_subplot(rows, columns, id + 1)
         img = color_img * mask2[:, :, np.newaxis]
@@ -384,7 +387,7 @@ def seg_viz_coco(mask_list, caption, color_img, thresh, save_flag=False, save_na
 
     for id in range(len(mask_list)-1):
         cap_phrase = caption[id]
-        mask = cv2.resize(mask_list[id], dsize=(224, 224))
+        mask = cv2.resize(mask_list[id], dsize=(IMAGE_SIZE, IMAGE_SIZE))
         mask2 = np.where((mask < thresh * np.mean(mask)), 0, 1).astype('uint8')
         # ax = 
         if not cap_phrase in ['<start>', '<end>',',','.','<unk>']:
@@ -408,7 +411,7 @@ def find_mask_max(mask_list):
     """
     coords_max = list()
     for id in range(len(mask_list)):
-        mask = cv2.resize(mask_list[id], dsize=(224, 224))
+        mask = cv2.resize(mask_list[id], dsize=(IMAGE_SIZE, IMAGE_SIZE))
         ind = np.unravel_index(np.argmax(mask, axis=None), mask.shape)
         coords_max.append(ind)
     return coords_max
@@ -421,8 +424,8 @@ def flickr_box_converter(boxes, image_size):
     :param image_size: original image size from element
     :return new_boxes: transformed boxes with coordinates
     """
-    width_multiplier = 224 / image_size['width']
-    height_multiplier = 224 / image_size['height']
+    width_multiplier = IMAGE_SIZE / image_size['width']
+    height_multiplier = IMAGE_SIZE / image_size['height']
 
     new_boxes = list()
     for frame in boxes: